@@ -0,0 +1,38 @@
+# app/backfill_sessions.py
+"""
+Tính lại ChatSessions.last_time / msg_count từ ChatMessages (chạy 1 lần sau migration,
+hoặc khi nghi số liệu lệch).
+
+    python -m app.backfill_sessions
+    python -m app.backfill_sessions --page-size 500
+
+Duyệt session theo keyset (session_id), mỗi trang 1 UPDATE ... JOIN + commit → không khoá bảng lâu.
+"""
+from __future__ import annotations
+
+import argparse
+import time
+
+from .db import db_conn, backfill_session_summary
+
+
+def run(page_size: int = 1000) -> dict:
+    t0 = time.perf_counter()
+    after, pages = "", 0
+    while True:
+        with db_conn() as conn:
+            after = backfill_session_summary(conn, after_sid=after, limit=page_size)
+        if after is None:
+            break
+        pages += 1
+    return {"pages": pages, "seconds": round(time.perf_counter() - t0, 1)}
+
+def main():
+    ap = argparse.ArgumentParser(description="Backfill ChatSessions.last_time/msg_count")
+    ap.add_argument("--page-size", type=int, default=1000, help="số session / lần UPDATE")
+    a = ap.parse_args()
+    stats = run(page_size=a.page_size)
+    print(f"Backfilled {stats['pages']} pages of sessions ({stats['seconds']}s).")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# app/bench_sql.py
+"""
+Micro-benchmark: text() dựng mỗi lần gọi (cách cũ) vs Stmt khai báo sẵn trong app/sql.py.
+
+    python -m app.bench_sql                 # MySQL theo .env (insert chạy trong transaction rồi rollback)
+    python -m app.bench_sql --sqlite        # không cần DB: SQLite trong RAM, chỉ đo phần phía client
+    python -m app.bench_sql -n 20000
+
+Đo các đường nóng: get_book_by_id, books_by_ids (IN mở rộng, nhánh bù id của search),
+insert_chat (INSERT ChatMessages), get_chat_history (trang mới nhất).
+"""
+from __future__ import annotations
+
+import argparse
+import time
+
+from sqlalchemy import bindparam, create_engine, text
+
+from . import sql as Q
+
+_SQLITE_SCHEMA = [
+    """CREATE TABLE Books(book_id INTEGER PRIMARY KEY, title TEXT, author TEXT,
+         price INTEGER, stock INTEGER, category TEXT)""",
+    """CREATE TABLE ChatMessages(id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT, role TEXT,
+         content TEXT, created_at TEXT DEFAULT CURRENT_TIMESTAMP)""",
+    "INSERT INTO Books VALUES (7, 'Dế Mèn phiêu lưu ký', 'Tô Hoài', 50000, 10, 'Thiếu nhi')",
+]
+
+# ----- cách cũ: TextClause mới mỗi lần gọi -----
+def _old_book(conn):
+    r = conn.execute(text("""
+      SELECT book_id, title, author, price, stock, category
+      FROM Books WHERE book_id=:id
+    """), {"id": 7}).mappings().first()
+    return dict(r) if r else None
+
+def _old_by_ids(conn):
+    stmt = text("""
+        SELECT book_id, title, author, price, stock, category
+        FROM Books
+        WHERE book_id IN :ids
+    """).bindparams(bindparam("ids", expanding=True))
+    return [dict(r) for r in conn.execute(stmt, {"ids": [7, 8, 9]}).mappings().all()]
+
+def _old_insert(conn):
+    conn.execute(text("""
+      INSERT INTO ChatMessages(session_id, role, content) VALUES (:sid,:role,:content)
+    """), {"sid": "bench-sql", "role": "user", "content": "xin chào"})
+
+def _old_history(conn):
+    rows = conn.execute(text("""
+      SELECT id, role, content, created_at
+      FROM ChatMessages
+      WHERE session_id = :sid
+      ORDER BY id DESC
+      LIMIT :lim
+    """), {"sid": "bench-sql", "lim": 20}).mappings().all()
+    return [dict(r) for r in reversed(rows)]
+
+# ----- cách mới -----
+def _new_book(conn):
+    return Q.BOOK_BY_ID.one(conn, {"id": 7})
+
+def _new_by_ids(conn):
+    return Q.BOOKS_BY_IDS.rows(conn, {"ids": [7, 8, 9]})
+
+def _new_insert(conn):
+    Q.CHAT_INSERT.run(conn, {"sid": "bench-sql", "role": "user", "content": "xin chào"})
+
+def _new_history(conn):
+    return Q.CHAT_LATEST.rows(conn, {"sid": "bench-sql", "lim": 20})[::-1]
+
+CASES = [
+    ("get_book_by_id", _old_book, _new_book),
+    ("books_by_ids", _old_by_ids, _new_by_ids),
+    ("insert_chat", _old_insert, _new_insert),
+    ("get_chat_history", _old_history, _new_history),
+]
+
+
+def _time(fn, conn, n: int) -> float:
+    for _ in range(min(200, n)):   # warm-up: compiled cache, prepared statement
+        fn(conn)
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn(conn)
+    return (time.perf_counter() - t0) / n * 1e6
+
+
+def run(n: int = 5000, sqlite: bool = False) -> list[dict]:
+    if sqlite:
+        eng = create_engine("sqlite://")
+    else:
+        from .db import engine as eng
+    out = []
+    with eng.connect() as conn:
+        if sqlite:
+            for ddl in _SQLITE_SCHEMA:
+                conn.execute(text(ddl))
+        else:
+            # FK ChatMessages → ChatSessions: tạo phiên bench trong cùng transaction (rollback ở cuối)
+            Q.CHAT_SESSION_ENSURE.run(conn, {"sid": "bench-sql"})
+        for name, old, new in CASES:
+            us_old = _time(old, conn, n)
+            us_new = _time(new, conn, n)
+            out.append({"case": name, "old_us": round(us_old, 1), "new_us": round(us_new, 1),
+                        "saved_us": round(us_old - us_new, 1)})
+        conn.rollback()   # không để lại dòng benchmark trong DB
+    return out
+
+def main():
+    ap = argparse.ArgumentParser(description="Per-call cost: text() per call vs precompiled statements")
+    ap.add_argument("-n", type=int, default=5000, help="số lần gọi mỗi case")
+    ap.add_argument("--sqlite", action="store_true", help="SQLite trong RAM thay vì MySQL")
+    a = ap.parse_args()
+    print(f"{'case':<18}{'old µs':>10}{'new µs':>10}{'saved µs':>10}")
+    for r in run(n=a.n, sqlite=a.sqlite):
+        print(f"{r['case']:<18}{r['old_us']:>10}{r['new_us']:>10}{r['saved_us']:>10}")
+
+if __name__ == "__main__":
+    main()
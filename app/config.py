@@ -13,12 +13,111 @@ class Settings(BaseModel):
     db_user: str = os.getenv("DB_USER", "root")
     db_pass: str = os.getenv("DB_PASS", "123456")
     db_name: str = os.getenv("DB_NAME", "bookstore")
+    # Pool kết nối (mỗi engine sync/async): recycle trước wait_timeout của MySQL/proxy;
+    # không pre-ping mỗi checkout, chỉ ping kết nối đã rỗi quá DB_PING_IDLE_SEC (0 = tắt)
+    db_pool_size: int = int(os.getenv("DB_POOL_SIZE", "10"))
+    db_max_overflow: int = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+    db_pool_timeout: float = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+    db_pool_recycle: int = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+    db_pool_pre_ping: bool = os.getenv("DB_POOL_PRE_PING", "0") == "1"
+    db_ping_idle_sec: float = float(os.getenv("DB_PING_IDLE_SEC", "300"))
+    # Log cảnh báo câu SQL chạy lâu hơn N ms (0 = tắt)
+    db_slow_query_ms: float = float(os.getenv("DB_SLOW_QUERY_MS", "500"))
+    # Driver sync ('pymysql' | 'mysqlconnector'); DB_SERVER_PREPARE=1 chỉ có tác dụng với mysqlconnector
+    db_driver: str = os.getenv("DB_DRIVER", "pymysql")
+    db_server_prepare: bool = os.getenv("DB_SERVER_PREPARE", "0") == "1"
 
     # LLM & Embedding (Ollama)
     llm_model: str   = os.getenv("LLM_MODEL", "llama3.1:8b")
     embed_model: str = os.getenv("EMBED_MODEL", "nomic-embed-text")
     ollama_url: str  = os.getenv("OLLAMA_URL", "http://localhost:11434")
 
+    # HTTP client tới LLM (pool keep-alive, dùng chung giữa các lần gọi)
+    llm_timeout: float = float(os.getenv("LLM_TIMEOUT", "60"))
+    llm_max_connections: int = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+    llm_max_keepalive: int = int(os.getenv("LLM_MAX_KEEPALIVE", "10"))
+    llm_keepalive_expiry: float = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30"))
+
+    # Embedding theo lô: số văn bản / request /api/embed và số request chạy song song
+    embed_batch_size: int = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+    embed_concurrency: int = int(os.getenv("EMBED_CONCURRENCY", "4"))
+
+    # Cache embedding của câu truy vấn (LRU trong RAM + tuỳ chọn SQLite trên đĩa)
+    query_embed_cache_size: int = int(os.getenv("QUERY_EMBED_CACHE_SIZE", "4096"))
+    query_embed_cache_ttl: float = float(os.getenv("QUERY_EMBED_CACHE_TTL", "86400"))
+    query_embed_cache_path: str = os.getenv("QUERY_EMBED_CACHE_PATH", "")  # rỗng = chỉ RAM
+
+    # Cache kết quả HybridRetriever.search (bị xoá chính xác khi admin sửa catalog)
+    search_cache_size: int = int(os.getenv("SEARCH_CACHE_SIZE", "1024"))
+    search_cache_ttl: float = float(os.getenv("SEARCH_CACHE_TTL", "300"))
+
+    # Deadline (giây) cho từng nhánh ứng viên của search; quá hạn thì bỏ nhánh đó
+    search_lexical_timeout: float = float(os.getenv("SEARCH_LEXICAL_TIMEOUT", "1.0"))
+    search_vector_timeout: float = float(os.getenv("SEARCH_VECTOR_TIMEOUT", "1.5"))
+
+    # Rerank: số ứng viên mỗi nhánh, trọng số và cách gộp điểm ('linear' | 'rrf')
+    search_candidates: int = int(os.getenv("SEARCH_CANDIDATES", "100"))
+    rerank_fusion: str = os.getenv("RERANK_FUSION", "linear")
+    rerank_w_fuzzy: float = float(os.getenv("RERANK_W_FUZZY", "0.55"))
+    rerank_w_vector: float = float(os.getenv("RERANK_W_VECTOR", "0.35"))
+    rerank_title_boost: float = float(os.getenv("RERANK_TITLE_BOOST", "0.20"))
+    rerank_cat_boost: float = float(os.getenv("RERANK_CAT_BOOST", "0.15"))
+    rerank_rrf_k: float = float(os.getenv("RERANK_RRF_K", "60"))
+
+    # Catalog snapshot trong RAM: chu kỳ refresh tăng dần (giây)
+    catalog_refresh_sec: float = float(os.getenv("CATALOG_REFRESH_SEC", "30"))
+
+    # Session state: 'memory' (LRU+TTL trong process) | 'mysql' | 'redis' (dùng chung giữa các worker)
+    session_store: str = os.getenv("SESSION_STORE", "memory")
+    session_max: int = int(os.getenv("SESSION_MAX", "10000"))
+    session_ttl: float = float(os.getenv("SESSION_TTL", "86400"))
+    session_flush_ms: float = float(os.getenv("SESSION_FLUSH_MS", "200"))
+    redis_url: str = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+    # WebSocket fan-out giữa các worker: 'local' (1 worker) | 'mysql' (poll HubEvents) | 'redis' (pub/sub)
+    hub_backplane: str = os.getenv("HUB_BACKPLANE", "local")
+    hub_poll_ms: float = float(os.getenv("HUB_POLL_MS", "250"))
+    hub_channel: str = os.getenv("HUB_CHANNEL", "bookstore:hub")
+    # Hàng đợi gửi mỗi socket; đầy thì 'drop_oldest' | 'coalesce' | 'disconnect'
+    ws_queue_size: int = int(os.getenv("WS_QUEUE_SIZE", "64"))
+    ws_send_timeout: float = float(os.getenv("WS_SEND_TIMEOUT", "5"))
+    ws_slow_policy: str = os.getenv("WS_SLOW_POLICY", "drop_oldest")
+
+    # Ghi ChatMessages theo lô (write-behind): flush khi đủ số tin hoặc sau N ms
+    chatlog_batch_size: int = int(os.getenv("CHATLOG_BATCH_SIZE", "200"))
+    chatlog_flush_ms: float = float(os.getenv("CHATLOG_FLUSH_MS", "50"))
+    # trần buffer khi DB lỗi kéo dài: vượt thì bỏ tin cũ nhất (đếm ở 'dropped')
+    chatlog_max_buffer: int = int(os.getenv("CHATLOG_MAX_BUFFER", "10000"))
+
+    # Lịch sử chat: số tin mỗi trang mặc định / tối đa (after_id với limit lớn hơn → stream)
+    chat_history_page: int = int(os.getenv("CHAT_HISTORY_PAGE", "50"))
+    chat_history_max_page: int = int(os.getenv("CHAT_HISTORY_MAX_PAGE", "500"))
+
+    # Trang admin: số dòng mỗi trang (orders/books)
+    admin_page_size: int = int(os.getenv("ADMIN_PAGE_SIZE", "50"))
+
+    # Feed sự kiện đơn hàng cho admin: giữ log bao lâu để client kết nối lại còn bù được (giây)
+    order_feed_retention_sec: int = int(os.getenv("ORDER_FEED_RETENTION_SEC", "86400"))
+
+    # Cache phản hồi complete_json (0 = tắt); TTL mặc định + TTL theo call site; path rỗng = chỉ RAM
+    llm_cache_size: int = int(os.getenv("LLM_CACHE_SIZE", "2048"))
+    llm_cache_ttl: float = float(os.getenv("LLM_CACHE_TTL", "600"))
+    llm_cache_ttls: str = os.getenv("LLM_CACHE_TTLS", "nlu=3600,planner=600,responder=300")
+    llm_cache_path: str = os.getenv("LLM_CACHE_PATH", "")
+
+    # Admission control trước LLM: số request đồng thời mỗi model (mặc định + riêng từng model 'model=n,...')
+    # và deadline chờ (giây) theo lớp ưu tiên interactive/background/batch (0 = chờ mãi)
+    llm_max_inflight: int = int(os.getenv("LLM_MAX_INFLIGHT", "2"))
+    llm_max_inflight_models: str = os.getenv("LLM_MAX_INFLIGHT_MODELS", "")
+    llm_queue_deadlines: str = os.getenv("LLM_QUEUE_DEADLINES", "interactive=15,background=120,batch=0")
+
+    # Structured outputs: gửi JSON Schema của output cho LLM (Ollama format=<schema>, OpenAI json_schema);
+    # 0 = chỉ ép JSON (format "json" / json_object) như cũ
+    llm_structured_output: bool = os.getenv("LLM_STRUCTURED_OUTPUT", "1") == "1"
+
+    # NLU nhiều tầng: luật/từ điển đủ tin cậy (>= ngưỡng) thì bỏ qua LLM; > 1 = luôn gọi LLM
+    nlu_fast_threshold: float = float(os.getenv("NLU_FAST_THRESHOLD", "0.8"))
+
     # Vector store path
     chroma_dir: str = os.getenv("CHROMA_DIR", ".chroma")
 
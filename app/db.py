@@ -1,192 +1,411 @@
-from sqlalchemy import create_engine, text
+import logging
+import threading
+import time
+from sqlalchemy import create_engine, event, exc as sa_exc
 from sqlalchemy.engine import Engine
-from contextlib import contextmanager
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncConnection
+from contextlib import contextmanager, asynccontextmanager
+from typing import AsyncIterator
 from urllib.parse import quote_plus
 from .config import settings
+from . import sql as Q
 
-def _build_url() -> str:
+logger = logging.getLogger(__name__)
+
+def _build_url(driver: str = "pymysql") -> str:
     user = quote_plus(settings.db_user)
     pwd  = quote_plus(settings.db_pass)
     host = settings.db_host
     port = settings.db_port
     db   = settings.db_name
-    return f"mysql+pymysql://{user}:{pwd}@{host}:{port}/{db}"
+    return f"mysql+{driver}://{user}:{pwd}@{host}:{port}/{db}"
+
+def _pool_kwargs() -> dict:
+    # Không pre-ping mỗi lần checkout (thêm 1 round-trip); thay bằng recycle định kỳ
+    # + ping chỉ khi kết nối đã nằm rỗi lâu hơn db_ping_idle_sec (xem _instrument)
+    return dict(
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_timeout=settings.db_pool_timeout,
+        pool_recycle=settings.db_pool_recycle,
+        pool_pre_ping=settings.db_pool_pre_ping,
+    )
+
+engine: Engine = create_engine(_build_url(settings.db_driver), future=True, **_pool_kwargs())
+# Engine async (aiomysql) cho đường chat: không chiếm thread trong lúc chờ DB
+async_engine: AsyncEngine = create_async_engine(_build_url("aiomysql"), **_pool_kwargs())
+
+# ---------- Pool metrics + slow query log ----------
+_pool_metrics = {
+    name: {"checkouts": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0, "timeouts": 0,
+           "connects": 0, "pings": 0, "ping_failures": 0, "invalidated": 0,
+           "queries": 0, "slow_queries": 0}
+    for name in ("sync", "async")
+}
+
+_metrics_lock = threading.Lock()   # event pool chạy trên nhiều thread (threadpool + executor của arun)
+
+def _bump(m: dict, field: str, n: float = 1) -> None:
+    with _metrics_lock:
+        m[field] += n
+
+def _instrument(eng: Engine, name: str) -> None:
+    m = _pool_metrics[name]
+    ping_idle = settings.db_ping_idle_sec
+
+    @event.listens_for(eng, "connect")
+    def _on_connect(dbapi_conn, record):
+        _bump(m, "connects")
+
+    @event.listens_for(eng, "checkin")
+    def _on_checkin(dbapi_conn, record):
+        record.info["idle_since"] = time.monotonic()
+
+    @event.listens_for(eng, "checkout")
+    def _on_checkout(dbapi_conn, record, proxy):
+        # ping rẻ: chỉ khi kết nối đã nằm rỗi lâu (MySQL/proxy có thể đã cắt)
+        idle_since = record.info.pop("idle_since", None)
+        if ping_idle <= 0 or idle_since is None or time.monotonic() - idle_since < ping_idle:
+            return
+        _bump(m, "pings")
+        try:
+            eng.dialect.do_ping(dbapi_conn)
+        except Exception as e:
+            _bump(m, "ping_failures")
+            # pool bỏ kết nối này và lấy/tạo kết nối khác
+            raise sa_exc.DisconnectionError() from e
+
+    @event.listens_for(eng, "invalidate")
+    def _on_invalidate(dbapi_conn, record, exception):
+        _bump(m, "invalidated")
+
+    @event.listens_for(eng, "before_cursor_execute")
+    def _before_exec(conn, cursor, statement, params, context, executemany):
+        conn.info.setdefault("query_t0", []).append(time.perf_counter())
+
+    @event.listens_for(eng, "after_cursor_execute")
+    def _after_exec(conn, cursor, statement, params, context, executemany):
+        stack = conn.info.get("query_t0")
+        if not stack:
+            return
+        _note_query(name, statement, time.perf_counter() - stack.pop())
+
+def _note_query(name: str, statement: str, dt: float) -> None:
+    m = _pool_metrics[name]
+    _bump(m, "queries")
+    slow_s = settings.db_slow_query_ms / 1000.0
+    if slow_s > 0 and dt >= slow_s:
+        _bump(m, "slow_queries")
+        logger.warning("slow query (%s, %.0f ms): %s", name, dt * 1000, " ".join(statement.split())[:500])
+
+def _note_prepared(conn, statement: str, dt: float) -> None:
+    # nhánh prepared của Stmt chạy thẳng trên cursor DBAPI, không qua event của engine
+    _note_query("async" if conn.engine is async_engine.sync_engine else "sync", statement, dt)
 
-engine: Engine = create_engine(_build_url(), pool_pre_ping=True, future=True)
+_instrument(engine, "sync")
+_instrument(async_engine.sync_engine, "async")
+Q.on_prepared_query = _note_prepared
+
+def _note_checkout(name: str, t0: float) -> None:
+    m = _pool_metrics[name]
+    ms = (time.perf_counter() - t0) * 1000
+    with _metrics_lock:
+        m["checkouts"] += 1
+        m["wait_ms_total"] += ms
+        m["wait_ms_max"] = max(m["wait_ms_max"], ms)
+
+def pool_stats() -> dict:
+    out = {}
+    for name, eng in (("sync", engine), ("async", async_engine.sync_engine)):
+        pool = eng.pool
+        with _metrics_lock:
+            m = dict(_pool_metrics[name])
+        out[name] = {
+            **m,
+            "wait_ms_total": round(m["wait_ms_total"], 1),
+            "wait_ms_max": round(m["wait_ms_max"], 1),
+            "wait_ms_avg": round(m["wait_ms_total"] / m["checkouts"], 2) if m["checkouts"] else 0.0,
+            "size": pool.size(), "in_use": pool.checkedout(),
+            "idle": pool.checkedin(), "overflow": max(0, pool.overflow()),
+        }
+    return out
 
 @contextmanager
 def db_conn():
-    with engine.connect() as conn:
+    t0 = time.perf_counter()
+    try:
+        conn = engine.connect()   # checkout pool ngay tại đây
+    except sa_exc.TimeoutError:
+        _bump(_pool_metrics["sync"], "timeouts")
+        raise
+    _note_checkout("sync", t0)
+    with conn:
         yield conn
 
+@asynccontextmanager
+async def adb_conn() -> AsyncIterator[AsyncConnection]:
+    t0 = time.perf_counter()
+    entered = False
+    try:
+        async with async_engine.connect() as conn:
+            entered = True
+            _note_checkout("async", t0)
+            yield conn
+    except sa_exc.TimeoutError:
+        if not entered:
+            _bump(_pool_metrics["async"], "timeouts")
+        raise
+
+async def arun(fn, *args, **kwargs):
+    """
+    Chạy 1 helper sync bên dưới (nhận conn làm tham số đầu) trên kết nối async.
+    Vd: await arun(get_book_by_id, 7)
+    """
+    async with adb_conn() as conn:
+        return await conn.run_sync(fn, *args, **kwargs)
+
 # ---------- Books ----------
 def list_books(conn):
-    rows = conn.execute(text("""
-      SELECT book_id, title, author, price, stock, category
-      FROM Books ORDER BY book_id DESC
-    """)).mappings().all()
-    return [dict(r) for r in rows]
+    return Q.BOOKS_ALL.rows(conn)
 
 def get_book_by_id(conn, book_id:int):
-    r = conn.execute(text("""
-      SELECT book_id, title, author, price, stock, category
-      FROM Books WHERE book_id=:id
-    """), {"id": book_id}).mappings().first()
-    return dict(r) if r else None
+    return Q.BOOK_BY_ID.one(conn, {"id": book_id})
 
 def create_book(conn, data: dict) -> int:
-    r = conn.execute(text("""
-      INSERT INTO Books(title,author,price,stock,category)
-      VALUES (:title,:author,:price,:stock,:category)
-    """), data)
+    r = Q.BOOK_INSERT.run(conn, data)
     conn.commit()
     return r.lastrowid
 
 def update_book(conn, book_id:int, data: dict) -> bool:
-    conn.execute(text("""
-      UPDATE Books SET title=:title,author=:author,price=:price,stock=:stock,category=:category
-      WHERE book_id=:id
-    """), {**data, "id": book_id})
+    Q.BOOK_UPDATE.run(conn, {**data, "id": book_id})
     conn.commit()
     return True
 
 def delete_book(conn, book_id:int) -> bool:
-    conn.execute(text("DELETE FROM Books WHERE book_id=:id"), {"id": book_id})
+    Q.BOOK_DELETE.run(conn, {"id": book_id})
     conn.commit()
     return True
 
+# Cột được phép sort ở trang admin (tên tham số → cột SQL)
+BOOK_SORTS = {"id": "book_id", "title": "title", "price": "price", "stock": "stock"}
+
+def page_books(conn, limit: int = 50, sort: str = "id", desc: bool = True,
+               after: tuple | None = None, q: str | None = None):
+    """
+    Keyset theo (cột sort, book_id): after = (giá trị sort, book_id) của dòng cuối trang trước.
+    q: lọc theo tiêu đề / tác giả / thể loại.
+    """
+    col = BOOK_SORTS.get(sort, "book_id")
+    op = "<" if desc else ">"
+    direction = "DESC" if desc else "ASC"
+    where, params = [], {"lim": limit}
+    if q:
+        where.append("(title LIKE :q OR author LIKE :q OR category LIKE :q)")
+        params["q"] = f"%{q}%"
+    if after is not None:
+        if col == "book_id":
+            where.append(f"book_id {op} :a_id")
+        else:
+            where.append(f"({col} {op} :a_val OR ({col} = :a_val AND book_id {op} :a_id))")
+            params["a_val"] = after[0]
+        params["a_id"] = after[1]
+    return Q.variant(f"""
+      SELECT book_id, title, author, price, stock, category
+      FROM Books {"WHERE " + " AND ".join(where) if where else ""}
+      ORDER BY {col} {direction}{"" if col == "book_id" else f", book_id {direction}"}
+      LIMIT :lim
+    """).rows(conn, params)
+
 # ---------- Orders ----------
 def create_order(conn, payload: dict) -> int:
-    r = conn.execute(text("""
-      INSERT INTO Orders (customer_name, phone, address, book_id, quantity, status, session_id)
-      VALUES (:customer_name, :phone, :address, :book_id, :quantity, 'pending', :session_id)
-    """), payload)
+    r = Q.ORDER_INSERT.run(conn, payload)
     conn.commit()
     return r.lastrowid
 
 def list_orders_by_status(conn, status:str, limit:int=200):
-    rows = conn.execute(text("""
-      SELECT o.order_id, o.customer_name, o.phone, o.address,
-             o.book_id, b.title, b.author, o.quantity, o.status, o.created_at,
-             b.price, (b.price * o.quantity) AS total, o.session_id
+    return Q.ORDERS_BY_STATUS.rows(conn, {"status": status, "lim": limit})
+
+def page_orders(conn, status: str, limit: int = 50, desc: bool = True,
+                after: tuple | None = None, q: str | None = None):
+    """
+    Keyset theo (created_at, order_id) trong 1 status → index (status, created_at) (+PK).
+    after = (created_at, order_id) của dòng cuối trang trước; q: tên khách / SĐT / tên sách.
+    """
+    op = "<" if desc else ">"
+    direction = "DESC" if desc else "ASC"
+    where, params = ["o.status=:status"], {"status": status, "lim": limit}
+    if q:
+        where.append("(o.customer_name LIKE :q OR o.phone LIKE :q OR b.title LIKE :q)")
+        params["q"] = f"%{q}%"
+    if after is not None:
+        where.append(f"(o.created_at {op} :a_at OR (o.created_at = :a_at AND o.order_id {op} :a_id))")
+        params.update(a_at=after[0], a_id=after[1])
+    return Q.variant(f"""
+      SELECT {Q.ORDER_COLS}
       FROM Orders o
       JOIN Books b ON b.book_id=o.book_id
-      WHERE o.status=:status
-      ORDER BY o.created_at DESC
+      WHERE {" AND ".join(where)}
+      ORDER BY o.created_at {direction}, o.order_id {direction}
       LIMIT :lim
-    """), {"status": status, "lim": limit}).mappings().all()
-    return [dict(r) for r in rows]
+    """).rows(conn, params)
+
+def get_order_detail(conn, order_id: int):
+    """1 đơn với cùng các cột như page_orders (dùng cho event feed admin)."""
+    return Q.ORDER_DETAIL.one(conn, {"id": order_id})
+
+def count_orders_by_status(conn) -> dict:
+    rows = Q.ORDER_COUNTS.execute(conn).all()
+    counts = {"pending": 0, "approved": 0, "cancelled": 0}
+    counts.update({r[0]: int(r[1]) for r in rows})
+    return counts
 
 def approve_order(conn, order_id:int) -> bool:
     with conn.begin():
-        r = conn.execute(text("SELECT book_id, quantity FROM Orders WHERE order_id=:id FOR UPDATE"),
-                         {"id": order_id}).mappings().first()
+        r = Q.ORDER_LOCK.one(conn, {"id": order_id})
         if not r: return False
         bid, qty = r["book_id"], r["quantity"]
-        upd = conn.execute(text("""
-          UPDATE Books SET stock = stock - :qty
-          WHERE book_id=:bid AND stock >= :qty
-        """), {"qty": qty, "bid": bid})
+        upd = Q.BOOK_TAKE_STOCK.run(conn, {"qty": qty, "bid": bid})
         if upd.rowcount == 0: return False
-        conn.execute(text("UPDATE Orders SET status='approved' WHERE order_id=:id"), {"id": order_id})
+        Q.ORDER_APPROVE.run(conn, {"id": order_id})
     return True
 
 def cancel_order(conn, order_id:int) -> bool:
-    res = conn.execute(text("UPDATE Orders SET status='cancelled' WHERE order_id=:id"), {"id": order_id})
+    res = Q.ORDER_CANCEL.run(conn, {"id": order_id})
     conn.commit()
     return res.rowcount > 0
 
+def get_order(conn, order_id:int):
+    return Q.ORDER_BY_ID.one(conn, {"id": order_id})
+
 def get_order_session(conn, order_id:int):
-    r = conn.execute(text("SELECT session_id FROM Orders WHERE order_id=:id"), {"id": order_id}).mappings().first()
-    return r["session_id"] if r else None
+    return Q.ORDER_SESSION.scalar(conn, {"id": order_id})
 
 # ---------- Fulltext for RAG ----------
 def fetch_books_fulltext(conn, q: str, limit:int=10):
     try:
-        rows = conn.execute(text("""
-          SELECT book_id, title, author, price, stock, category,
-                 MATCH(title, author) AGAINST (:q IN NATURAL LANGUAGE MODE) AS score
-          FROM Books
-          WHERE MATCH(title, author) AGAINST (:q IN NATURAL LANGUAGE MODE)
-          ORDER BY score DESC
-          LIMIT :lim
-        """), {"q": q, "lim": limit}).mappings().all()
+        return Q.BOOKS_FULLTEXT.rows(conn, {"q": q, "lim": limit})
     except Exception:
-        rows = conn.execute(text("""
-          SELECT book_id, title, author, price, stock, category, 0.0 AS score
-          FROM Books
-          WHERE title LIKE :like OR author LIKE :like
-          LIMIT :lim
-        """), {"like": f"%{q}%", "lim": limit}).mappings().all()
-    return [dict(r) for r in rows]
+        return Q.BOOKS_LIKE_TITLE_AUTHOR.rows(conn, {"like": f"%{q}%", "lim": limit})
 
 # ---------- Chat history ----------
 def ensure_chat_session(conn, session_id: str):
-    conn.execute(
-        text("INSERT IGNORE INTO ChatSessions(session_id) VALUES (:sid)"),
-        {"sid": session_id},
-    )
+    Q.CHAT_SESSION_ENSURE.run(conn, {"sid": session_id})
     conn.commit()
 
-def get_chat_history(conn, session_id: str, limit: int = 1000):
-    rows = conn.execute(text("""
-      SELECT role, content, created_at
+def get_chat_history(conn, session_id: str, limit: int = 1000,
+                     before_id: int | None = None, after_id: int | None = None):
+    """
+    Keyset theo ChatMessages.id (idx_chat_session = (session_id, id) vì InnoDB kèm PK).
+    - after_id: các tin mới hơn after_id (tải tăng dần)
+    - còn lại: trang mới nhất, trước before_id nếu có
+    Luôn trả theo id tăng dần.
+    """
+    if after_id is not None:
+        return Q.CHAT_AFTER.rows(conn, {"sid": session_id, "after": after_id, "lim": limit})
+    if before_id:
+        rows = Q.CHAT_BEFORE.rows(conn, {"sid": session_id, "before": before_id, "lim": limit})
+    else:
+        rows = Q.CHAT_LATEST.rows(conn, {"sid": session_id, "lim": limit})
+    return rows[::-1]
+
+def iter_chat_history(conn, session_id: str, after_id: int = 0, limit: int | None = None, batch: int = 500):
+    """Đọc lịch sử lớn bằng server-side cursor, trả từng lô (không dựng cả list trong RAM)."""
+    stmt = Q.variant(f"""
+      SELECT id, role, content, created_at
       FROM ChatMessages
-      WHERE session_id = :sid
+      WHERE session_id = :sid AND id > :after
       ORDER BY id ASC
-      LIMIT :lim
-    """), {"sid": session_id, "lim": limit}).mappings().all()
-    return [dict(r) for r in rows]
+      {"LIMIT :lim" if limit else ""}
+    """)
+    res = stmt.execute(conn.execution_options(stream_results=True),
+                       {"sid": session_id, "after": after_id, "lim": limit})
+    for part in res.mappings().partitions(batch):
+        yield [dict(r) for r in part]
 
 def insert_chat(conn, session_id: str, role: str, content: str):
-    conn.execute(text("""
-      INSERT INTO ChatMessages(session_id, role, content) VALUES (:sid,:role,:content)
-    """), {"sid": session_id, "role": role, "content": content})
+    Q.CHAT_TOUCH_SESSION.run(conn, {"sid": session_id, "n": 1})
+    Q.CHAT_INSERT.run(conn, {"sid": session_id, "role": role, "content": content})
+    conn.commit()
+
+def insert_chats(conn, rows: list[dict]) -> int:
+    """
+    Ghi 1 lô tin nhắn (nhiều session) trong 1 transaction / 1 commit.
+    rows: [{sid, role, content}] theo đúng thứ tự phát sinh.
+    executemany → PyMySQL gộp thành INSERT nhiều dòng.
+    ChatSessions.last_time/msg_count được cập nhật cùng lô (sid sắp xếp → thứ tự khoá cố định giữa các worker).
+    """
+    if not rows:
+        return 0
+    counts: dict[str, int] = {}
+    for r in rows:
+        counts[r["sid"]] = counts.get(r["sid"], 0) + 1
+    Q.CHAT_TOUCH_SESSION.run(conn, [{"sid": sid, "n": n} for sid, n in sorted(counts.items())])
+    Q.CHAT_INSERT.run(conn, rows)
     conn.commit()
+    return len(rows)
 
 def list_chat_sessions(conn, q: str | None = None, limit: int = 200):
-    if q:
-        rows = conn.execute(text("""
-          SELECT s.session_id,
-                 COALESCE(MAX(m.created_at), s.created_at) AS last_time,
-                 COUNT(m.id) AS msg_count
-          FROM ChatSessions s
-          LEFT JOIN ChatMessages m ON m.session_id = s.session_id
-          WHERE s.session_id LIKE :q
-          GROUP BY s.session_id
-          ORDER BY last_time DESC
-          LIMIT :lim
-        """), {"q": f"%{q}%", "lim": limit}).mappings().all()
-    else:
-        rows = conn.execute(text("""
-          SELECT s.session_id,
-                 COALESCE(MAX(m.created_at), s.created_at) AS last_time,
-                 COUNT(m.id) AS msg_count
-          FROM ChatSessions s
-          LEFT JOIN ChatMessages m ON m.session_id = s.session_id
-          GROUP BY s.session_id
-          ORDER BY last_time DESC
-          LIMIT :lim
-        """), {"lim": limit}).mappings().all()
-    return [dict(r) for r in rows]
+    """
+    Đọc thẳng cột tóm tắt last_time/msg_count (idx_sessions_last) – không JOIN/GROUP BY ChatMessages.
+    Có q: vẫn duyệt theo thứ tự index last_time, lọc session_id rồi dừng ở LIMIT.
+    """
+    return Q.variant(f"""
+      SELECT session_id, last_time, msg_count
+      FROM ChatSessions {"WHERE session_id LIKE :q" if q else ""}
+      ORDER BY last_time DESC
+      LIMIT :lim
+    """).rows(conn, {"q": f"%{q}%", "lim": limit})
+
+def backfill_session_summary(conn, after_sid: str = "", limit: int = 1000) -> str | None:
+    """Tính lại last_time/msg_count cho 1 trang session (keyset theo session_id). Trả session_id cuối, None nếu hết."""
+    sids = Q.CHAT_SESSION_PAGE_IDS.execute(conn, {"after": after_sid, "lim": limit}).scalars().all()
+    if not sids:
+        return None
+    Q.CHAT_SESSION_BACKFILL.run(conn, {"first": sids[0], "last": sids[-1]})
+    conn.commit()
+    return sids[-1]
+
 def fetch_books_by_category(conn, category: str, limit: int = 10):
     # Lọc đơn giản theo thể loại; MySQL thường đang dùng collation CI nên không phân biệt hoa/thường/dấu
-    rows = conn.execute(text("""
-      SELECT book_id, title, author, price, stock, category
-      FROM Books
-      WHERE category LIKE :pat
-      ORDER BY stock DESC, book_id DESC
-      LIMIT :lim
-    """), {"pat": f"%{category}%", "lim": limit}).mappings().all()
-    return [dict(r) for r in rows]
+    return Q.BOOKS_BY_CATEGORY.rows(conn, {"pat": f"%{category}%", "lim": limit})
 
 def fetch_books_keywords(conn, q: str, limit: int = 10):
     # Fallback khi MATCH() không có: dùng LIKE
-    rows = conn.execute(text("""
-      SELECT book_id, title, author, price, stock, category, 0.0 AS score
-      FROM Books
-      WHERE title LIKE :like OR author LIKE :like OR category LIKE :like
-      ORDER BY book_id DESC
-      LIMIT :lim
-    """), {"like": f"%{q}%", "lim": limit}).mappings().all()
-    return [dict(r) for r in rows]
\ No newline at end of file
+    return Q.BOOKS_KEYWORDS.rows(conn, {"like": f"%{q}%", "lim": limit})
+
+# ---------- Hub events (backplane WebSocket giữa các worker) ----------
+def insert_hub_event(conn, payload: str) -> int:
+    r = Q.HUB_EVENT_INSERT.run(conn, {"p": payload})
+    conn.commit()
+    return r.lastrowid
+
+def max_hub_event_id(conn) -> int:
+    return int(Q.HUB_EVENT_MAX.scalar(conn) or 0)
+
+def fetch_hub_events(conn, after_id: int, limit: int = 500):
+    rows = Q.HUB_EVENTS_AFTER.execute(conn, {"after": after_id, "lim": limit}).all()
+    return [(int(r[0]), r[1]) for r in rows]
+
+def purge_hub_events(conn, older_than_sec: int) -> int:
+    r = Q.HUB_EVENTS_PURGE.run(conn, {"s": older_than_sec})
+    conn.commit()
+    return r.rowcount
+
+# ---------- Order events (feed admin, resume theo seq) ----------
+def insert_order_event(conn, payload: str) -> int:
+    r = Q.ORDER_EVENT_INSERT.run(conn, {"p": payload})
+    conn.commit()
+    return r.lastrowid
+
+def fetch_order_events(conn, since: int, limit: int = 500):
+    rows = Q.ORDER_EVENTS_SINCE.execute(conn, {"since": since, "lim": limit}).all()
+    return [(int(r[0]), r[1]) for r in rows]
+
+def order_events_bounds(conn) -> tuple[int, int]:
+    r = Q.ORDER_EVENTS_BOUNDS.execute(conn).first()
+    return int(r[0]), int(r[1])
+
+def purge_order_events(conn, older_than_sec: int) -> int:
+    r = Q.ORDER_EVENTS_PURGE.run(conn, {"s": older_than_sec})
+    conn.commit()
+    return r.rowcount
@@ -1,16 +1,144 @@
 # app/index_books.py
-from sqlalchemy import text                 # <-- THÊM DÒNG NÀY
+"""
+Index sách vào Chroma.
+
+    python -m app.index_books                  # full (tự resume nếu lần trước crash)
+    python -m app.index_books --incremental    # chỉ embed lại sách có nội dung đổi (so hash)
+    python -m app.index_books --restart        # bỏ checkpoint cũ, chạy lại từ đầu
+    python -m app.index_books --prune          # xoá khỏi Chroma các id không còn trong DB
+
+- Đọc Books theo keyset (book_id > :after) từng trang, mỗi trang stream bằng server-side cursor.
+- Embed theo lô trên pool thread; upsert Chroma theo lô ở thread chính (đúng thứ tự).
+- Checkpoint (book_id cuối cùng đã upsert xong) ghi sau mỗi lô → crash thì chạy lại là tiếp tục.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+from sqlalchemy import text
+from .config import settings
 from .db import db_conn
-from .services.rag import retriever
+from .services.rag import retriever, book_doc, doc_hash
+
+CHECKPOINT = Path(settings.chroma_dir or ".chroma") / "index_checkpoint.json"
+
+
+# ---------- checkpoint ----------
+def _load_checkpoint(mode: str) -> int:
+    try:
+        cp = json.loads(CHECKPOINT.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return 0
+    return int(cp.get("last_id") or 0) if cp.get("mode") == mode else 0
+
+def _save_checkpoint(mode: str, last_id: int) -> None:
+    CHECKPOINT.parent.mkdir(parents=True, exist_ok=True)
+    tmp = CHECKPOINT.with_suffix(".tmp")
+    tmp.write_text(json.dumps({"mode": mode, "last_id": last_id, "ts": int(time.time())}), encoding="utf-8")
+    os.replace(tmp, CHECKPOINT)   # ghi atomic
+
+def _clear_checkpoint() -> None:
+    try:
+        CHECKPOINT.unlink()
+    except FileNotFoundError:
+        pass
+
+
+# ---------- đọc DB ----------
+def iter_book_batches(after_id: int, page_size: int, batch_size: int) -> Iterator[List[Dict]]:
+    """Keyset pagination theo book_id; mỗi trang đọc bằng server-side cursor, cắt thành lô."""
+    stmt = text("""
+      SELECT book_id, title, author, price, stock, category
+      FROM Books WHERE book_id > :after ORDER BY book_id LIMIT :lim
+    """)
+    while True:
+        n = 0
+        with db_conn() as conn:
+            res = conn.execution_options(stream_results=True).execute(stmt, {"after": after_id, "lim": page_size})
+            for part in res.mappings().partitions(batch_size):
+                batch = [dict(r) for r in part]
+                n += len(batch)
+                after_id = batch[-1]["book_id"]
+                yield batch
+        if n < page_size:
+            return
+
+def _changed_only(batch: List[Dict]) -> List[Dict]:
+    """Lọc các sách có nội dung khác hash đã lưu trong metadata Chroma."""
+    got = retriever.collection.get(ids=[str(b["book_id"]) for b in batch], include=["metadatas"])
+    old = {i: (m or {}).get("hash") for i, m in zip(got.get("ids") or [], got.get("metadatas") or [])}
+    return [b for b in batch if old.get(str(b["book_id"])) != doc_hash(book_doc(b))]
+
+
+# ---------- main ----------
+def run(incremental: bool = False, restart: bool = False, prune: bool = False,
+        page_size: int = 5000, batch_size: int = 256, workers: int = 4) -> dict:
+    mode = "incremental" if incremental else "full"
+    if restart:
+        _clear_checkpoint()
+    start_id = _load_checkpoint(mode)
+    if start_id:
+        print(f"Resume {mode} index từ book_id > {start_id}")
+
+    stats = {"scanned": 0, "embedded": 0, "skipped": 0}
+    seen: set[str] = set()
+    pending: deque[tuple[Future, List[Dict], int]] = deque()
+    t0 = time.perf_counter()
+
+    def _drain(block: bool) -> None:
+        # upsert theo đúng thứ tự lô để checkpoint luôn là tiền tố đã xong
+        while pending and (block or pending[0][0].done()):
+            fut, batch, last_id = pending.popleft()
+            embeddings = fut.result()
+            if batch:
+                retriever.upsert_books(batch, embeddings)
+            _save_checkpoint(mode, last_id)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+        for batch in iter_book_batches(start_id, page_size, batch_size):
+            stats["scanned"] += len(batch)
+            last_id = batch[-1]["book_id"]
+            if prune:
+                seen.update(str(b["book_id"]) for b in batch)
+            todo = _changed_only(batch) if incremental else batch
+            stats["embedded"] += len(todo)
+            stats["skipped"] += len(batch) - len(todo)
+            fut = ex.submit(retriever.embed_fn.embed_documents, [book_doc(b) for b in todo])
+            pending.append((fut, todo, last_id))
+            _drain(block=len(pending) >= workers * 2)   # giới hạn số lô đang chờ (backpressure)
+        _drain(block=True)
+
+    if prune and not start_id:
+        all_ids = set(retriever.collection.get(include=[]).get("ids") or [])
+        stale = sorted(all_ids - seen)
+        if stale:
+            retriever.collection.delete(ids=stale)
+        stats["pruned"] = len(stale)
+
+    _clear_checkpoint()
+    stats["seconds"] = round(time.perf_counter() - t0, 1)
+    return stats
 
 def main():
-    with db_conn() as conn:
-        rows = conn.execute(                # <-- DÙNG text(...)
-            text("SELECT book_id, title, author, price, stock, category FROM Books")
-        ).mappings().all()
-        for r in rows:
-            retriever.upsert_book(dict(r))
-    print(f"Indexed {len(rows)} books into Chroma.")
+    ap = argparse.ArgumentParser(description="Index Books vào Chroma")
+    ap.add_argument("--incremental", action="store_true", help="chỉ embed lại sách có nội dung thay đổi")
+    ap.add_argument("--restart", action="store_true", help="bỏ checkpoint, chạy lại từ đầu")
+    ap.add_argument("--prune", action="store_true", help="xoá vector của sách không còn trong DB")
+    ap.add_argument("--page-size", type=int, default=5000, help="số dòng / trang keyset")
+    ap.add_argument("--batch-size", type=int, default=settings.embed_batch_size, help="số sách / lô embed+upsert")
+    ap.add_argument("--workers", type=int, default=settings.embed_concurrency, help="số lô embed song song")
+    a = ap.parse_args()
+    stats = run(incremental=a.incremental, restart=a.restart, prune=a.prune,
+                page_size=a.page_size, batch_size=a.batch_size, workers=a.workers)
+    print(f"Indexed {stats['embedded']} books into Chroma "
+          f"(scanned {stats['scanned']}, unchanged {stats['skipped']}, {stats['seconds']}s).")
 
 if __name__ == "__main__":
     main()
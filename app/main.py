@@ -1,12 +1,19 @@
 from __future__ import annotations
 
 import re
+import json
+import base64
+import hashlib
+import asyncio
 import unicodedata
 import uuid
+import logging
 import anyio
+from contextlib import asynccontextmanager
+from functools import partial
 
 from fastapi import FastAPI, Request, Response, WebSocket, WebSocketDisconnect, Body
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from starlette.middleware.sessions import SessionMiddleware
@@ -15,24 +22,78 @@ from .services.agent import run_agent
 from .config import settings
 from .schemas import ChatIn, AdminLogin
 from .db import (
-    db_conn,
+    db_conn, arun, async_engine, pool_stats,
     # Books
-    list_books, get_book_by_id, create_book, update_book, delete_book,
+    page_books, BOOK_SORTS, get_book_by_id, create_book, update_book, delete_book,
     # Orders
-    create_order, list_orders_by_status, approve_order, cancel_order, get_order_session,
+    create_order, page_orders, count_orders_by_status, approve_order, cancel_order, get_order_detail,
+    order_events_bounds,
     # Chat history / sessions
-    insert_chat, get_chat_history, ensure_chat_session, list_chat_sessions,
+    get_chat_history, iter_chat_history, ensure_chat_session, list_chat_sessions,
 )
-from .services.state import get_session, reset_session
+from .services.state import get_session, aget_session, reset_session, sessions
 from .services.rag import retriever
-from .services.llm import classify_intent, extract_order_entities, QTY_RE, PHONE_RE
+from .services.catalog import catalog
+from .services.chatlog import chatlog
+from .services.order_feed import order_feed
+from .services.llm import classify_intent, extract_order_entities, nlu_stats, QTY_RE, PHONE_RE
+from .services.llm_json import llm_stats, json_stats, aclose_backends, response_cache, llm_flight
+from .services.llm_sched import scheduler as llm_scheduler
 from .ws import hub
 
 
 # -----------------------------------------------------------------------------
 # App & assets
 # -----------------------------------------------------------------------------
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+
+async def _catalog_refresher():
+    """Giữ snapshot Books trong RAM khớp DB (bắt thay đổi từ worker/process khác)."""
+    while True:
+        await asyncio.sleep(settings.catalog_refresh_sec)
+        try:
+            await anyio.to_thread.run_sync(catalog.refresh)
+        except Exception:
+            logger.exception("catalog refresh failed")
+
+
+async def _on_catalog_event(message: dict):
+    # worker khác vừa ghi Books: refresh ngay (không chờ chu kỳ) → snapshot + cache tìm kiếm khớp DB
+    await anyio.to_thread.run_sync(catalog.refresh)
+
+
+def _announce_catalog_change(**info) -> None:
+    """Gọi từ endpoint sync sau khi ghi Books."""
+    anyio.from_thread.run(hub.publish_catalog, info)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    try:
+        n = await anyio.to_thread.run_sync(catalog.load)
+        logger.info("catalog snapshot: %d books", n)
+    except Exception:
+        # DB chưa sẵn sàng: đường chat tạm đọc thẳng DB, refresher sẽ nạp lại sau
+        logger.exception("catalog snapshot load failed")
+    refresher = asyncio.create_task(_catalog_refresher())
+    hub.on_catalog = _on_catalog_event
+    try:
+        await hub.start()
+    except Exception:
+        logger.exception("hub backplane start failed (chỉ giao WebSocket trong worker này)")
+    yield
+    refresher.cancel()
+    await hub.stop()
+    await anyio.to_thread.run_sync(sessions.close)   # ghi nốt session đang chờ
+    await anyio.to_thread.run_sync(chatlog.close)    # ghi nốt tin nhắn trong buffer
+    # đóng pool HTTP async (LLM, embedding) & pool DB async
+    await aclose_backends()
+    await retriever.aclose()
+    await async_engine.dispose()
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(SessionMiddleware, secret_key=settings.secret_key)
 templates = Jinja2Templates(directory="templates")
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -41,14 +102,16 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 # -----------------------------------------------------------------------------
 # Helpers
 # -----------------------------------------------------------------------------
-def get_or_create_session_id(request: Request) -> str:
-    """Lấy session_id từ cookie; nếu chưa có thì tạo mới & đảm bảo có bản ghi ChatSessions."""
+def get_or_create_session_id(request: Request, ensure: bool = True) -> str:
+    """Lấy session_id từ cookie; nếu chưa có thì tạo mới & đảm bảo có bản ghi ChatSessions.
+    ensure=False: bỏ qua ghi DB (caller tự ensure, vd. endpoint async)."""
     sid = request.session.get("session_id")
     if not sid:
         sid = uuid.uuid4().hex[:24]
         request.session["session_id"] = sid
-        with db_conn() as conn:
-            ensure_chat_session(conn, sid)
+        if ensure:
+            with db_conn() as conn:
+                ensure_chat_session(conn, sid)
     return sid
 
 
@@ -112,36 +175,161 @@ def home(request: Request):
 # -----------------------------------------------------------------------------
 # Chat APIs
 # -----------------------------------------------------------------------------
-@app.get("/api/chat/history")
-def chat_history(session_id: str):
+def _fmt_time(it: dict) -> dict:
+    if hasattr(it.get("created_at"), "isoformat"):
+        it["created_at"] = it["created_at"].isoformat(sep=" ", timespec="seconds")
+    return it
+
+
+def _pending_tail(items: list, pending: list) -> list:
+    """
+    Tin còn trong buffer ghi của chatlog (chưa có id) để hiển thị sau các dòng đã commit.
+    pending lấy trước khi đọc DB: lô có thể vừa commit giữa 2 lần đọc → bỏ phần đã có trong items.
+    """
+    tail = [{"role": it["role"], "content": it["content"]} for it in items[-len(pending):]] if pending else []
+    overlap = next((k for k in range(min(len(pending), len(tail)), 0, -1)
+                    if tail[-k:] == pending[:k]), 0)
+    return pending[overlap:]
+
+
+def _history_stream(session_id: str, after_id: int, limit: int, extra: dict):
+    """JSON cùng dạng với trang thường nhưng ghi dần theo lô đọc từ server-side cursor."""
+    head = json.dumps({**extra, "session_id": session_id}, ensure_ascii=False)[:-1]
+    yield head + ',"messages":['
+    pending = chatlog.pending(session_id)
+    last_id, n, has_more, tail = after_id, 0, False, []
+    with db_conn() as conn:
+        for part in iter_chat_history(conn, session_id, after_id=after_id, limit=limit + 1):
+            if len(part) > limit - n:
+                part, has_more = part[:limit - n], True   # dòng thừa chỉ để biết còn tin
+            if part:
+                yield ("," if n else "") + ",".join(json.dumps(_fmt_time(it), ensure_ascii=False) for it in part)
+                n += len(part)
+                last_id = part[-1]["id"]
+                tail = (tail + part)[-len(pending):] if pending else []
+            if has_more:
+                break
+    pending = [] if has_more else _pending_tail(tail, pending)
+    yield (f'],"last_id":{last_id},"has_more":{json.dumps(has_more)},'
+           f'"pending":{json.dumps(pending, ensure_ascii=False)}}}')
+
+
+def _history_page(session_id: str, before_id: int | None, after_id: int | None,
+                  limit: int | None, extra: dict | None = None):
+    """
+    Lịch sử chat phân trang keyset:
+    - mặc định: trang mới nhất; before_id=<id nhỏ nhất đang có> để tải trang cũ hơn
+    - after_id=<id lớn nhất đang có>: chỉ lấy tin mới (after_id=0 là cả phiên, stream nếu lớn)
+    Tin chưa commit (buffer của chatlog) trả riêng ở "pending" – không có id, client không lưu vào cache;
+    không flush ở đây để đọc lịch sử không phá batching của writer.
+    """
+    extra = extra or {}
+    limit = limit or settings.chat_history_page
+    if after_id is not None and limit > settings.chat_history_max_page:
+        return StreamingResponse(_history_stream(session_id, after_id, limit, extra),
+                                 media_type="application/json")
+    limit = max(1, min(limit, settings.chat_history_max_page))
+    # chỉ trang ở mép mới nhất mới nối tin đang chờ ghi
+    pending = chatlog.pending(session_id) if before_id is None else []
     with db_conn() as conn:
-        items = get_chat_history(conn, session_id, limit=1000)
-    # không sửa dữ liệu; client render trực tiếp
-    return {"session_id": session_id, "messages": items}
+        items = get_chat_history(conn, session_id, limit=limit + 1, before_id=before_id, after_id=after_id)
+    has_more = len(items) > limit
+    if has_more:
+        # thừa 1 dòng ở phía "xa" của con trỏ
+        items = items[:limit] if after_id is not None else items[1:]
+    if has_more and after_id is not None:
+        pending = []
+    return {
+        **extra, "session_id": session_id, "messages": [_fmt_time(it) for it in items],
+        "first_id": items[0]["id"] if items else before_id,
+        "last_id": items[-1]["id"] if items else after_id,
+        "has_more": has_more,
+        "pending": _pending_tail(items, pending),
+    }
+
+
+@app.get("/api/chat/history")
+def chat_history(session_id: str, before_id: int | None = None, after_id: int | None = None,
+                 limit: int | None = None):
+    return _history_page(session_id, before_id, after_id, limit)
 
 
 def _reply_and_log(sid: str, reply: str, state: str, data: dict | None = None):
-    with db_conn() as conn:
-        insert_chat(conn, sid, "assistant", reply)
+    chatlog.log(sid, "assistant", reply)
     return {"session_id": sid, "reply": reply, "state": state, "data": data}
 
 
 @app.post("/api/chat")
-def chat_api(payload: ChatIn, request: Request):
-    sid = payload.session_id or get_or_create_session_id(request)
+async def chat_api(payload: ChatIn, request: Request):
+    sid = payload.session_id or get_or_create_session_id(request, ensure=False)
     text_in = (payload.message or "").strip()
 
-    with db_conn() as conn:
-        ensure_chat_session(conn, sid)
-        insert_chat(conn, sid, "user", text_in)
+    chatlog.log(sid, "user", text_in)     # ChatSessions được ensure trong cùng lô ghi
 
-    reply = run_agent(text_in, sid)
+    reply = await run_agent(text_in, sid)
 
-    with db_conn() as conn:
-        insert_chat(conn, sid, "assistant", reply)
+    chatlog.log(sid, "assistant", reply)
 
     # tuỳ thích gửi thêm {state} để UI biết
-    return {"session_id": sid, "reply": reply, "state": get_session(sid)}
+    return {"session_id": sid, "reply": reply, "state": (await aget_session(sid)).to_dict()}
+
+
+_BG_TASKS: set[asyncio.Task] = set()  # giữ tham chiếu task nền (tránh bị GC giữa chừng)
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+@app.post("/api/chat/stream")
+async def chat_stream_api(payload: ChatIn, request: Request):
+    """
+    Như /api/chat nhưng trả Server-Sent Events:
+    - event 'delta' {text}: từng mẩu câu trả lời (khi đi qua Responder)
+    - event 'done' {session_id, reply, state}: câu trả lời cuối (client thay bubble tạm)
+    - event 'error' {message}
+    """
+    sid = payload.session_id or get_or_create_session_id(request, ensure=False)
+    text_in = (payload.message or "").strip()
+
+    chatlog.log(sid, "user", text_in)
+
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def on_delta(piece: str):
+        await queue.put(("delta", {"text": piece}))
+
+    async def worker():
+        # chạy độc lập với kết nối: client ngắt giữa chừng vẫn ghi log câu trả lời
+        final = ("error", {"message": "Yêu cầu bị huỷ"})
+        try:
+            reply = await run_agent(text_in, sid, on_delta=on_delta)
+            chatlog.log(sid, "assistant", reply)
+            final = ("done", {"session_id": sid, "reply": reply, "state": (await aget_session(sid)).to_dict()})
+        except Exception:
+            # chi tiết lỗi (SQL, URL nội bộ...) chỉ ghi log server, client nhận câu cố định
+            logger.exception("chat stream failed (session %s)", sid)
+            final = ("error", {"message": "Có lỗi khi xử lý yêu cầu, bạn thử lại sau ít phút nhé!"})
+        finally:
+            # luôn có event kết thúc (kể cả CancelledError) → events() không treo ở queue.get()
+            queue.put_nowait(final)
+
+    async def events():
+        task = asyncio.create_task(worker())
+        _BG_TASKS.add(task)
+        task.add_done_callback(_BG_TASKS.discard)
+        while True:
+            ev, data = await queue.get()
+            yield _sse(ev, data)
+            if ev != "delta":
+                break
+        await asyncio.wait([task])   # không re-raise: lỗi/huỷ đã báo qua event cuối
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 # --- Reset session API (POST + GET cho tiện test) ---
@@ -190,23 +378,91 @@ def admin_login(request: Request, creds: AdminLogin):
 
 @app.get("/admin", response_class=HTMLResponse)
 def admin_dashboard(request: Request):
+    """Chỉ trả khung trang; các bảng được admin.js/book.js tải lười qua /admin/api/* khi mở tab."""
     if not request.session.get("is_admin"):
         return RedirectResponse("/admin/login", status_code=302)
+    return templates.TemplateResponse("admin.html", {"request": request})
+
+
+# --- Admin: danh sách phân trang (keyset) + ETag ---
+def _encode_cursor(value, row_id) -> str:
+    raw = json.dumps([value, row_id], default=str, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str | None) -> tuple | None:
+    if not cursor:
+        return None
+    try:
+        value, row_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return value, int(row_id)
+    except (ValueError, TypeError):
+        return None
+
+
+def _etag_json(request: Request, payload: dict) -> Response:
+    """JSON + ETag (hash nội dung); client gửi If-None-Match trùng → 304 không body."""
+    body = json.dumps(payload, ensure_ascii=False, default=str, separators=(",", ":")).encode()
+    tag = f'"{hashlib.sha1(body).hexdigest()[:20]}"'
+    headers = {"ETag": tag, "Cache-Control": "private, no-cache"}
+    sent = [t.strip().removeprefix("W/") for t in (request.headers.get("if-none-match") or "").split(",")]
+    if tag in sent:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+def _page_limit(limit: int | None) -> int:
+    return max(1, min(limit or settings.admin_page_size, 200))
+
+
+@app.get("/admin/api/orders")
+def admin_api_orders(request: Request, status: str = "pending", q: str | None = None,
+                     sort: str = "newest", cursor: str | None = None, limit: int | None = None):
+    if not request.session.get("is_admin"):
+        return JSONResponse({"ok": False, "message": "Unauthorized"}, status_code=401)
+    if status not in ("pending", "approved", "cancelled"):
+        return JSONResponse({"ok": False, "message": "status không hợp lệ"}, status_code=400)
+    lim = _page_limit(limit)
     with db_conn() as conn:
-        pending = list_orders_by_status(conn, "pending")
-        approved = list_orders_by_status(conn, "approved")
-        cancelled = list_orders_by_status(conn, "cancelled")
-        books = list_books(conn)
-    return templates.TemplateResponse(
-        "admin.html",
-        {
-            "request": request,
-            "pending": pending,
-            "approved": approved,
-            "cancelled": cancelled,
-            "books": books,
-        },
-    )
+        items = page_orders(conn, status, limit=lim + 1, desc=(sort != "oldest"),
+                            after=_decode_cursor(cursor), q=(q or "").strip() or None)
+    has_more = len(items) > lim
+    items = items[:lim]
+    last = items[-1] if items else None
+    return _etag_json(request, {
+        "ok": True, "items": items,
+        "next_cursor": _encode_cursor(last["created_at"], last["order_id"]) if has_more else None,
+    })
+
+
+@app.get("/admin/api/orders/counts")
+def admin_api_order_counts(request: Request):
+    if not request.session.get("is_admin"):
+        return JSONResponse({"ok": False, "message": "Unauthorized"}, status_code=401)
+    with db_conn() as conn:
+        counts = count_orders_by_status(conn)
+        seq = order_events_bounds(conn)[1]
+    # seq: client mở /ws/admin?since=seq → nhận mọi thay đổi sau thời điểm đọc số liệu này
+    return _etag_json(request, {"ok": True, "counts": counts, "seq": seq})
+
+
+@app.get("/admin/api/books")
+def admin_api_books(request: Request, q: str | None = None, sort: str = "id", order: str = "desc",
+                    cursor: str | None = None, limit: int | None = None):
+    if not request.session.get("is_admin"):
+        return JSONResponse({"ok": False, "message": "Unauthorized"}, status_code=401)
+    sort = sort if sort in BOOK_SORTS else "id"
+    lim = _page_limit(limit)
+    with db_conn() as conn:
+        items = page_books(conn, limit=lim + 1, sort=sort, desc=(order != "asc"),
+                           after=_decode_cursor(cursor), q=(q or "").strip() or None)
+    has_more = len(items) > lim
+    items = items[:lim]
+    last = items[-1] if items else None
+    return _etag_json(request, {
+        "ok": True, "items": items,
+        "next_cursor": _encode_cursor(last[BOOK_SORTS[sort]], last["book_id"]) if has_more else None,
+    })
 
 
 # --- Books CRUD (JSON) ---
@@ -217,7 +473,10 @@ def admin_create_book(request: Request, data: dict = Body(...)):
     with db_conn() as conn:
         bid = create_book(conn, data)
         b = get_book_by_id(conn, bid)
+    catalog.put(b)
     retriever.upsert_book(b)
+    retriever.invalidate_book(bid, content_changed=True)  # sách mới có thể khớp truy vấn đã cache
+    _announce_catalog_change(book_id=bid)
     return {"ok": True, "book_id": bid}
 
 
@@ -226,9 +485,15 @@ def admin_update_book(book_id: int, request: Request, data: dict = Body(...)):
     if not request.session.get("is_admin"):
         return JSONResponse({"ok": False, "message": "Unauthorized"}, status_code=401)
     with db_conn() as conn:
+        old = get_book_by_id(conn, book_id)
         update_book(conn, book_id, data)
         b = get_book_by_id(conn, book_id)
+    catalog.put(b)
     retriever.upsert_book(b)
+    # chỉ đổi giá/tồn → xoá entry chứa sách này; đổi tên/tác giả/thể loại → bỏ toàn bộ
+    content_changed = not old or any(old.get(k) != b.get(k) for k in ("title", "author", "category"))
+    retriever.invalidate_book(book_id, content_changed=content_changed)
+    _announce_catalog_change(book_id=book_id)
     return {"ok": True}
 
 
@@ -238,7 +503,9 @@ def admin_delete_book(book_id: int, request: Request):
         return JSONResponse({"ok": False, "message": "Unauthorized"}, status_code=401)
     with db_conn() as conn:
         delete_book(conn, book_id)
+    catalog.remove(book_id)
     retriever.delete_book(book_id)
+    _announce_catalog_change(book_id=book_id)
     return {"ok": True}
 
 
@@ -247,15 +514,25 @@ def admin_delete_book(book_id: int, request: Request):
 def admin_approve(order_id: int, request: Request):
     if not request.session.get("is_admin"):
         return JSONResponse({"ok": False, "message": "Unauthorized"}, status_code=401)
+    with db_conn() as conn:
+        order = get_order_detail(conn, order_id)     # trạng thái trước khi duyệt (cho feed admin)
     with db_conn() as conn:
         ok = approve_order(conn, order_id)
-        sid = get_order_session(conn, order_id)
+        book = get_book_by_id(conn, order["book_id"]) if ok and order else None
+    sid = order["session_id"] if order else None
     if ok:
+        catalog.put(book)                            # tồn kho vừa giảm
+        retriever.invalidate_book(order["book_id"])
+        _announce_catalog_change(book_id=order["book_id"])
         if sid:
             msg = f"Đơn #{order_id} đã được duyệt. Cảm ơn bạn!"
-            with db_conn() as conn2:
-                insert_chat(conn2, sid, "assistant", msg)
-            anyio.from_thread.run(hub.send_to_user, sid, {"type": "order_approved", "order_id": order_id})
+            chatlog.log(sid, "assistant", msg)
+            anyio.from_thread.run(hub.publish_user, sid, {"type": "order_approved", "order_id": order_id})
+        anyio.from_thread.run(partial(
+            order_feed.publish, "order_approved", order_id=order_id, from_status=order["status"],
+            order={**order, "status": "approved"},
+            book_id=order["book_id"], stock=book["stock"] if book else None, stock_delta=-order["quantity"],
+        ))
         return {"ok": True}
     return JSONResponse({"ok": False, "message": "Không đủ tồn hoặc đơn không hợp lệ"}, status_code=400)
 
@@ -265,14 +542,20 @@ def admin_cancel(order_id: int, request: Request):
     if not request.session.get("is_admin"):
         return JSONResponse({"ok": False, "message": "Unauthorized"}, status_code=401)
     with db_conn() as conn:
+        order = get_order_detail(conn, order_id)
         ok = cancel_order(conn, order_id)
-        sid = get_order_session(conn, order_id)
+    sid = order["session_id"] if order else None
     if ok:
         if sid:
             msg = f"Đơn #{order_id} đã bị hủy. Nếu cần, mình có thể gợi ý cuốn tương tự."
-            with db_conn() as conn2:
-                insert_chat(conn2, sid, "assistant", msg)
-            anyio.from_thread.run(hub.send_to_user, sid, {"type": "order_cancelled", "order_id": order_id})
+            chatlog.log(sid, "assistant", msg)
+            anyio.from_thread.run(hub.publish_user, sid, {"type": "order_cancelled", "order_id": order_id})
+        anyio.from_thread.run(partial(
+            order_feed.publish, "order_cancelled", order_id=order_id,
+            from_status=order["status"] if order else None,
+            order={**order, "status": "cancelled"} if order else None,
+            book_id=order["book_id"] if order else None, stock_delta=0,
+        ))
         return {"ok": True}
     return JSONResponse({"ok": False, "message": "Đơn không hợp lệ"}, status_code=400)
 
@@ -291,38 +574,79 @@ def admin_list_chats(request: Request, q: str | None = None, limit: int = 200):
 
 
 @app.get("/admin/api/chats/{session_id}")
-def admin_chat_history(request: Request, session_id: str, limit: int = 1000):
+def admin_chat_history(request: Request, session_id: str, before_id: int | None = None,
+                       after_id: int | None = None, limit: int | None = None):
     if not request.session.get("is_admin"):
         return JSONResponse({"ok": False, "message": "Unauthorized"}, status_code=401)
-    with db_conn() as conn:
-        items = get_chat_history(conn, session_id, limit=limit)
-    for it in items:
-        if it.get("created_at") is not None:
-            it["created_at"] = it["created_at"].isoformat(sep=" ", timespec="seconds")
-    return {"ok": True, "session_id": session_id, "messages": items}
+    return _history_page(session_id, before_id, after_id, limit, extra={"ok": True})
+
+
+# --- Admin: số liệu vận hành (latency LLM, ...) ---
+@app.get("/admin/api/metrics")
+def admin_metrics(request: Request):
+    if not request.session.get("is_admin"):
+        return JSONResponse({"ok": False, "message": "Unauthorized"}, status_code=401)
+    return {
+        "ok": True,
+        "llm": llm_stats(),
+        "nlu": nlu_stats(),
+        "llm_json": json_stats(),
+        "llm_cache": response_cache.stats(),
+        "llm_sched": llm_scheduler.stats(),
+        "singleflight": {"llm": llm_flight.stats(), "embed": retriever.embed_fn.flight.stats()},
+        "query_embed_cache": retriever.query_cache.stats(),
+        "search_cache": retriever.result_cache.stats(),
+        "search_legs": retriever.search_stats(),
+        "catalog": catalog.stats(),
+        "sessions": sessions.stats(),
+        "ws": hub.stats(),
+        "chatlog": chatlog.stats(),
+        "db": pool_stats(),
+    }
 
 
 # -----------------------------------------------------------------------------
 # WebSockets
 # -----------------------------------------------------------------------------
+@app.websocket("/ws/admin")
+async def ws_admin(ws: WebSocket, since: int | None = None):
+    """
+    Feed đơn hàng cho admin. since=<seq cuối client đã áp dụng> → bù các event đã lỡ trước khi nhận live;
+    không bù được thì gửi {'type': 'resync'} (client tải lại danh sách).
+    """
+    if not ws.session.get("is_admin"):
+        await ws.close(code=1008)
+        return
+    # đăng ký trước (gom event live), replay xong mới mở gửi → không hở event ở giữa
+    await hub.connect_admin(ws, paused=True)
+    try:
+        if since is None:
+            first = [{"type": "hello", "seq": await order_feed.latest_seq()}]
+        else:
+            events, latest = await order_feed.replay(since)
+            first = events + [{"type": "hello", "seq": latest}] if latest is not None else [{"type": "resync"}]
+    except Exception:
+        logger.exception("order feed replay failed")
+        first = [{"type": "resync"}]
+    await hub.resume_admin(ws, first)
+    try:
+        while True:
+            await ws.receive_text()
+    except WebSocketDisconnect:
+        await hub.disconnect_admin(ws)
+
+
 @app.websocket("/ws/{session_id}")
 async def ws_user(ws: WebSocket, session_id: str):
+    if session_id == "admin":
+        # id dành riêng cho feed admin (route /ws/admin khai báo trước) → không tạo session rác
+        await ws.close(code=1008)
+        return
     # đảm bảo có dòng session (tránh lỗi FK khi ghi chat sau đó)
-    with db_conn() as conn:
-        ensure_chat_session(conn, session_id)
+    await arun(ensure_chat_session, session_id)
     await hub.connect_user(session_id, ws)
     try:
         while True:
             await ws.receive_text()  # giữ kết nối
     except WebSocketDisconnect:
         await hub.disconnect_user(session_id, ws)
-
-
-@app.websocket("/ws/admin")
-async def ws_admin(ws: WebSocket):
-    await hub.connect_admin(ws)
-    try:
-        while True:
-            await ws.receive_text()
-    except WebSocketDisconnect:
-        await hub.disconnect_admin(ws)
@@ -1,17 +1,23 @@
 # app/services/agent.py
 from __future__ import annotations
-from typing import Any, Dict, List, Optional
+from typing import Any, Awaitable, Callable, Dict, List, Optional
 import re, unicodedata
 from pydantic import BaseModel, Field, ValidationError
-from sqlalchemy import text
 
 from ..config import settings
-from ..db import db_conn
-from .state import get_session
+from ..db import adb_conn
+from .. import sql as Q
+from .state import Session, aget_session, save_session
+from .catalog import catalog
+from .chatlog import chatlog
 from .agent_tools import REGISTRY
 from .agent_tools import CreateOrderIn  # dùng cho rule chốt đơn
-from .llm_json import complete_json
-from .llm import nlu_resolve_from_context, extract_order_entities
+from .llm_json import acomplete_json, acomplete_json_stream
+from .llm_sched import LLMOverloaded, llm_context
+from .llm import nlu_resolve, extract_order_entities
+
+OVERLOADED_REPLY = ("Hệ thống đang đông khách nên mình trả lời chậm. Bạn có thể gõ **id sách** hoặc "
+                    "**tên thể loại** để mình tìm nhanh, hoặc thử lại sau ít phút nhé!")
 
 # ================= Helpers =================
 
@@ -21,14 +27,18 @@ def _fmt_currency(v: int) -> str:
     except Exception:
         return str(v)
 
-def _recent_dialog(session_id: str, limit: int = 16) -> List[Dict[str, str]]:
-    """Lấy lịch sử chat gần đây (user/assistant) để LLM nắm ngữ cảnh."""
-    with db_conn() as conn:
-        rows = conn.execute(
-            text("SELECT role, content FROM ChatMessages WHERE session_id=:sid ORDER BY id DESC LIMIT :lim"),
-            {"sid": session_id, "lim": limit},
-        ).fetchall()
-    return [{"role": r[0], "content": r[1]} for r in reversed(rows)]
+async def _recent_dialog(session_id: str, limit: int = 16) -> List[Dict[str, str]]:
+    """Lấy lịch sử chat gần đây (user/assistant) để LLM nắm ngữ cảnh (gồm cả tin còn trong buffer ghi)."""
+    pending = chatlog.pending(session_id)
+    async with adb_conn() as conn:
+        rows = (await conn.execute(
+            Q.CHAT_RECENT_DIALOG.clause, {"sid": session_id, "lim": limit},
+        )).fetchall()
+    dialog = [{"role": r[0], "content": r[1]} for r in reversed(rows)]
+    # lô có thể vừa commit giữa 2 lần đọc → bỏ phần đã có trong DB
+    overlap = next((k for k in range(min(len(pending), len(dialog)), 0, -1)
+                    if dialog[-k:] == pending[:k]), 0)
+    return (dialog + pending[overlap:])[-limit:]
 
 def _render_books_list(items: List[Dict]) -> str:
     if not items:
@@ -41,20 +51,19 @@ def _render_books_list(items: List[Dict]) -> str:
     body = "\n".join(lines)
     return "Mình tìm thấy:\n" + body + "\nBạn muốn đặt cuốn nào? (nhập **id** hoặc **tên sách**)."
 
-def _book_by_id(book_id: int) -> Optional[Dict[str, Any]]:
-    with db_conn() as conn:
-        rows = conn.execute(
-            text("SELECT book_id, title, author, price, stock, category FROM Books WHERE book_id = :bid"),
-            {"bid": int(book_id)},
-        ).mappings().all()
+async def _book_by_id(book_id: int) -> Optional[Dict[str, Any]]:
+    if catalog.ready:
+        return catalog.get(int(book_id))
+    async with adb_conn() as conn:
+        rows = (await conn.execute(Q.BOOK_BY_ID.clause, {"id": int(book_id)})).mappings().all()
     return rows[0] if rows else None
 
-def _confirm_text(slots: Dict[str, Any]) -> Optional[str]:
+async def _confirm_text(slots: Dict[str, Any]) -> Optional[str]:
     """Tạo đoạn xác nhận đơn nếu đã đủ slot."""
     required = ["book_id", "quantity", "phone", "address", "customer_name"]
     if not all(slots.get(k) for k in required):
         return None
-    b = _book_by_id(int(slots["book_id"]))
+    b = await _book_by_id(int(slots["book_id"]))
     if not b:
         return None
     qty = int(slots["quantity"])
@@ -99,7 +108,10 @@ class RespondOut(BaseModel):
 
 # ================= Agent =================
 
-def run_agent(user_text: str, session_id: str, max_actions: int = 3) -> str:
+async def run_agent(
+    user_text: str, session_id: str, max_actions: int = 3,
+    on_delta: Optional[Callable[[str], Awaitable[None]]] = None,
+) -> str:
     """
     Agent 3 giai đoạn: NLU → (Shortcut) → Planner→Execute→Responder.
     - NLU theo ngữ cảnh điền slot trước (book_id/quantity/phone/address/name).
@@ -108,8 +120,25 @@ def run_agent(user_text: str, session_id: str, max_actions: int = 3) -> str:
     - Nếu đang chờ xác nhận và user 'OK' → tạo đơn.
     - Nếu thiếu → hỏi bù ngắn gọn.
     - Ambiguous → Planner→Execute→Responder.
+    on_delta: nếu có, câu 'say' của Responder được stream từng mẩu qua callback này.
     """
-    st = get_session(session_id)
+    st = await aget_session(session_id)
+    try:
+        # lượt chat: ưu tiên cao nhất ở hàng chờ LLM, xoay vòng công bằng theo session
+        with llm_context("interactive", session_id):
+            return await _run_turn(st, user_text, session_id, max_actions, on_delta)
+    except LLMOverloaded:
+        # chờ LLM quá deadline → trả lời rút gọn ngay thay vì để người dùng treo
+        return OVERLOADED_REPLY
+    finally:
+        # store dùng chung (MySQL/Redis): đánh dấu dirty, ghi theo lô ở nền
+        save_session(session_id, st)
+
+
+async def _run_turn(
+    st: Session, user_text: str, session_id: str, max_actions: int,
+    on_delta: Optional[Callable[[str], Awaitable[None]]],
+) -> str:
     tok = (user_text or "").strip().lower()
 
     # ===== RULE: chốt đơn khi đang chờ xác nhận =====
@@ -127,7 +156,7 @@ def run_agent(user_text: str, session_id: str, max_actions: int = 3) -> str:
             pass
         else:
             from .agent_tools import _create_order  # type: ignore
-            ob = _create_order(args, {"session_id": session_id, "state": st, "user_text": user_text})
+            ob = await _create_order(args, {"session_id": session_id, "state": st, "user_text": user_text})
             return f"Đã tạo đơn #{ob['order_id']} (chờ duyệt). Mình sẽ báo khi Admin duyệt/hủy."
 
     # ===== NLU: hiểu ngữ cảnh & lấp slot =====
@@ -138,9 +167,10 @@ def run_agent(user_text: str, session_id: str, max_actions: int = 3) -> str:
             st["slots"][k] = ents[k]
 
     last_hits = (st.get("cache") or {}).get("last_hits") or []
-    nlu = nlu_resolve_from_context(
+    # câu rõ ràng (SĐT, "2 quyển", "id 7", thể loại...) xử lý bằng luật; chỉ câu mơ hồ mới gọi LLM
+    nlu = await nlu_resolve(
         user_text=user_text,
-        recent_dialog=_recent_dialog(session_id),
+        recent_dialog=lambda: _recent_dialog(session_id),
         last_hits=last_hits,
         current_slots=st.get("slots") or {},
     )
@@ -157,12 +187,12 @@ def run_agent(user_text: str, session_id: str, max_actions: int = 3) -> str:
         if spec:
             args = spec.input_schema(query=nlu.get("query") or user_text, limit=5)
             ctx = {"session_id": session_id, "state": st, "user_text": user_text}
-            result = spec.func(args, ctx)
+            result = await spec.func(args, ctx)
             items = (result or {}).get("results") or []
             return _render_books_list(items)
 
     # 2) Nếu order đã đủ slot → hiển thị phiếu xác nhận (không auto tạo)
-    confirm = _confirm_text(st["slots"])
+    confirm = await _confirm_text(st["slots"])
     if confirm and st["state"] != "await_confirm":
         st["state"] = "await_confirm"
         return confirm
@@ -193,14 +223,15 @@ def run_agent(user_text: str, session_id: str, max_actions: int = 3) -> str:
         "Nếu đủ dữ liệu để đặt hàng, hãy đề xuất create_order. Nếu đang tìm sách, đề xuất search_books với truy vấn phù hợp. "
         "Nếu thiếu dữ liệu, hãy điền 'ask' (một câu hỏi ngắn). Trả về DUY NHẤT JSON theo schema."
     )
-    plan = complete_json(
+    plan = await acomplete_json(
         base_url=getattr(settings, "ollama_base_url", "http://localhost:11434"),
         model=getattr(settings, "planner_model", "qwen2.5:14b-instruct"),
         system=system_plan,
         user=user_text,
-        context={"state": st, "tools": tools_contract, "nlu": nlu},
+        context={"state": st.to_dict(), "tools": tools_contract, "nlu": nlu},
         schema_hint={"actions":"array[{tool,args}]", "ask?":"string"},
         schema_model=PlanOut,
+        cache="planner",
     )
 
     # Execute
@@ -217,7 +248,7 @@ def run_agent(user_text: str, session_id: str, max_actions: int = 3) -> str:
             observations.append({"tool": tool_name, "error": "args_invalid", "detail": e.errors()})
             continue
         ctx = {"session_id": session_id, "state": st, "user_text": user_text}
-        result = spec.func(args, ctx)
+        result = await spec.func(args, ctx)
         # Chuẩn hoá kết quả search cho Responder
         if tool_name == "search_books":
             result = {"items": (result or {}).get("results") or []}
@@ -234,15 +265,20 @@ def run_agent(user_text: str, session_id: str, max_actions: int = 3) -> str:
         "Tiêu đề – Tác giả | giá | tồn | id. Nếu đã đủ thông tin đặt hàng nhưng chưa xác nhận, "
         "hãy trình bày phiếu tóm tắt và mời người dùng gõ OK. Trả về JSON với field 'say'."
     )
-    respond = complete_json(
+    resp_kwargs = dict(
         base_url=getattr(settings, "ollama_base_url", "http://localhost:11434"),
         model=getattr(settings, "planner_model", "qwen2.5:14b-instruct"),
         system=system_resp,
         user="",
-        context={"state": st, "observations": observations},
+        context={"state": st.to_dict(), "observations": observations},
         schema_hint={"say":"string"},
         schema_model=RespondOut,
+        cache="responder",
     )
+    if on_delta is not None:
+        respond = await acomplete_json_stream(**resp_kwargs, on_delta=on_delta, field="say")
+    else:
+        respond = await acomplete_json(**resp_kwargs)
     say = respond.get("say") or "Mình đã ghi nhận nhé."
 
     # Safety: nếu Responder quên render list trong khi có search_books
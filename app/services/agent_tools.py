@@ -1,15 +1,20 @@
 # app/services/agent_tools.py
 from __future__ import annotations
-from typing import Callable, Dict, Any
+import logging
+from typing import Awaitable, Callable, Dict, Any
 from pydantic import BaseModel, Field
-from ..db import db_conn, create_order
+from ..db import adb_conn, arun, create_order, get_order_detail
+from .. import sql as Q
 from .rag import retriever
+from .order_feed import order_feed
+
+logger = logging.getLogger(__name__)
 
 class ToolSpec(BaseModel):
     name: str
     description: str
     input_schema: type[BaseModel]
-    func: Callable[[BaseModel, dict], dict]  # (args, ctx) -> observation
+    func: Callable[[BaseModel, dict], Awaitable[dict]]  # async (args, ctx) -> observation
 
 REGISTRY: Dict[str, ToolSpec] = {}
 def register(spec: ToolSpec): REGISTRY[spec.name] = spec
@@ -19,9 +24,9 @@ class SearchBooksIn(BaseModel):
     query: str = Field(..., description="Câu tìm kiếm (tên sách/tác giả/chủ đề)")
     limit: int = 5
 
-def _search_books(args: SearchBooksIn, ctx: dict) -> dict:
+async def _search_books(args: SearchBooksIn, ctx: dict) -> dict:
     q = (args.query or ctx.get("user_text") or "").strip()
-    results = retriever.search(q, limit=args.limit)
+    results = await retriever.search(q, limit=args.limit)
     return {"results": results}
 
 register(ToolSpec(
@@ -39,13 +44,18 @@ class CreateOrderIn(BaseModel):
     address: str
     customer_name: str
 
-def _create_order(args: CreateOrderIn, ctx: dict) -> dict:
+async def _create_order(args: CreateOrderIn, ctx: dict) -> dict:
     payload = args.model_dump()
     payload["session_id"] = ctx["session_id"]
-    with db_conn() as conn:
-        order_id = create_order(conn, payload)
+    order_id = await arun(create_order, payload)
     # cập nhật state để kênh chat biết đang chờ duyệt
     ctx["state"]["state"] = "await_admin_decision"
+    # báo admin ngay (feed /ws/admin); lỗi feed không làm hỏng việc tạo đơn
+    try:
+        order = await arun(get_order_detail, order_id)
+        await order_feed.publish("order_created", order_id=order_id, order=order)
+    except Exception:
+        logger.exception("order_created event failed")
     return {"order_id": order_id}
 
 register(ToolSpec(
@@ -59,12 +69,9 @@ register(ToolSpec(
 class LastOrderStatusIn(BaseModel):
     session_id: str
 
-def _last_order_status(args: LastOrderStatusIn, ctx: dict) -> dict:
-    with db_conn() as conn:
-        rows = conn.execute(
-            "SELECT order_id, status FROM Orders WHERE session_id=:sid ORDER BY order_id DESC LIMIT 1",
-            {"sid": args.session_id}
-        ).mappings().all()
+async def _last_order_status(args: LastOrderStatusIn, ctx: dict) -> dict:
+    async with adb_conn() as conn:
+        rows = (await conn.execute(Q.LAST_ORDER_OF_SESSION.clause, {"sid": args.session_id})).mappings().all()
     if not rows:
         return {"found": False}
     return {"found": True, "order_id": rows[0]["order_id"], "status": rows[0]["status"]}
@@ -0,0 +1,234 @@
+# app/services/cache.py
+from __future__ import annotations
+
+import asyncio
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Cache trong process: LRU giới hạn số phần tử + TTL từng phần tử. Thread-safe.
+    ttl <= 0 nghĩa là không hết hạn (chỉ bị đẩy ra theo LRU).
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 0.0):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = float(ttl)
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING or (item[0] and item[0] < now):
+                if item is not _MISSING:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else float(ttl)
+        exp = time.monotonic() + ttl if ttl > 0 else 0.0
+        with self._lock:
+            self._data[key] = (exp, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.pop(key, _MISSING)
+        return default if item is _MISSING else item[1]
+
+    def __contains__(self, key: Hashable) -> bool:
+        # không tính vào hits/misses, không đổi thứ tự LRU
+        item = self._data.get(key, _MISSING)
+        return item is not _MISSING and not (item[0] and item[0] < time.monotonic())
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data), "maxsize": self.maxsize,
+            "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+class SQLiteKV:
+    """
+    Tầng cache trên đĩa (sống qua restart): key TEXT → value BLOB + hạn dùng.
+    1 connection dùng chung, khoá bằng lock; WAL để ghi không chặn đọc.
+    """
+
+    def __init__(self, path: str, table: str = "kv"):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.table = table
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (k TEXT PRIMARY KEY, v BLOB NOT NULL, exp REAL NOT NULL)"
+        )
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._db.execute(f"SELECT v, exp FROM {self.table} WHERE k=?", (key,)).fetchone()
+        if not row:
+            return None
+        if row[1] and row[1] < time.time():
+            self.delete(key)
+            return None
+        return row[0]
+
+    def set(self, key: str, value: bytes, ttl: float = 0.0) -> None:
+        exp = time.time() + ttl if ttl > 0 else 0.0
+        with self._lock:
+            self._db.execute(
+                f"INSERT OR REPLACE INTO {self.table}(k, v, exp) VALUES (?,?,?)", (key, value, exp)
+            )
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._db.execute(f"DELETE FROM {self.table} WHERE k=?", (key,))
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            cur = self._db.execute(f"DELETE FROM {self.table} WHERE exp > 0 AND exp < ?", (time.time(),))
+        return cur.rowcount
+
+
+class _Flight:
+    __slots__ = ("done", "result", "exc")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.exc: Optional[BaseException] = None
+
+
+class _AFlight:
+    __slots__ = ("task", "waiters", "shared")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0        # số caller đang await task
+        self.shared = False     # đã có follower → mọi caller nhận bản sao (clone)
+
+
+class SingleFlight:
+    """
+    Gộp các lời gọi giống hệt đang chạy đồng thời: cùng khoá → chỉ 1 lời gọi upstream (leader),
+    các lời gọi đến sau (follower) chờ và nhận chung kết quả / exception.
+    - do(): bản sync (thread trong threadpool), ado(): bản async (cùng event loop).
+    - ado() chạy upstream thành task riêng, leader và follower cùng chờ qua shield: caller nào bị huỷ
+      (vd. deadline của chính nó) chỉ rời hàng chờ; task chỉ bị huỷ khi không còn ai chờ.
+    - Không cache: leader xong là khoá được xoá, lời gọi kế tiếp lại gọi upstream.
+    - clone: nếu có, follower nhận bản sao kết quả (vd copy.deepcopy cho dict caller có thể sửa).
+    """
+
+    def __init__(self, clone: Optional[Callable[[Any], Any]] = None):
+        self.clone = clone
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, _Flight] = {}
+        self._acalls: dict[Hashable, _AFlight] = {}
+        self.counters = {"calls": 0, "leaders": 0, "coalesced": 0, "errors": 0}
+
+    def _share(self, value: Any) -> Any:
+        return self.clone(value) if self.clone is not None else value
+
+    def do(self, key: Hashable, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        with self._lock:
+            self.counters["calls"] += 1
+            flight = self._calls.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._calls[key] = _Flight()
+                self.counters["leaders"] += 1
+            else:
+                self.counters["coalesced"] += 1
+        if not leader:
+            flight.done.wait()
+            if flight.exc is not None:
+                raise flight.exc
+            return self._share(flight.result)
+        try:
+            flight.result = fn(*args, **kwargs)
+            return flight.result
+        except BaseException as e:
+            flight.exc = e
+            with self._lock:
+                self.counters["errors"] += 1
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            flight.done.set()
+
+    async def ado(self, key: Hashable, fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        with self._lock:
+            self.counters["calls"] += 1
+            flight = self._acalls.get(key)
+            leader = flight is None or flight.task.done()
+            if leader:
+                task = asyncio.get_running_loop().create_task(fn(*args, **kwargs))
+                flight = self._acalls[key] = _AFlight(task)
+                task.add_done_callback(lambda t, f=flight: self._afinish(key, f))
+                self.counters["leaders"] += 1
+            else:
+                flight.shared = True
+                self.counters["coalesced"] += 1
+            flight.waiters += 1
+        cancelled = False
+        try:
+            result = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            with self._lock:
+                flight.waiters -= 1
+                orphan = cancelled and flight.waiters == 0 and not flight.task.done()
+                if orphan and self._acalls.get(key) is flight:
+                    del self._acalls[key]
+            if orphan:
+                flight.task.cancel()    # caller cuối cùng đã bỏ đi → không ai cần kết quả
+        return self._share(result) if flight.shared else result
+
+    def _afinish(self, key: Hashable, flight: _AFlight) -> None:
+        task = flight.task
+        with self._lock:
+            if self._acalls.get(key) is flight:
+                del self._acalls[key]
+            # exception() cũng đánh dấu đã đọc (không còn ai chờ thì khỏi cảnh báo)
+            if not task.cancelled() and task.exception() is not None:
+                self.counters["errors"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            c = dict(self.counters)
+            c["in_flight"] = len(self._calls) + len(self._acalls)
+        c["coalesce_rate"] = round(c["coalesced"] / c["calls"], 3) if c["calls"] else 0.0
+        return c
@@ -0,0 +1,224 @@
+# app/services/catalog.py
+from __future__ import annotations
+
+import math
+import re
+import sys
+import threading
+import unicodedata
+from array import array
+from typing import Callable, Dict, Iterable, List, Optional
+
+from sqlalchemy import text
+
+from ..db import db_conn
+
+_COLS = "book_id, title, author, price, stock, category"
+_COLUMNS = ("ids", "prices", "stock", "titles", "authors", "categories")
+
+# listener(book_ids, content_changed): book_ids None = nạp lại toàn bộ có thay đổi (không rõ sách nào);
+# content_changed = có sách mới / đổi tên, tác giả, thể loại (không chỉ giá/tồn)
+ChangeListener = Callable[[Optional[List[int]], bool], None]
+
+
+def fold(s: str) -> str:
+    """Bỏ dấu + lower (giống collation *_ai_ci của MySQL): 'Thiếu Nhi' → 'thieu nhi'."""
+    s = unicodedata.normalize("NFD", s or "").replace("đ", "d").replace("Đ", "D")
+    return "".join(ch for ch in s if unicodedata.category(ch) != "Mn").lower()
+
+
+def _tokens(s: str) -> List[str]:
+    return [t for t in re.split(r"[^a-z0-9]+", fold(s)) if len(t) >= 2]
+
+
+class CatalogSnapshot:
+    """
+    Bản chụp bảng Books trong RAM, dạng cột:
+    - ids / prices / stock: array('q') (mỗi dòng 8 byte, không có object Python)
+    - titles / authors / categories: list chuỗi đã intern (thể loại lặp lại dùng chung 1 object)
+    - _pos: book_id → chỉ số dòng; dòng bị xoá để id = 0 (tombstone), dọn khi load lại toàn bộ
+    - _index: token (bỏ dấu) của title/author → các dòng, thay cho FULLTEXT trên đường chat
+    Nạp lúc khởi động, refresh tăng dần theo Books.updated_at, admin CRUD đẩy thay đổi vào ngay.
+    Thay đổi thấy được lúc refresh/load (vd. do worker khác ghi) được báo cho listener (subscribe) –
+    cache tìm kiếm dựa vào đó để không phục vụ giá/tồn cũ trên worker khác.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.ready = False
+        self.incremental = True     # False nếu DB chưa có cột updated_at → refresh = nạp lại toàn bộ
+        self._since = None          # max(updated_at) đã thấy
+        self._listeners: List[ChangeListener] = []
+        self._reset()
+
+    def subscribe(self, fn: ChangeListener) -> None:
+        self._listeners.append(fn)
+
+    def _notify(self, book_ids: Optional[List[int]], content_changed: bool = True) -> None:
+        for fn in self._listeners:
+            fn(book_ids, content_changed)
+
+    def _reset(self) -> None:
+        self.ids = array("q")
+        self.prices = array("q")
+        self.stock = array("q")
+        self.titles: List[str] = []
+        self.authors: List[str] = []
+        self.categories: List[str] = []
+        self._pos: Dict[int, int] = {}
+        self._index: Dict[str, set] = {}
+        self._cat_rows: Dict[str, set] = {}
+
+    # ---------- nạp / refresh ----------
+    def load(self) -> int:
+        """Nạp lại toàn bộ (dựng cấu trúc mới rồi tráo, không chặn người đọc lâu)."""
+        with db_conn() as conn:
+            try:
+                rows = conn.execute(text(f"SELECT {_COLS}, updated_at FROM Books ORDER BY book_id")).mappings().all()
+                self.incremental = True
+            except Exception:
+                conn.rollback()
+                rows = conn.execute(text(f"SELECT {_COLS} FROM Books ORDER BY book_id")).mappings().all()
+                self.incremental = False
+        fresh = CatalogSnapshot.__new__(CatalogSnapshot)
+        fresh._reset()
+        for r in rows:
+            fresh._append(r)
+        with self._lock:
+            changed = self.ready and any(getattr(self, n) != getattr(fresh, n) for n in _COLUMNS)
+            for name in (*_COLUMNS, "_pos", "_index", "_cat_rows"):
+                setattr(self, name, getattr(fresh, name))
+            self._since = max((r["updated_at"] for r in rows if r.get("updated_at")), default=None)
+            self.ready = True
+        if changed:
+            self._notify(None)
+        return len(rows)
+
+    def refresh(self) -> int:
+        """Áp các dòng đổi từ lần trước; phát hiện xoá qua COUNT(*) → khi lệch thì nạp lại toàn bộ."""
+        if not self.ready or not self.incremental or self._since is None:
+            return self.load()
+        with db_conn() as conn:
+            rows = conn.execute(
+                text(f"SELECT {_COLS}, updated_at FROM Books WHERE updated_at >= :since"),
+                {"since": self._since},
+            ).mappings().all()
+            total = conn.execute(text("SELECT COUNT(*) FROM Books")).scalar()
+        kinds = {int(r["book_id"]): self.put(r) for r in rows}
+        changed = [bid for bid, kind in kinds.items() if kind]
+        if changed:
+            self._notify(changed, content_changed="content" in kinds.values())
+        with self._lock:
+            if rows:
+                self._since = max([self._since] + [r["updated_at"] for r in rows if r.get("updated_at")])
+            drifted = total != len(self._pos)
+        return self.load() if drifted else len(rows)
+
+    # ---------- ghi (admin đẩy vào) ----------
+    def _append(self, b) -> None:
+        i = len(self.ids)
+        self.ids.append(int(b["book_id"]))
+        self.prices.append(int(b["price"]))
+        self.stock.append(int(b["stock"]))
+        self.titles.append(sys.intern(b["title"]))
+        self.authors.append(sys.intern(b["author"]))
+        self.categories.append(sys.intern(b["category"] or ""))
+        self._pos[int(b["book_id"])] = i
+        self._link(i)
+
+    def _link(self, i: int) -> None:
+        for t in set(_tokens(f"{self.titles[i]} {self.authors[i]}")):
+            self._index.setdefault(t, set()).add(i)
+        self._cat_rows.setdefault(fold(self.categories[i]), set()).add(i)
+
+    def _unlink(self, i: int) -> None:
+        for t in set(_tokens(f"{self.titles[i]} {self.authors[i]}")):
+            rows = self._index.get(t)
+            if rows:
+                rows.discard(i)
+        rows = self._cat_rows.get(fold(self.categories[i]))
+        if rows:
+            rows.discard(i)
+
+    def put(self, b) -> Optional[str]:
+        """
+        Thêm/cập nhật 1 sách (dict có book_id, title, author, price, stock, category).
+        Trả None (không đổi) | 'stock' (chỉ giá/tồn) | 'content' (sách mới, đổi tên/tác giả/thể loại).
+        """
+        if not b:
+            return None
+        bid = int(b["book_id"])
+        with self._lock:
+            i = self._pos.get(bid)
+            if i is None:
+                self._append(b)
+                return "content"
+            content = (self.titles[i], self.authors[i], self.categories[i]) != (
+                b["title"], b["author"], b["category"] or "")
+            if not content and (self.prices[i], self.stock[i]) == (int(b["price"]), int(b["stock"])):
+                return None
+            self._unlink(i)
+            self.prices[i] = int(b["price"])
+            self.stock[i] = int(b["stock"])
+            self.titles[i] = sys.intern(b["title"])
+            self.authors[i] = sys.intern(b["author"])
+            self.categories[i] = sys.intern(b["category"] or "")
+            self._link(i)
+            return "content" if content else "stock"
+
+    def remove(self, book_id: int) -> None:
+        with self._lock:
+            i = self._pos.pop(int(book_id), None)
+            if i is not None:
+                self._unlink(i)
+                self.ids[i] = 0
+
+    # ---------- đọc (đường chat) ----------
+    def _row(self, i: int) -> Dict:
+        return {
+            "book_id": self.ids[i], "title": self.titles[i], "author": self.authors[i],
+            "price": self.prices[i], "stock": self.stock[i], "category": self.categories[i],
+        }
+
+    def get(self, book_id: int) -> Optional[Dict]:
+        with self._lock:
+            i = self._pos.get(int(book_id))
+            return self._row(i) if i is not None else None
+
+    def get_many(self, ids: Iterable[int]) -> List[Dict]:
+        with self._lock:
+            return [self._row(i) for i in (self._pos.get(int(b)) for b in ids) if i is not None]
+
+    def by_category(self, category: str, limit: int = 10) -> List[Dict]:
+        """Như fetch_books_by_category: category LIKE %x% (không phân biệt hoa/dấu), stock DESC, id DESC."""
+        pat = fold(category)
+        with self._lock:
+            rows = [i for cat, rs in self._cat_rows.items() if pat in cat for i in rs]
+            rows.sort(key=lambda i: (self.stock[i], self.ids[i]), reverse=True)
+            return [self._row(i) for i in rows[:limit]]
+
+    def keyword_search(self, q: str, limit: int = 10) -> List[Dict]:
+        """Thay FULLTEXT(title, author): cộng IDF các token khớp, trả kèm 'score'."""
+        with self._lock:
+            n = max(1, len(self._pos))
+            scores: Dict[int, float] = {}
+            for t in set(_tokens(q)):
+                rows = self._index.get(t)
+                if not rows:
+                    continue
+                idf = math.log(1.0 + n / len(rows))
+                for i in rows:
+                    scores[i] = scores.get(i, 0.0) + idf
+            top = sorted(scores.items(), key=lambda kv: (kv[1], self.ids[kv[0]]), reverse=True)[:limit]
+            return [{**self._row(i), "score": round(s, 4)} for i, s in top]
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready, "incremental": self.incremental, "books": len(self._pos),
+            "rows": len(self.ids), "tokens": len(self._index), "categories": len(self._cat_rows),
+            "since": str(self._since) if self._since else None,
+        }
+
+
+# singleton
+catalog = CatalogSnapshot()
@@ -0,0 +1,165 @@
+# app/services/chatlog.py
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from typing import Dict, List
+
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError, TimeoutError as PoolTimeout
+
+from ..config import settings
+from ..db import db_conn, insert_chats
+
+logger = logging.getLogger(__name__)
+
+
+def _db_unavailable(e: Exception) -> bool:
+    """Lỗi kết nối/pool (thử lại cả lô sau) – khác lỗi do dữ liệu của 1 dòng (IntegrityError, DataError...)."""
+    if isinstance(e, (OperationalError, InterfaceError, PoolTimeout)):
+        return True
+    return isinstance(e, DBAPIError) and e.connection_invalidated
+
+
+class ChatLogWriter:
+    """
+    Ghi ChatMessages kiểu write-behind:
+    - log(): chỉ đưa vào buffer (không mở kết nối DB trên đường request)
+    - thread nền group-commit cả lô (nhiều session) khi đủ `batch_size` hoặc sau `flush_interval` giây
+    - flush tuần tự (giữ đúng thứ tự id theo session)
+    - DB không kết nối được → trả lô về đầu buffer để thử lại; buffer có trần `max_buffer` (bỏ tin cũ nhất)
+    - lô lỗi vì dữ liệu → ghi lại từng dòng; dòng vẫn lỗi bị loại (log + đếm 'dead_letter'),
+      không chặn các tin sau
+    - close(): ghi hết buffer khi tắt app
+    """
+
+    def __init__(self, batch_size: int = 200, flush_interval: float = 0.05, max_buffer: int = 10000):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_buffer = max(self.batch_size, max_buffer)
+        self._buf: List[Dict] = []
+        self._inflight: List[Dict] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.counters = {"logged": 0, "written": 0, "commits": 0, "errors": 0, "max_batch": 0,
+                         "dead_letter": 0, "dropped": 0}
+
+    def log(self, session_id: str, role: str, content: str) -> None:
+        with self._lock:
+            self._buf.append({"sid": session_id, "role": role, "content": content})
+            self.counters["logged"] += 1
+            self._trim()
+            full = len(self._buf) >= self.batch_size
+        self._ensure_thread()
+        if full:
+            self._wake.set()
+
+    def pending(self, session_id: str) -> List[Dict[str, str]]:
+        """Tin của session chưa commit (kể cả lô đang ghi) – để đọc ngay sau khi log."""
+        with self._lock:
+            return [{"role": r["role"], "content": r["content"]}
+                    for r in (*self._inflight, *self._buf) if r["sid"] == session_id]
+
+    def _trim(self) -> None:
+        """Gọi khi đang giữ self._lock."""
+        over = len(self._buf) - self.max_buffer
+        if over > 0:
+            del self._buf[:over]
+            self.counters["dropped"] += over
+            logger.warning("chat log buffer full: dropped %d oldest messages", over)
+
+    def _requeue(self, rows: List[Dict]) -> None:
+        with self._lock:
+            self._buf[:0] = rows
+            self._inflight = []
+            self.counters["errors"] += 1
+            self._trim()
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                batch, self._buf = self._buf, []
+                self._inflight = batch
+            if not batch:
+                return 0
+            try:
+                with db_conn() as conn:
+                    insert_chats(conn, batch)
+                commits = 1
+            except Exception as e:
+                if _db_unavailable(e):
+                    self._requeue(batch)
+                    raise
+                logger.warning("chat log batch insert failed (%s), retrying row by row", e)
+                with self._lock:
+                    self.counters["errors"] += 1
+                written, commits = self._flush_rows(batch)
+                batch = batch[:written]
+            with self._lock:
+                self._inflight = []
+                st = self.counters
+                st["written"] += len(batch)
+                st["commits"] += commits
+                st["max_batch"] = max(st["max_batch"], len(batch))
+            return len(batch)
+
+    def _flush_rows(self, rows: List[Dict]) -> tuple[int, int]:
+        """Ghi từng dòng (mỗi dòng 1 transaction) → (số dòng ghi được, số commit). Dòng lỗi dữ liệu bị loại."""
+        written = 0
+        for i, row in enumerate(rows):
+            try:
+                with db_conn() as conn:
+                    insert_chats(conn, [row])
+                written += 1
+            except Exception as e:
+                if _db_unavailable(e):
+                    with self._lock:
+                        self.counters["written"] += written
+                        self.counters["commits"] += written
+                    self._requeue(rows[i:])
+                    raise
+                with self._lock:
+                    self.counters["dead_letter"] += 1
+                logger.error("chat log: dropping message that cannot be stored (sid=%s role=%s len=%d): %s",
+                             row.get("sid"), row.get("role"), len(row.get("content") or ""), e)
+        return written, written
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name="chatlog-writer", daemon=True)
+                    self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("chat log flush failed")
+                time.sleep(min(1.0, self.flush_interval * 10))   # DB lỗi: lùi lại chút rồi thử tiếp
+
+    def close(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("chat log flush on shutdown failed (%d messages lost)", len(self._buf))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self.counters, "buffered": len(self._buf) + len(self._inflight)}
+
+
+# singleton
+chatlog = ChatLogWriter(batch_size=settings.chatlog_batch_size,
+                        flush_interval=settings.chatlog_flush_ms / 1000.0,
+                        max_buffer=settings.chatlog_max_buffer)
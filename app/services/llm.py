@@ -1,10 +1,11 @@
 from __future__ import annotations
 
-import os, re, json, httpx, unicodedata
+import os, re, json, httpx, threading, time, unicodedata
 from ..config import settings
-from typing import Optional, List, Dict, Any
+from typing import Any, Awaitable, Callable, Dict, List, Optional
 from pydantic import BaseModel, Field
-from .llm_json import complete_json
+from .llm_json import acomplete_json
+from .llm_sched import LLMOverloaded
 
 ORDER_WORDS = [r"mua", r"đặt", r"mình lấy", r"order", r"mua giúp"]
 CATALOG_WORDS = [r"giá", r"còn không", r"tác giả", r"thể loại", r"tồn", r"bao nhiêu"]
@@ -110,7 +111,7 @@ class NLUOut(BaseModel):
     customer_name: Optional[str] = None
     ask: Optional[str] = None        # nếu còn thiếu, đề xuất câu hỏi ngắn
 
-def nlu_resolve_from_context(
+async def nlu_resolve_from_context(
     user_text: str,
     recent_dialog: List[Dict[str, str]],
     last_hits: List[Dict[str, Any]],
@@ -143,7 +144,7 @@ def nlu_resolve_from_context(
         "customer_name?": "string",
         "ask?": "string"
     }
-    out = complete_json(
+    out = await acomplete_json(
         base_url=getattr(settings, "ollama_base_url", "http://localhost:11434"),
         model=getattr(settings, "planner_model", "qwen2.5:14b-instruct"),
         system=system,
@@ -151,5 +152,236 @@ def nlu_resolve_from_context(
         context=context,
         schema_hint=schema_hint,
         schema_model=NLUOut,
+        cache="nlu",
     )
-    return out
\ No newline at end of file
+    return out
+
+# ================= NLU nhiều tầng: luật/từ điển trước, LLM khi chưa chắc =================
+
+def _norm(s: str) -> str:
+    return _strip_diacritics(s).replace("đ", "d")
+
+_GREETINGS = {"xin chao", "chao", "chao ban", "chao shop", "hi", "hello", "alo", "cam on", "cam on ban",
+              "cam on shop", "thanks", "thank you", "tks"}
+_STATUS_WORDS = ["trang thai don", "tinh trang don", "don cua toi", "don cua minh", "kiem tra don",
+                 "don hang cua", "don da duyet", "don duoc duyet"]
+_SEARCH_WORDS = ["tim sach", "tim cuon", "co sach", "co cuon", "goi y", "gioi thieu", "sach ve", "sach nao",
+                 "sach cua", "tac gia"]
+# từ đệm không làm câu "khó hiểu" hơn (không bị trừ điểm khi còn sót lại)
+_FILLER = {"minh", "toi", "em", "anh", "chi", "ban", "shop", "nhe", "nha", "a", "ak", "ah", "voi", "cho",
+           "lay", "la", "so", "sdt", "dien", "thoai", "quyen", "cuon", "sach", "di", "giup", "oi", "thi",
+           "nay", "do", "thu", "muon", "can", "va", "con", "ok", "oke", "vay"}
+
+_PHONE_LOOSE_RE = re.compile(r"(?<!\d)0(?:[\s.\-]?\d){9,10}(?!\d)")
+_QTY_NORM_RE = re.compile(r"\b(\d{1,3})\s*(?:quyen|cuon|q|x|ban|cai)\b")
+_ID_RE = re.compile(r"(?:\bid|\bma sach|#)\s*[:#]?\s*(\d{1,7})\b")
+_ORDINAL_RE = re.compile(r"\b(?:cuon|quyen|so|sach)\s*(?:thu\s*)?(dau tien|dau|mot|hai|ba|bon|nam|[1-9])\b")
+_ORDINALS = {"dau tien": 1, "dau": 1, "mot": 1, "hai": 2, "ba": 3, "bon": 4, "nam": 5}
+_ADDR_RE = re.compile(r"^\s*(?:địa chỉ|dia chi|đ/c|d/c|đc)\s*(?:là|la|:|-)?\s*(.{6,})$", re.I)
+_NAME_RE = re.compile(r"^\s*(?:tên người nhận|ten nguoi nhan|người nhận|nguoi nhan)\b\s*(?:là|la|:|-)?\s*"
+                      r"([^\d,;:]{2,60})$", re.I)
+# "tên ..." trơn: chỉ nhận khi đang hỏi tên người nhận, và không phải "tên sách/tên tác giả/..."
+_BARE_NAME_RE = re.compile(r"^\s*(?:tên|ten)\b(?!\s*(?:sách|sach|tác giả|tac gia|truyện|truyen|cuốn|cuon|quyển|quyen|"
+                           r"bộ|bo|nxb|nhà xuất bản|nha xuat ban)\b)\s*"
+                           r"(?:(?:của\s+)?(?:tôi|toi|mình|minh|em|anh|chị|chi)\s+(?:là|la)\b|là|la|:|-)?"
+                           r"\s*([^\d,;:]{2,60})$", re.I)
+# còn sót đại từ/từ đệm trong phần tên ("tên tôi Lan", "Lan nhé") → không chắc, để LLM tách
+_NOT_NAME = {"tôi", "toi", "mình", "minh", "là", "la", "của", "cua", "nhé", "nhe", "nha", "nhá", "ạ", "ơi", "oi"}
+# câu ngắn bắt đầu bằng danh từ chỉ loại sách ("truyện trinh thám", "tiểu thuyết lãng mạn") → tìm sách
+_GENRE_HEAD_RE = re.compile(r"^(?:truyen|tieu thuyet|sach)(?: [a-z0-9]+){1,4}$")
+_NOT_GENRE = {"cua", "toi", "minh", "em", "dau", "don", "da", "chua"}   # "sách của tôi đâu" là hỏi đơn
+
+
+def _genre_phrase(bare: str) -> bool:
+    b = " ".join(bare.split())
+    return bool(_GENRE_HEAD_RE.match(b)) and not (_NOT_GENRE & set(b.split()))
+
+
+def fast_nlu(user_text: str, last_hits: List[Dict[str, Any]], current_slots: Dict[str, Any]) -> tuple[dict, float]:
+    """
+    Tầng 1 (không gọi LLM): regex + từ điển có sẵn (PHONE_RE/QTY_RE, ORDER_WORDS, CATALOG_WORDS,
+    _TOPIC_HINTS/_TOPIC_SYNONYMS) → (dict cùng dạng NLUOut, độ tin cậy 0..1).
+    Mỗi tín hiệu cộng bằng chứng cho 1 intent; phần câu không giải thích được (ngoài từ đệm) trừ điểm,
+    2 intent mâu thuẫn cũng trừ điểm → câu mơ hồ tự rơi xuống LLM.
+    """
+    raw = (user_text or "").strip()
+    norm = _norm(raw)
+    out: Dict[str, Any] = {k: None for k in NLUOut.model_fields}
+    out["intent"] = "unknown"
+    if not norm:
+        return out, 0.0
+    slots = current_slots or {}
+    evidence: Dict[str, float] = {}
+    rest = f" {norm} "
+
+    def add(intent: str, p: float):
+        # gộp nhiều tín hiệu độc lập: 1 - Π(1 - p)
+        evidence[intent] = 1 - (1 - evidence.get(intent, 0.0)) * (1 - p)
+
+    def consume(m: re.Match) -> None:
+        nonlocal rest
+        rest = rest[:m.start()] + " " + rest[m.end():]
+
+    bare = re.sub(r"[^a-z0-9 ]+", " ", norm).strip()
+    if " ".join(bare.split()) in _GREETINGS:
+        out["intent"] = "smalltalk"
+        return out, 0.95
+
+    # --- slot: địa chỉ / tên người nhận (có tiền tố rõ ràng) → nhận cả phần còn lại ---
+    m = _ADDR_RE.match(raw)
+    if m:
+        out["address"] = m.group(1).strip()
+        add("order", 0.9)
+        rest = " "
+    else:
+        m = _NAME_RE.match(raw)
+        if m is None and slots.get("book_id") and not slots.get("customer_name"):
+            m = _BARE_NAME_RE.match(raw)
+        if m and not _PHONE_LOOSE_RE.search(raw):
+            name = m.group(1).strip()
+            out["customer_name"] = name.title()
+            add("order", 0.5 if _NOT_NAME & set(name.lower().split()) else 0.9)
+            rest = " "
+
+    # --- slot: SĐT, số lượng, id sách, "cuốn thứ 2", tên sách trong last_hits ---
+    m = _PHONE_LOOSE_RE.search(rest)
+    if m:
+        digits = re.sub(r"\D", "", m.group(0))
+        if PHONE_RE.fullmatch(digits):
+            out["phone"] = digits
+            add("order", 0.9)
+            consume(m)
+    m = _QTY_NORM_RE.search(rest)
+    if m:
+        out["quantity"] = int(m.group(1))
+        add("order", 0.85)
+        consume(m)
+    m = _ID_RE.search(rest)
+    if m:
+        out["book_id"] = int(m.group(1))
+        add("order", 0.85)
+        consume(m)
+    if out["book_id"] is None and last_hits:
+        m = _ORDINAL_RE.search(rest)
+        if m:
+            v = m.group(1)
+            idx = int(v) if v.isdigit() else _ORDINALS[v]
+            if 1 <= idx <= len(last_hits):
+                out["book_id"] = int(last_hits[idx - 1]["book_id"])
+                add("order", 0.8)
+                consume(m)
+    if out["book_id"] is None and last_hits:
+        for h in last_hits:
+            t = _norm(str(h.get("title") or "")).strip()
+            if len(t) >= 4 and f" {t} " in rest:
+                out["book_id"] = int(h["book_id"])
+                out["book_ref"] = h.get("title")
+                add("order", 0.8)
+                rest = rest.replace(f" {t} ", " ", 1)
+                break
+
+    # --- trả lời trống 1 con số: điền đúng slot đang chờ ---
+    if re.fullmatch(r"\d{1,3}", bare):
+        n = int(bare)
+        hit_ids = {int(h["book_id"]) for h in last_hits or [] if h.get("book_id") is not None}
+        if slots.get("book_id") and not slots.get("quantity"):
+            out["quantity"] = n
+            add("order", 0.9)
+        elif not slots.get("book_id") and n in hit_ids:
+            out["book_id"] = n
+            add("order", 0.85)
+        rest = " "
+
+    # --- từ khoá intent ---
+    low = raw.lower()
+    if any(re.search(w, low) for w in ORDER_WORDS):
+        add("order", 0.7)
+        for w in ("mua giup", "mua", "dat", "minh lay", "order"):
+            rest = rest.replace(f" {w} ", " ")
+    if any(w in norm for w in _STATUS_WORDS):
+        add("status", 0.85)
+        rest = " "
+    if not any(evidence.get(k) for k in ("order", "status")):
+        pq = parse_catalog_query(raw)
+        has_hint = any(h in norm for h in _TOPIC_HINTS)
+        if pq["category"] and (has_hint or pq["category"] in _TOPIC_SYNONYMS):
+            out["query"] = pq["query"]
+            add("search", 0.9)
+        if any(w in norm for w in _SEARCH_WORDS) or _genre_phrase(bare):
+            out["query"] = raw
+            add("search", 0.8)
+        if any(re.search(w, low) for w in CATALOG_WORDS):
+            out["query"] = raw
+            add("search", 0.6)
+
+    if not evidence:
+        return out, 0.0
+    ranked = sorted(evidence.items(), key=lambda kv: kv[1], reverse=True)
+    intent, conf = ranked[0]
+    out["intent"] = intent
+    if len(ranked) > 1:
+        conf *= 1 - ranked[1][1] * 0.5            # tín hiệu trái chiều
+    if intent != "search":                         # với search, phần còn lại chính là truy vấn
+        leftover = [t for t in re.split(r"[^a-z0-9]+", rest) if t and t not in _FILLER]
+        conf -= 0.1 * len(leftover)
+        if intent == "order" and leftover and not (out["book_id"] or slots.get("book_id")):
+            conf = min(conf, 0.6)                  # có thể đang nêu tên sách → để LLM lấy book_ref
+    return out, max(0.0, min(1.0, conf))
+
+
+_nlu_counters = {"fast": 0, "llm": 0, "degraded": 0, "fast_ms": 0.0, "llm_ms": 0.0}
+_nlu_fast_intents: Dict[str, int] = {}
+_nlu_lock = threading.Lock()
+
+def _nlu_count(intent: Optional[str] = None, **inc: float) -> None:
+    with _nlu_lock:
+        for k, v in inc.items():
+            _nlu_counters[k] += v
+        if intent is not None:
+            _nlu_fast_intents[intent] = _nlu_fast_intents.get(intent, 0) + 1
+
+async def nlu_resolve(
+    user_text: str,
+    recent_dialog: Callable[[], Awaitable[List[Dict[str, str]]]],
+    last_hits: List[Dict[str, Any]],
+    current_slots: Dict[str, Any],
+) -> dict:
+    """
+    NLU 2 tầng: fast_nlu trước; đủ tin cậy (>= settings.nlu_fast_threshold) thì trả luôn,
+    không thì mới đọc lịch sử (recent_dialog gọi lười) và hỏi LLM qua nlu_resolve_from_context.
+    """
+    t0 = time.perf_counter()
+    guess, conf = fast_nlu(user_text, last_hits, current_slots)
+    if conf >= settings.nlu_fast_threshold:
+        _nlu_count(guess["intent"], fast=1, fast_ms=(time.perf_counter() - t0) * 1000)
+        return guess
+    try:
+        out = await nlu_resolve_from_context(
+            user_text=user_text,
+            recent_dialog=await recent_dialog(),
+            last_hits=last_hits,
+            current_slots=current_slots,
+        )
+    except LLMOverloaded:
+        # LLM quá tải: dùng tạm kết quả luật nếu có hiểu được chút gì
+        if guess["intent"] == "unknown":
+            raise
+        _nlu_count(degraded=1)
+        return guess
+    _nlu_count(llm=1, llm_ms=(time.perf_counter() - t0) * 1000)
+    return out
+
+def nlu_stats() -> dict:
+    with _nlu_lock:
+        c = dict(_nlu_counters)
+        intents = dict(_nlu_fast_intents)
+    total = c["fast"] + c["llm"]
+    return {
+        "turns": total,
+        "fast": c["fast"], "llm": c["llm"], "degraded": c["degraded"],
+        "fast_rate": round(c["fast"] / total, 3) if total else 0.0,
+        "fast_avg_ms": round(c["fast_ms"] / c["fast"], 2) if c["fast"] else 0.0,
+        "llm_avg_ms": round(c["llm_ms"] / c["llm"], 1) if c["llm"] else 0.0,
+        "fast_intents": intents,
+        "threshold": settings.nlu_fast_threshold,
+    }
@@ -1,9 +1,17 @@
 # app/services/llm_json.py
 from __future__ import annotations
-import json, time
+import asyncio, copy, hashlib, json, re, time, logging, threading
+from functools import lru_cache
+from typing import AsyncIterator, Awaitable, Callable
 import httpx
 from pydantic import BaseModel, ValidationError
 
+from ..config import settings
+from .cache import SingleFlight, SQLiteKV, TTLCache
+from .llm_sched import scheduler
+
+logger = logging.getLogger(__name__)
+
 # ---------- utils ----------
 def _messages_to_prompt(messages: list[dict]) -> str:
     parts, sys = [], []
@@ -41,107 +49,759 @@ def _nice_404(e: httpx.HTTPStatusError):
 def _ok(r: httpx.Response) -> bool:
     return 200 <= r.status_code < 300
 
-# ---------- backend detection ----------
-def _detect_backend(base_url: str) -> str:
+# ---------- backend client (pool + cache detect) ----------
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=settings.llm_max_connections,
+        max_keepalive_connections=settings.llm_max_keepalive,
+        keepalive_expiry=settings.llm_keepalive_expiry,
+    )
+
+class LLMBackend:
     """
-    Trả về: 'ollama_api' | 'ollama_root' | 'openai'
+    Client dài hạn cho 1 base_url:
+    - Phát hiện backend 1 lần rồi nhớ ('ollama_api' | 'ollama_root' | 'openai'),
+      tự phát hiện lại khi gọi lỗi kết nối.
+    - Dùng chung httpx.Client / AsyncClient keep-alive (pool) thay vì mở kết nối mới mỗi lần.
+    - Ghi nhận thời gian từng lần gọi (xem llm_stats()).
     """
+
+    def __init__(self, base_url: str):
+        self.base = base_url.rstrip("/")
+        self.style: str | None = None
+        self._lock = threading.Lock()
+        self.http = httpx.Client(timeout=settings.llm_timeout, limits=_limits())
+        self._ahttp: httpx.AsyncClient | None = None
+        # structured outputs (format/response_format = JSON Schema): None = chưa biết,
+        # False = server từ chối schema (Ollama cũ, proxy không hỗ trợ) → chỉ ép JSON như trước
+        self.structured: bool | None = None
+        self.stats = {"calls": 0, "errors": 0, "detects": 0, "total_ms": 0.0, "last_ms": 0.0}
+        self._stats_lock = threading.Lock()     # cập nhật từ cả thread (chat) lẫn event loop (achat)
+
+    @property
+    def ahttp(self) -> httpx.AsyncClient:
+        if self._ahttp is None:
+            self._ahttp = httpx.AsyncClient(timeout=settings.llm_timeout, limits=_limits())
+        return self._ahttp
+
+    async def aclose(self) -> None:
+        if self._ahttp is not None:
+            await self._ahttp.aclose()
+            self._ahttp = None
+
+    # ----- detection -----
+    _PROBES = (("/api/tags", "ollama_api"), ("/tags", "ollama_root"))
+
+    def _remember(self, style: str, reachable: bool) -> str:
+        self._count("detects")
+        # server chưa lên thì không nhớ kết quả, lần sau probe lại
+        self.style = style if reachable else None
+        return style
+
+    def _probe(self) -> tuple[str, bool]:
+        """Trả (style, reachable); reachable=False nếu server không phản hồi probe nào."""
+        reachable = False
+        for path, style in self._PROBES:
+            try:
+                r = self.http.get(f"{self.base}{path}", timeout=5)
+                reachable = True
+                if _ok(r):
+                    return style, True
+            except Exception:
+                pass
+        return "openai", reachable
+
+    async def _aprobe(self) -> tuple[str, bool]:
+        reachable = False
+        for path, style in self._PROBES:
+            try:
+                r = await self.ahttp.get(f"{self.base}{path}", timeout=5)
+                reachable = True
+                if _ok(r):
+                    return style, True
+            except Exception:
+                pass
+        return "openai", reachable
+
+    def detect(self, force: bool = False) -> str:
+        style = self.style
+        if style and not force:
+            return style
+        with self._lock:
+            if force or not self.style:
+                return self._remember(*self._probe())
+            return self.style
+
+    async def adetect(self, force: bool = False) -> str:
+        style = self.style
+        if style and not force:
+            return style
+        return self._remember(*(await self._aprobe()))
+
+    def invalidate(self) -> None:
+        self.style = None
+
+    # ----- structured outputs -----
+    def _schema(self, schema: dict | None) -> dict | None:
+        if not schema or not settings.llm_structured_output or self.structured is False:
+            return None
+        return schema
+
+    def _schema_rejected(self, r: httpx.Response | None, schema: dict | None) -> bool:
+        """400/422 nhắc tới format/schema khi đang gửi JSON Schema → server không hỗ trợ, nhớ lại và gửi lại không schema."""
+        if not schema or r is None or r.status_code not in (400, 422):
+            return False
+        try:
+            txt = (r.text or "").lower()
+        except Exception:
+            txt = ""
+        if "format" not in txt and "schema" not in txt:
+            return False
+        self.structured = False
+        logger.warning("LLM %s không nhận JSON Schema, chuyển về format json: %s", self.base, txt[:200])
+        return True
+
+    # ----- low-level -----
+    def _count(self, field: str) -> None:
+        with self._stats_lock:
+            self.stats[field] += 1
+
+    def snapshot(self) -> dict:
+        with self._stats_lock:
+            return dict(self.stats)
+
+    def _record(self, url: str, t0: float) -> None:
+        ms = (time.perf_counter() - t0) * 1000.0
+        with self._stats_lock:
+            self.stats["calls"] += 1
+            self.stats["total_ms"] += ms
+            self.stats["last_ms"] = ms
+        logger.debug("llm POST %s %.1fms", url, ms)
+
+    def post_json(self, url: str, payload: dict, timeout: float | None = None) -> dict:
+        t0 = time.perf_counter()
+        try:
+            r = self.http.post(url, json=payload, timeout=timeout or settings.llm_timeout)
+            try:
+                r.raise_for_status()
+            except httpx.HTTPStatusError as e:
+                _nice_404(e)
+            return r.json()
+        except Exception:
+            self._count("errors")
+            raise
+        finally:
+            self._record(url, t0)
+
+    async def apost_json(self, url: str, payload: dict, timeout: float | None = None) -> dict:
+        t0 = time.perf_counter()
+        try:
+            r = await self.ahttp.post(url, json=payload, timeout=timeout or settings.llm_timeout)
+            try:
+                r.raise_for_status()
+            except httpx.HTTPStatusError as e:
+                _nice_404(e)
+            return r.json()
+        except Exception:
+            self._count("errors")
+            raise
+        finally:
+            self._record(url, t0)
+
+    def chat(self, model: str, messages: list[dict], schema: dict | None = None) -> str:
+        """schema: JSON Schema của output (structured outputs); None = chỉ ép JSON."""
+        cached = self.style is not None
+        style = self.detect()
+        with scheduler.slot(model):     # giới hạn số request đồng thời tới model (xem llm_sched)
+            try:
+                return self._dispatch(style, model, messages, schema)
+            except httpx.TransportError:
+                # server đổi/khởi động lại → phát hiện lại 1 lần rồi thử tiếp
+                self.invalidate()
+                if not cached:
+                    raise
+                return self._dispatch(self.detect(force=True), model, messages, schema)
+
+    async def achat(self, model: str, messages: list[dict], schema: dict | None = None) -> str:
+        cached = self.style is not None
+        style = await self.adetect()
+        async with scheduler.aslot(model):
+            try:
+                return await self._adispatch(style, model, messages, schema)
+            except httpx.TransportError:
+                self.invalidate()
+                if not cached:
+                    raise
+                return await self._adispatch(await self.adetect(force=True), model, messages, schema)
+
+    async def astream_chat(self, model: str, messages: list[dict], schema: dict | None = None) -> AsyncIterator[str]:
+        """
+        Stream từng mẩu content từ LLM (Ollama /chat NDJSON hoặc OpenAI SSE).
+        Backend không hỗ trợ stream (chỉ có /generate...) → trả nguyên câu 1 lần.
+        """
+        style = await self.adetect()
+        use_schema = self._schema(schema)
+        await scheduler.aacquire(model)   # giữ slot suốt thời gian stream
+        t0 = time.perf_counter()
+        try:
+            if style in ("ollama_api", "ollama_root"):
+                prefix = "" if style == "ollama_root" else "/api"
+                url = f"{self.base}{prefix}/chat"
+                payload = {**_ollama_chat_payload(model, messages, use_schema), "stream": True}
+            else:
+                url = f"{self.base}/v1/chat/completions"
+                payload = {**_openai_payload(model, messages, use_schema), "stream": True}
+            async with self.ahttp.stream("POST", url, json=payload) as r:
+                if r.status_code >= 400:
+                    await r.aread()
+                if r.status_code in (404, 405) or self._schema_rejected(r, use_schema):
+                    streamed = False
+                else:
+                    streamed = True
+                    try:
+                        r.raise_for_status()
+                    except httpx.HTTPStatusError as e:
+                        _nice_404(e)
+                    async for line in r.aiter_lines():
+                        piece = _stream_piece(line)
+                        if piece:
+                            yield piece
+        except Exception:
+            self._count("errors")
+            raise
+        finally:
+            scheduler.release(model)
+            self._record(f"{self.base} (stream)", t0)
+        if not streamed:
+            yield await self.achat(model, messages, schema)
+
+    def _dispatch(self, style: str, model: str, messages: list[dict], schema: dict | None = None) -> str:
+        use_schema = self._schema(schema)
+        try:
+            out = self._call(style, model, messages, use_schema)
+        except httpx.HTTPStatusError as e:
+            if not self._schema_rejected(e.response, use_schema):
+                raise
+            return self._call(style, model, messages, None)
+        if use_schema:
+            self.structured = True
+        return out
+
+    async def _adispatch(self, style: str, model: str, messages: list[dict], schema: dict | None = None) -> str:
+        use_schema = self._schema(schema)
+        try:
+            out = await self._acall(style, model, messages, use_schema)
+        except httpx.HTTPStatusError as e:
+            if not self._schema_rejected(e.response, use_schema):
+                raise
+            return await self._acall(style, model, messages, None)
+        if use_schema:
+            self.structured = True
+        return out
+
+    def _call(self, style: str, model: str, messages: list[dict], schema: dict | None) -> str:
+        if style == "ollama_api":
+            return _chat_ollama(self, model, messages, root_style=False, schema=schema)
+        if style == "ollama_root":
+            return _chat_ollama(self, model, messages, root_style=True, schema=schema)
+        # openai style (proxy)
+        return _chat_openai(self, model, messages, schema)
+
+    async def _acall(self, style: str, model: str, messages: list[dict], schema: dict | None) -> str:
+        if style == "ollama_api":
+            return await _achat_ollama(self, model, messages, root_style=False, schema=schema)
+        if style == "ollama_root":
+            return await _achat_ollama(self, model, messages, root_style=True, schema=schema)
+        return await _achat_openai(self, model, messages, schema)
+
+
+_BACKENDS: dict[str, LLMBackend] = {}
+_BACKENDS_LOCK = threading.Lock()
+
+def get_backend(base_url: str) -> LLMBackend:
     base = base_url.rstrip("/")
-    try:
-        r = httpx.get(f"{base}/api/tags", timeout=5)
-        if _ok(r): return "ollama_api"
-    except Exception:
-        pass
-    try:
-        r = httpx.get(f"{base}/tags", timeout=5)
-        if _ok(r): return "ollama_root"
-    except Exception:
-        pass
-    return "openai"
+    be = _BACKENDS.get(base)
+    if be is None:
+        with _BACKENDS_LOCK:
+            be = _BACKENDS.get(base)
+            if be is None:
+                be = _BACKENDS[base] = LLMBackend(base)
+    return be
+
+async def aclose_backends() -> None:
+    for be in list(_BACKENDS.values()):
+        await be.aclose()
+
+def llm_stats() -> dict:
+    """Thống kê theo base_url: backend đã phát hiện, số lần gọi, thời gian (ms)."""
+    out = {}
+    for base, be in _BACKENDS.items():
+        st = be.snapshot()
+        st["avg_ms"] = round(st["total_ms"] / st["calls"], 1) if st["calls"] else 0.0
+        st["total_ms"] = round(st["total_ms"], 1)
+        st["last_ms"] = round(st["last_ms"], 1)
+        out[base] = {"backend": be.style, "structured": be.structured, **st}
+    return out
+
+def _detect_backend(base_url: str) -> str:
+    """
+    Trả về: 'ollama_api' | 'ollama_root' | 'openai' (có cache theo base_url)
+    """
+    return get_backend(base_url).detect()
 
 # ---------- low-level calls ----------
-def _post_json(url: str, payload: dict, timeout: float = 60.0) -> dict:
-    r = httpx.post(url, json=payload, timeout=timeout)
+# payload/parse dùng chung cho nhánh sync và async
+# schema: JSON Schema → Ollama structured outputs (format=<schema>) / OpenAI response_format json_schema;
+# None → chỉ ép JSON ("json" / json_object)
+def _ollama_chat_payload(model: str, messages: list[dict], schema: dict | None = None) -> dict:
+    return {"model": model, "messages": messages, "format": schema or "json", "stream": False,
+            "options": {"temperature": 0}}
+
+def _ollama_generate_payload(model: str, messages: list[dict], schema: dict | None = None) -> dict:
+    prompt = _messages_to_prompt(messages)
+    return {"model": model, "prompt": prompt, "format": schema or "json", "stream": False,
+            "options": {"temperature": 0}}
+
+def _openai_payload(model: str, messages: list[dict], schema: dict | None = None) -> dict:
+    if schema:
+        name = re.sub(r"[^A-Za-z0-9_-]", "_", str(schema.get("title") or "response"))[:64]
+        fmt = {"type": "json_schema", "json_schema": {"name": name, "schema": schema}}
+    else:
+        fmt = {"type": "json_object"}
+    return {"model": model, "messages": messages, "temperature": 0, "response_format": fmt}
+
+def _ollama_chat_text(data: dict) -> str | None:
+    # Ollama chuẩn
+    if "message" in data and isinstance(data["message"], dict) and "content" in data["message"]:
+        return data["message"]["content"]
+    # Một số proxy dùng cấu trúc choices
+    if "choices" in data:
+        return data["choices"][0]["message"]["content"]
+    return None
+
+def _stream_piece(line: str) -> str:
+    """1 dòng stream → phần content mới (Ollama NDJSON hoặc OpenAI 'data: {...}')."""
+    line = (line or "").strip()
+    if not line:
+        return ""
+    if line.startswith("data:"):
+        line = line[5:].strip()
+        if line == "[DONE]":
+            return ""
     try:
-        r.raise_for_status()
-    except httpx.HTTPStatusError as e:
+        data = json.loads(line)
+    except json.JSONDecodeError:
+        return ""
+    if isinstance(data.get("message"), dict):
+        return data["message"].get("content") or ""
+    if data.get("choices"):
+        return (data["choices"][0].get("delta") or {}).get("content") or ""
+    return data.get("response") or ""
+
+def _chat_fallthrough(e: httpx.HTTPStatusError) -> None:
+    # Nếu là 404/405 có thể server không support /chat → thử /generate
+    if e.response is None or e.response.status_code not in (404, 405):
         _nice_404(e)
-    return r.json()
 
-def _chat_ollama(base: str, model: str, messages: list[dict], root_style: bool) -> str:
+def _chat_ollama(be: LLMBackend, model: str, messages: list[dict], root_style: bool,
+                 schema: dict | None = None) -> str:
     """
     Gọi Ollama theo 2 style: /api/* (root_style=False) hoặc /* (root_style=True)
     """
     prefix = "" if root_style else "/api"
-
     # 1) /chat
     try:
-        data = _post_json(
-            f"{base}{prefix}/chat",
-            {"model": model, "messages": messages, "format": "json", "stream": False, "options": {"temperature": 0}},
-        )
-        # Ollama chuẩn
-        if "message" in data and isinstance(data["message"], dict) and "content" in data["message"]:
-            return data["message"]["content"]
-        # Một số proxy dùng cấu trúc choices
-        if "choices" in data:
-            return data["choices"][0]["message"]["content"]
+        out = _ollama_chat_text(be.post_json(f"{be.base}{prefix}/chat", _ollama_chat_payload(model, messages, schema)))
+        if out is not None:
+            return out
     except httpx.HTTPStatusError as e:
-        # Nếu là 404/405 có thể server không support /chat → thử /generate
-        if e.response is None or e.response.status_code not in (404, 405):
-            _nice_404(e)
-
+        _chat_fallthrough(e)
     # 2) /generate
-    prompt = _messages_to_prompt(messages)
-    data2 = _post_json(
-        f"{base}{prefix}/generate",
-        {"model": model, "prompt": prompt, "format": "json", "stream": False, "options": {"temperature": 0}},
-    )
+    data2 = be.post_json(f"{be.base}{prefix}/generate", _ollama_generate_payload(model, messages, schema))
     return data2.get("response", "")
 
-def _chat_openai(base: str, model: str, messages: list[dict]) -> str:
-    data = _post_json(
-        f"{base}/v1/chat/completions",
-        {"model": model, "messages": messages, "temperature": 0, "response_format": {"type": "json_object"}},
-    )
+async def _achat_ollama(be: LLMBackend, model: str, messages: list[dict], root_style: bool,
+                        schema: dict | None = None) -> str:
+    prefix = "" if root_style else "/api"
+    try:
+        out = _ollama_chat_text(
+            await be.apost_json(f"{be.base}{prefix}/chat", _ollama_chat_payload(model, messages, schema)))
+        if out is not None:
+            return out
+    except httpx.HTTPStatusError as e:
+        _chat_fallthrough(e)
+    data2 = await be.apost_json(f"{be.base}{prefix}/generate", _ollama_generate_payload(model, messages, schema))
+    return data2.get("response", "")
+
+def _chat_openai(be: LLMBackend, model: str, messages: list[dict], schema: dict | None = None) -> str:
+    data = be.post_json(f"{be.base}/v1/chat/completions", _openai_payload(model, messages, schema))
     return data["choices"][0]["message"]["content"]
 
-def _chat_any(base_url: str, model: str, messages: list[dict]) -> str:
-    base = base_url.rstrip("/")
-    style = _detect_backend(base)
-    if style == "ollama_api":
-        return _chat_ollama(base, model, messages, root_style=False)
-    if style == "ollama_root":
-        return _chat_ollama(base, model, messages, root_style=True)
-    # openai style (proxy)
-    return _chat_openai(base, model, messages)
+async def _achat_openai(be: LLMBackend, model: str, messages: list[dict], schema: dict | None = None) -> str:
+    data = await be.apost_json(f"{be.base}/v1/chat/completions", _openai_payload(model, messages, schema))
+    return data["choices"][0]["message"]["content"]
+
+def _chat_any(base_url: str, model: str, messages: list[dict], schema: dict | None = None) -> str:
+    return get_backend(base_url).chat(model, messages, schema)
+
+async def _achat_any(base_url: str, model: str, messages: list[dict], schema: dict | None = None) -> str:
+    return await get_backend(base_url).achat(model, messages, schema)
 
 # ---------- public: complete_json ----------
+_RETRY_MSG = {"role": "user", "content": "JSON không hợp lệ. Trả lại đúng JSON theo schema, KHÔNG thêm chữ nào khác."}
+
+def _build_messages(system: str, user: str, context: dict, schema_hint: dict) -> list[dict]:
+    envelope = {
+        "instruction": "Chỉ trả về DUY NHẤT JSON hợp lệ đúng schema. Không markdown, không lời văn thừa.",
+        "schema": schema_hint, "context": context, "user": user,
+    }
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": json.dumps(envelope, ensure_ascii=False)},
+    ]
+
+def _balanced_object(raw: str, start: int) -> str | None:
+    """Đoạn {...} cân bằng ngoặc bắt đầu tại raw[start] (bỏ qua ngoặc nằm trong chuỗi JSON)."""
+    depth, in_str, esc = 0, False, False
+    for i in range(start, len(raw)):
+        ch = raw[i]
+        if in_str:
+            if esc:
+                esc = False
+            elif ch == "\\":
+                esc = True
+            elif ch == '"':
+                in_str = False
+        elif ch == '"':
+            in_str = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return raw[start:i + 1]
+    return None
+
+def _parse_json(raw: str) -> tuple[object, bool]:
+    """
+    → (obj, repaired). JSON gần đúng (```json fence, lời dẫn phía trước, chữ thừa phía sau)
+    được sửa bằng cách lấy object {...} cân bằng đầu tiên parse được, khỏi phải gọi lại LLM.
+    """
+    try:
+        return json.loads(raw), False
+    except json.JSONDecodeError as e:
+        err = e
+    raw = raw or ""
+    start = raw.find("{")
+    while start >= 0:
+        frag = _balanced_object(raw, start)
+        if frag is None:
+            break
+        try:
+            return json.loads(frag), True
+        except json.JSONDecodeError:
+            start = raw.find("{", start + 1)
+    raise err
+
+def _validate(raw: str, schema_model: type[BaseModel]) -> tuple[dict, bool]:
+    obj, repaired = _parse_json(raw)
+    return schema_model.model_validate(obj).model_dump(), repaired
+
+# ---------- số liệu theo call site: lần đầu đã hợp lệ / phải sửa JSON / phải gọi lại LLM ----------
+_JSON_FIELDS = ("calls", "first_try", "repaired", "retries", "failed")
+_json_sites: dict[str, dict] = {}
+_json_lock = threading.Lock()
+
+def _note_json(site: str, **inc: int) -> None:
+    with _json_lock:
+        st = _json_sites.setdefault(site, dict.fromkeys(_JSON_FIELDS, 0))
+        for k, v in inc.items():
+            st[k] += v
+
+def json_stats() -> dict:
+    """Theo call site: calls, first_try (hợp lệ ngay lần gọi đầu), repaired, retries (số lần gọi lại LLM), failed."""
+    with _json_lock:
+        return {"structured_output": settings.llm_structured_output,
+                "sites": {k: dict(v) for k, v in _json_sites.items()}}
+
+# ---------- cache phản hồi: temperature=0 → cùng input cho cùng output ----------
+@lru_cache(maxsize=64)
+def _json_schema(schema_model: type[BaseModel]) -> dict:
+    return schema_model.model_json_schema()
+
+def _parse_site_ttls(spec: str) -> dict[str, float]:
+    """'nlu=3600,planner=600' → {'nlu': 3600.0, 'planner': 600.0}"""
+    out = {}
+    for part in (spec or "").split(","):
+        name, _, ttl = part.partition("=")
+        if name.strip() and ttl.strip():
+            out[name.strip()] = float(ttl)
+    return out
+
+class ResponseCache:
+    """
+    Cache kết quả complete_json theo nội dung.
+    Khoá = sha256(JSON chuẩn hoá sort_keys của base_url, model, system, user, context, schema_hint, JSON Schema).
+    - context (state/slots/lịch sử/observations của session) nằm trọn trong khoá, nên kết quả
+      chỉ dùng lại khi toàn bộ đầu vào giống hệt, không bao giờ lẫn sang session khác.
+    - Tầng 1: LRU+TTL trong RAM. Tầng 2 (tuỳ chọn): SQLite, lưu hash → output đã validate.
+    - TTL theo call site (settings.llm_cache_ttls); TTL <= 0 = tắt cache cho site đó.
+    """
+
+    def __init__(self, maxsize: int, default_ttl: float, site_ttls: dict[str, float], path: str = ""):
+        self.mem = TTLCache(maxsize=maxsize, ttl=default_ttl) if maxsize > 0 else None
+        self.disk = SQLiteKV(path, table="llm_responses") if path and self.mem is not None else None
+        self.default_ttl = default_ttl
+        self.site_ttls = site_ttls
+        self.sites: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def ttl(self, site: str) -> float:
+        return self.site_ttls.get(site, self.default_ttl)
+
+    @staticmethod
+    def key(base_url: str, model: str, system: str, user: str, context: dict,
+            schema_hint: dict, schema_model: type[BaseModel]) -> str:
+        payload = {
+            "v": 1, "base": base_url.rstrip("/"), "model": model, "system": system, "user": user,
+            "context": context, "hint": schema_hint, "schema": _json_schema(schema_model),
+        }
+        raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def use(self, site: str, bypass: bool) -> bool:
+        """Có tra/ghi cache cho lần gọi này không (site tắt cache hoặc caller yêu cầu bypass → không)."""
+        if self.mem is None or self.ttl(site) <= 0:
+            return False
+        if bypass:
+            self._count(site, "bypass")
+            return False
+        return True
+
+    def _count(self, site: str, field: str) -> None:
+        with self._lock:
+            st = self.sites.setdefault(site, {"hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "bypass": 0})
+            st[field] += 1
+
+    def get(self, site: str, key: str) -> dict | None:
+        val = self.mem.get(key)
+        if val is None and self.disk is not None:
+            blob = self.disk.get(key)
+            if blob is not None:
+                val = json.loads(blob)
+                self.mem.set(key, val, ttl=self.ttl(site))
+                self._count(site, "disk_hits")
+        if val is None:
+            self._count(site, "misses")
+            return None
+        self._count(site, "hits")
+        return copy.deepcopy(val)      # caller được phép sửa dict trả về
+
+    def put(self, site: str, key: str, value: dict) -> None:
+        ttl = self.ttl(site)
+        self.mem.set(key, copy.deepcopy(value), ttl=ttl)
+        if self.disk is not None:
+            try:
+                self.disk.set(key, json.dumps(value, ensure_ascii=False, default=str).encode("utf-8"), ttl=ttl)
+            except Exception:
+                logger.exception("llm response cache: disk write failed")
+        self._count(site, "stores")
+
+    def stats(self) -> dict:
+        if self.mem is None:
+            return {"enabled": False}
+        with self._lock:
+            sites = {k: dict(v) for k, v in self.sites.items()}
+        return {"enabled": True, **self.mem.stats(), "disk": self.disk is not None,
+                "ttls": {**self.site_ttls, "default": self.default_ttl}, "sites": sites}
+
+# lời gọi giống hệt (cùng khoá nội dung) đang chạy đồng thời → 1 request tới LLM; follower nhận bản sao
+llm_flight = SingleFlight(clone=copy.deepcopy)
+
+response_cache = ResponseCache(
+    maxsize=settings.llm_cache_size,
+    default_ttl=settings.llm_cache_ttl,
+    site_ttls=_parse_site_ttls(settings.llm_cache_ttls),
+    path=settings.llm_cache_path,
+)
+
 def complete_json(
     *, base_url: str, model: str, system: str, user: str,
     context: dict, schema_hint: dict, schema_model: type[BaseModel], retries: int = 2,
+    cache: str = "default", bypass_cache: bool = False,
 ) -> dict:
     """
     Gọi LLM và ÉP trả JSON đúng schema (validate bằng Pydantic).
     Hỗ trợ tự phát hiện backend: Ollama (/api hoặc root) hoặc OpenAI-style proxy.
+    cache: tên call site (TTL riêng, xem ResponseCache); bypass_cache=True: luôn gọi LLM, không đọc/ghi cache.
     """
-    envelope = {
-        "instruction": "Chỉ trả về DUY NHẤT JSON hợp lệ đúng schema. Không markdown, không lời văn thừa.",
-        "schema": schema_hint, "context": context, "user": user,
-    }
-    messages = [
-        {"role": "system", "content": system},
-        {"role": "user", "content": json.dumps(envelope, ensure_ascii=False)},
-    ]
+    key = ResponseCache.key(base_url, model, system, user, context, schema_hint, schema_model)
+    cached = response_cache.use(cache, bypass_cache)
+    if cached:
+        hit = response_cache.get(cache, key)
+        if hit is not None:
+            return hit
+    out = llm_flight.do(key, _complete_json, base_url, model, system, user, context,
+                        schema_hint, schema_model, retries, cache)
+    if cached:
+        response_cache.put(cache, key, out)
+    return out
+
+def _complete_json(base_url, model, system, user, context, schema_hint, schema_model, retries, site) -> dict:
+    messages = _build_messages(system, user, context, schema_hint)
+    schema = _json_schema(schema_model)
+    last_err = None
+    for attempt in range(retries + 1):
+        try:
+            out, repaired = _validate(_chat_any(base_url, model, messages, schema), schema_model)
+        except (json.JSONDecodeError, ValidationError) as e:
+            last_err = e
+            if attempt < retries:
+                messages.append(dict(_RETRY_MSG))
+                time.sleep(0.2)
+            continue
+        _note_json(site, calls=1, first_try=int(attempt == 0), repaired=int(repaired), retries=attempt)
+        return out
+    _note_json(site, calls=1, retries=retries, failed=1)
+    raise last_err
+
+async def acomplete_json(
+    *, base_url: str, model: str, system: str, user: str,
+    context: dict, schema_hint: dict, schema_model: type[BaseModel], retries: int = 2,
+    cache: str = "default", bypass_cache: bool = False,
+) -> dict:
+    """Bản async của complete_json (không chiếm thread trong lúc chờ LLM)."""
+    key = ResponseCache.key(base_url, model, system, user, context, schema_hint, schema_model)
+    cached = response_cache.use(cache, bypass_cache)
+    if cached:
+        hit = response_cache.get(cache, key)
+        if hit is not None:
+            return hit
+    out = await llm_flight.ado(key, _acomplete_json, base_url, model, system, user, context,
+                               schema_hint, schema_model, retries, cache)
+    if cached:
+        response_cache.put(cache, key, out)
+    return out
 
+async def _acomplete_json(base_url, model, system, user, context, schema_hint, schema_model, retries, site) -> dict:
+    messages = _build_messages(system, user, context, schema_hint)
+    schema = _json_schema(schema_model)
     last_err = None
-    for _ in range(retries + 1):
+    for attempt in range(retries + 1):
         try:
-            raw = _chat_any(base_url, model, messages)
-            obj = json.loads(raw)
-            return schema_model.model_validate(obj).model_dump()
+            out, repaired = _validate(await _achat_any(base_url, model, messages, schema), schema_model)
         except (json.JSONDecodeError, ValidationError) as e:
             last_err = e
-            messages.append({"role": "user", "content": "JSON không hợp lệ. Trả lại đúng JSON theo schema, KHÔNG thêm chữ nào khác."})
-            time.sleep(0.2)
+            if attempt < retries:
+                messages.append(dict(_RETRY_MSG))
+                await asyncio.sleep(0.2)
+            continue
+        _note_json(site, calls=1, first_try=int(attempt == 0), repaired=int(repaired), retries=attempt)
+        return out
+    _note_json(site, calls=1, retries=retries, failed=1)
     raise last_err
+
+
+# ---------- streaming: rút 1 field chuỗi khi JSON còn đang sinh ----------
+_JSON_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+class JsonFieldStreamer:
+    """
+    Parser tăng dần: nhận từng mẩu JSON thô, trả phần text mới giải mã được của
+    field chuỗi `field` (vd. 'say') ngay khi model còn đang sinh.
+    Chỉ hỗ trợ field kiểu string; escape bị cắt giữa 2 mẩu sẽ được giữ lại chờ mẩu sau.
+    """
+
+    def __init__(self, field: str = "say"):
+        self._key_re = re.compile(r'"%s"\s*:\s*"' % re.escape(field))
+        self.buf = ""
+        self.pos = 0
+        self.state = "seek"   # seek | value | done
+
+    def feed(self, chunk: str) -> str:
+        self.buf += chunk or ""
+        if self.state == "seek":
+            m = self._key_re.search(self.buf, max(0, self.pos - 64))
+            if not m:
+                self.pos = len(self.buf)
+                return ""
+            self.pos = m.end()
+            self.state = "value"
+        if self.state != "value":
+            return ""
+
+        out, i, buf = [], self.pos, self.buf
+        while i < len(buf):
+            ch = buf[i]
+            if ch == '"':
+                self.state = "done"
+                i += 1
+                break
+            if ch != "\\":
+                out.append(ch)
+                i += 1
+                continue
+            if i + 1 >= len(buf):
+                break                       # chờ ký tự escape
+            esc = buf[i + 1]
+            if esc == "u":
+                if i + 6 > len(buf):
+                    break                   # chờ đủ 4 hex
+                try:
+                    code = int(buf[i + 2:i + 6], 16)
+                except ValueError:
+                    code = 0xFFFD
+                if 0xD800 <= code < 0xDC00:  # surrogate pair (emoji...) → cần thêm \uXXXX
+                    if i + 12 > len(buf):
+                        break
+                    try:
+                        low = int(buf[i + 8:i + 12], 16)
+                        code = 0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)
+                    except ValueError:
+                        code = 0xFFFD
+                    i += 6
+                out.append(chr(code))
+                i += 6
+                continue
+            out.append(_JSON_ESCAPES.get(esc, esc))
+            i += 2
+        self.pos = i
+        return "".join(out)
+
+async def acomplete_json_stream(
+    *, base_url: str, model: str, system: str, user: str,
+    context: dict, schema_hint: dict, schema_model: type[BaseModel],
+    on_delta: Callable[[str], Awaitable[None]], field: str = "say", retries: int = 2,
+    cache: str = "default", bypass_cache: bool = False,
+) -> dict:
+    """
+    Như acomplete_json nhưng stream: mỗi mẩu text mới của `field` được đẩy qua on_delta.
+    JSON cuối cùng vẫn được validate; nếu hỏng thì rơi về acomplete_json (có retry).
+    Trúng cache: đẩy nguyên `field` qua on_delta 1 lần. Không gộp single-flight (mỗi caller stream riêng).
+    """
+    key = ResponseCache.key(base_url, model, system, user, context, schema_hint, schema_model)
+    cached = response_cache.use(cache, bypass_cache)
+    if cached:
+        hit = response_cache.get(cache, key)
+        if hit is not None:
+            if hit.get(field):
+                await on_delta(str(hit[field]))
+            return hit
+    messages = _build_messages(system, user, context, schema_hint)
+    streamer = JsonFieldStreamer(field)
+    chunks: list[str] = []
+    async for piece in get_backend(base_url).astream_chat(model, messages, _json_schema(schema_model)):
+        chunks.append(piece)
+        delta = streamer.feed(piece)
+        if delta:
+            await on_delta(delta)
+    try:
+        out, repaired = _validate("".join(chunks), schema_model)
+        _note_json(cache, calls=1, first_try=1, repaired=int(repaired))
+    except (json.JSONDecodeError, ValidationError):
+        _note_json(cache, retries=1)     # lượt stream hỏng = 1 lần gọi lại; phần còn lại do _acomplete_json đếm
+        out = await llm_flight.ado(key, _acomplete_json, base_url, model, system, user, context,
+                                   schema_hint, schema_model, retries, cache)
+    if cached:
+        response_cache.put(cache, key, out)
+    return out
@@ -0,0 +1,270 @@
+# app/services/llm_sched.py
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, Iterator, AsyncIterator, Optional
+
+from ..config import settings
+
+# Lớp ưu tiên (nhỏ = ưu tiên cao): lượt chat của người dùng > tác vụ nền (tóm tắt...) > reindex embedding
+PRIORITIES = ("interactive", "background", "batch")
+_WAIT_BUCKETS_MS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+# ngữ cảnh gọi: đặt 1 lần ở đầu request/job (llm_context), mọi lời gọi LLM bên dưới tự mang theo
+_PRIORITY: contextvars.ContextVar[str] = contextvars.ContextVar("llm_priority", default="interactive")
+_SESSION: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("llm_session", default=None)
+
+
+class LLMOverloaded(RuntimeError):
+    """Chờ slot LLM quá deadline của lớp ưu tiên → caller trả câu trả lời rút gọn thay vì treo."""
+
+
+@contextmanager
+def llm_context(priority: str = "interactive", session: Optional[str] = None) -> Iterator[None]:
+    t1 = _PRIORITY.set(priority)
+    t2 = _SESSION.set(session)
+    try:
+        yield
+    finally:
+        _PRIORITY.reset(t1)
+        _SESSION.reset(t2)
+
+
+def _parse_map(spec: str) -> Dict[str, float]:
+    out = {}
+    for part in (spec or "").split(","):
+        name, _, val = part.rpartition("=")
+        if name.strip() and val.strip():
+            out[name.strip()] = float(val)
+    return out
+
+
+class _Waiter:
+    __slots__ = ("prio", "session", "enq", "deadline", "event", "fut", "loop", "state")
+
+    def __init__(self, prio: int, session: str, deadline: Optional[float], loop=None):
+        self.prio = prio
+        self.session = session
+        self.enq = time.monotonic()
+        self.deadline = deadline
+        self.loop = loop
+        self.event = None if loop else threading.Event()
+        self.fut = loop.create_future() if loop else None
+        self.state = "waiting"        # waiting | granted | expired | gone
+
+
+class _Gate:
+    """Hàng chờ của 1 model: mỗi lớp ưu tiên là OrderedDict session → deque (xoay vòng giữa các session)."""
+    __slots__ = ("limit", "inflight", "queues", "admitted", "rejected", "waits", "wait_ms_max")
+
+    def __init__(self, limit: int):
+        self.limit = max(1, limit)
+        self.inflight = 0
+        self.queues = [OrderedDict() for _ in PRIORITIES]
+        self.admitted = {p: 0 for p in PRIORITIES}
+        self.rejected = {p: 0 for p in PRIORITIES}
+        self.waits = {p: [0] * (len(_WAIT_BUCKETS_MS) + 1) for p in PRIORITIES}
+        self.wait_ms_max = {p: 0.0 for p in PRIORITIES}
+
+    def queued(self) -> int:
+        return sum(len(dq) for q in self.queues for dq in q.values())
+
+
+class LLMScheduler:
+    """
+    Admission control trước Ollama/LLM server:
+    - tối đa `limit` request đang chạy cho mỗi model (settings.llm_max_inflight / llm_max_inflight_models)
+    - hết slot thì xếp hàng: lớp ưu tiên cao đi trước; trong 1 lớp xoay vòng theo session,
+      1 session gửi dồn không chặn được session khác
+    - mỗi lớp có deadline chờ (settings.llm_queue_deadlines); quá hạn → LLMOverloaded (fail fast)
+    - dùng được từ thread (slot) lẫn coroutine (aslot); cấp slot giữa 2 bên qua call_soon_threadsafe
+    """
+
+    def __init__(self, default_limit: int, limits: Dict[str, float], deadlines: Dict[str, float]):
+        self.default_limit = default_limit
+        self.limits = {k: int(v) for k, v in limits.items()}
+        self.deadlines = deadlines
+        self._gates: Dict[str, _Gate] = {}
+        self._lock = threading.Lock()
+
+    def _gate(self, model: str) -> _Gate:
+        g = self._gates.get(model)
+        if g is None:
+            g = self._gates[model] = _Gate(self.limits.get(model, self.default_limit))
+        return g
+
+    def _deadline(self, priority: str) -> Optional[float]:
+        sec = self.deadlines.get(priority, 0)
+        return time.monotonic() + sec if sec and sec > 0 else None
+
+    # ----- hàng đợi (gọi khi đang giữ self._lock) -----
+    def _try_admit(self, g: _Gate, prio: str) -> bool:
+        if g.inflight < g.limit and not g.queued():
+            g.inflight += 1
+            self._record_wait(g, prio, 0.0)
+            return True
+        return False
+
+    def _enqueue(self, g: _Gate, w: _Waiter) -> None:
+        g.queues[w.prio].setdefault(w.session, deque()).append(w)
+
+    def _remove(self, g: _Gate, w: _Waiter) -> None:
+        q = g.queues[w.prio]
+        dq = q.get(w.session)
+        if dq is not None:
+            try:
+                dq.remove(w)
+            except ValueError:
+                pass
+            if not dq:
+                del q[w.session]
+
+    def _next(self, g: _Gate) -> Optional[_Waiter]:
+        for q in g.queues:
+            while q:
+                sid, dq = next(iter(q.items()))
+                w = dq.popleft()
+                if dq:
+                    q.move_to_end(sid)      # session này vừa được phục vụ → xuống cuối vòng
+                else:
+                    del q[sid]
+                if w.state == "waiting":
+                    return w
+        return None
+
+    def _dispatch(self, g: _Gate) -> None:
+        now = time.monotonic()
+        while g.inflight < g.limit:
+            w = self._next(g)
+            if w is None:
+                return
+            if w.deadline is not None and now > w.deadline:
+                w.state = "expired"
+            else:
+                w.state = "granted"
+                g.inflight += 1
+                self._record_wait(g, PRIORITIES[w.prio], (now - w.enq) * 1000)
+            self._wake(w)
+
+    @staticmethod
+    def _wake(w: _Waiter) -> None:
+        if w.event is not None:
+            w.event.set()
+        else:
+            w.loop.call_soon_threadsafe(lambda f=w.fut: f.done() or f.set_result(None))
+
+    def _record_wait(self, g: _Gate, prio: str, ms: float) -> None:
+        g.admitted[prio] += 1
+        g.waits[prio][bisect_left(_WAIT_BUCKETS_MS, ms)] += 1
+        g.wait_ms_max[prio] = max(g.wait_ms_max[prio], ms)
+
+    def _reject(self, g: _Gate, w: _Waiter, model: str) -> LLMOverloaded:
+        prio = PRIORITIES[w.prio]
+        g.rejected[prio] += 1
+        waited = time.monotonic() - w.enq
+        return LLMOverloaded(f"LLM '{model}' quá tải: chờ {waited:.1f}s vẫn chưa tới lượt ({prio})")
+
+    def release(self, model: str) -> None:
+        with self._lock:
+            g = self._gate(model)
+            g.inflight = max(0, g.inflight - 1)
+            self._dispatch(g)
+
+    def _new_waiter(self, model: str, priority: Optional[str], loop=None) -> tuple[_Gate, Optional[_Waiter], str]:
+        prio = priority or _PRIORITY.get()
+        if prio not in PRIORITIES:
+            prio = "interactive"
+        with self._lock:
+            g = self._gate(model)
+            if self._try_admit(g, prio):
+                return g, None, prio
+            w = _Waiter(PRIORITIES.index(prio), _SESSION.get() or "", self._deadline(prio), loop)
+            self._enqueue(g, w)
+            return g, w, prio
+
+    # ----- sync -----
+    def acquire(self, model: str, priority: Optional[str] = None) -> None:
+        g, w, _ = self._new_waiter(model, priority)
+        if w is None:
+            return
+        timeout = None if w.deadline is None else max(0.0, w.deadline - time.monotonic())
+        w.event.wait(timeout)
+        with self._lock:
+            if w.state == "granted":
+                return
+            if w.state == "waiting":
+                self._remove(g, w)
+            w.state = "gone"
+            raise self._reject(g, w, model)
+
+    @contextmanager
+    def slot(self, model: str, priority: Optional[str] = None) -> Iterator[None]:
+        """priority=None: lấy theo llm_context của caller."""
+        self.acquire(model, priority)
+        try:
+            yield
+        finally:
+            self.release(model)
+
+    # ----- async -----
+    async def aacquire(self, model: str, priority: Optional[str] = None) -> None:
+        g, w, _ = self._new_waiter(model, priority, asyncio.get_running_loop())
+        if w is None:
+            return
+        timeout = None if w.deadline is None else max(0.0, w.deadline - time.monotonic())
+        try:
+            await asyncio.wait_for(asyncio.shield(w.fut), timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            with self._lock:
+                granted = w.state == "granted"
+                if w.state == "waiting":
+                    self._remove(g, w)
+                w.state = "gone"
+            if granted:
+                self.release(model)    # đã được cấp slot nhưng caller bị huỷ → trả lại
+            raise
+        with self._lock:
+            if w.state == "granted":
+                return
+            if w.state == "waiting":
+                self._remove(g, w)
+            w.state = "gone"
+            raise self._reject(g, w, model)
+
+    @asynccontextmanager
+    async def aslot(self, model: str, priority: Optional[str] = None) -> AsyncIterator[None]:
+        await self.aacquire(model, priority)
+        try:
+            yield
+        finally:
+            self.release(model)
+
+    def stats(self) -> dict:
+        buckets = [f"le_{b}" for b in _WAIT_BUCKETS_MS] + ["inf"]
+        out = {}
+        with self._lock:
+            for model, g in self._gates.items():
+                out[model] = {
+                    "limit": g.limit, "in_flight": g.inflight,
+                    "queued": {p: sum(len(dq) for dq in g.queues[i].values()) for i, p in enumerate(PRIORITIES)},
+                    "admitted": dict(g.admitted), "rejected": dict(g.rejected),
+                    "wait_ms_max": {p: round(v, 1) for p, v in g.wait_ms_max.items()},
+                    "wait_ms_hist": {p: dict(zip(buckets, h)) for p, h in g.waits.items() if any(h)},
+                }
+        return {"deadlines": self.deadlines, "models": out}
+
+
+# singleton
+scheduler = LLMScheduler(
+    default_limit=settings.llm_max_inflight,
+    limits=_parse_map(settings.llm_max_inflight_models),
+    deadlines=_parse_map(settings.llm_queue_deadlines),
+)
@@ -0,0 +1,76 @@
+# app/services/order_feed.py
+from __future__ import annotations
+
+import json
+import logging
+import time
+from typing import List, Optional, Tuple
+
+from ..config import settings
+from ..db import (
+    arun, insert_order_event, fetch_order_events, order_events_bounds, purge_order_events,
+)
+from ..ws import hub
+
+logger = logging.getLogger(__name__)
+
+
+class OrderFeed:
+    """
+    Sự kiện vòng đời đơn hàng cho /ws/admin: order_created / order_approved / order_cancelled.
+    - Mỗi event được ghi vào OrderEvents (seq AUTO_INCREMENT, dùng chung giữa các worker) rồi phát qua hub
+    - Client giữ seq cuối; kết nối lại với ?since=<seq> để nhận bù các event đã lỡ.
+      seq cấp lúc INSERT nên seq nhỏ có thể commit sau seq lớn: replay đọc lùi thêm `overlap` seq,
+      client bỏ bản trùng theo seq
+    - Lỡ quá xa (đã bị dọn, hoặc quá `replay_limit` event) → gửi 'resync' để client tải lại danh sách
+    """
+
+    def __init__(self, retention_sec: int = 86400, replay_limit: int = 500, overlap: int = 50):
+        self.retention_sec = retention_sec
+        self.replay_limit = replay_limit
+        self.overlap = overlap
+        self._last_purge = 0.0
+
+    async def publish(self, type_: str, **data) -> dict:
+        # datetime/Decimal → chuỗi 1 lần ở đây để hub chỉ việc json.dumps
+        event = json.loads(json.dumps({"type": type_, **data}, ensure_ascii=False, default=str))
+        try:
+            event["seq"] = await arun(insert_order_event, json.dumps(event, ensure_ascii=False))
+        except Exception:
+            # không ghi được log: vẫn phát live (client nhận được, chỉ không replay được)
+            logger.exception("order event log failed")
+        await hub.publish_admin(event)
+        await self._maybe_purge()
+        return event
+
+    async def latest_seq(self) -> int:
+        return (await arun(order_events_bounds))[1]
+
+    async def replay(self, since: int) -> Tuple[List[dict], Optional[int]]:
+        """
+        Trả (events có seq > since - overlap, seq mới nhất). Danh sách rỗng + seq None nghĩa là
+        không bù được (client phải resync).
+        """
+        lo, hi = await arun(order_events_bounds)
+        if since + 1 < lo or hi - since > self.replay_limit:
+            return [], None
+        rows = await arun(fetch_order_events, max(0, since - self.overlap), self.replay_limit + self.overlap)
+        events = []
+        for seq, payload in rows:
+            ev = json.loads(payload)
+            ev["seq"] = seq
+            events.append(ev)
+        return events, hi
+
+    async def _maybe_purge(self) -> None:
+        if time.monotonic() - self._last_purge < 600:
+            return
+        self._last_purge = time.monotonic()
+        try:
+            await arun(purge_order_events, self.retention_sec)
+        except Exception:
+            logger.exception("order event purge failed")
+
+
+# singleton
+order_feed = OrderFeed(retention_sec=settings.order_feed_retention_sec)
@@ -2,31 +2,28 @@
 from __future__ import annotations
 
 from typing import List, Optional, Dict
-import os, httpx
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import os, re, time, asyncio, hashlib, threading, unicodedata, httpx, anyio
 import chromadb
 from chromadb import PersistentClient
 from chromadb.api.types import EmbeddingFunction
 from chromadb.config import Settings
-from sqlalchemy import text, bindparam
 
 from ..config import settings
+from .. import sql as Q
 from ..db import (
-    db_conn,
+    adb_conn,
+    arun,
     fetch_books_fulltext,
     fetch_books_keywords,
     fetch_books_by_category,
 )
 from .llm import parse_catalog_query
-
-# rapidfuzz để rerank theo từ khóa; nếu chưa cài vẫn chạy được
-try:
-    from rapidfuzz import fuzz
-except Exception:  # fallback mềm
-    class _F:
-        @staticmethod
-        def token_set_ratio(a, b): return 0.0
-    fuzz = _F()
-
+from .cache import SingleFlight, TTLCache, SQLiteKV
+from .llm_sched import scheduler
+from .catalog import catalog
+from .rerank import reranker_from_settings
 
 # ========= Helpers lấy config linh hoạt =========
 def _get(name: str, default=None):
@@ -50,32 +47,82 @@ def _get(name: str, default=None):
 # =================== Embedding qua Ollama ===================
 
 class OllamaEmbeddingFn(EmbeddingFunction):
+    """
+    Embedding qua Ollama, gửi theo lô: /api/embed nhận list `input` nên 1 request
+    embed được cả batch; các batch chạy song song (thread cho sync, gather cho async).
+    Endpoint dùng được (/api/embed hay legacy /api/embeddings) chỉ dò 1 lần rồi nhớ.
+    """
 
-    def __init__(self, model: str, base_url: str = "http://localhost:11434"):
+    def __init__(self, model: str, base_url: str = "http://localhost:11434",
+                 batch_size: int | None = None, concurrency: int | None = None):
         self.model = model
         self.base_url = (base_url or "http://localhost:11434").rstrip("/")
-        self.http = httpx.Client(timeout=60.0)
+        self.batch_size = max(1, batch_size or settings.embed_batch_size)
+        self.concurrency = max(1, concurrency or settings.embed_concurrency)
+        self.endpoint: str | None = None   # 'embed' | 'embeddings' (legacy, 1 prompt/request)
+        limits = httpx.Limits(max_connections=self.concurrency * 2, max_keepalive_connections=self.concurrency)
+        self.http = httpx.Client(timeout=60.0, limits=limits)
+        self._ahttp: httpx.AsyncClient | None = None
+        # cùng 1 câu truy vấn đang được embed → các lời gọi đồng thời dùng chung 1 request
+        self.flight = SingleFlight()
 
     def name(self) -> str:
         return f"ollama:{self.model}"
 
-    def _embed_one(self, text: str) -> List[float]:
-        r = self.http.post(f"{self.base_url}/api/embed",
-                           json={"model": self.model, "input": text})
-        if r.status_code >= 400:  # fallback legacy
-            r = self.http.post(f"{self.base_url}/api/embeddings",
-                               json={"model": self.model, "prompt": text})
+    @property
+    def ahttp(self) -> httpx.AsyncClient:
+        if self._ahttp is None:
+            limits = httpx.Limits(max_connections=self.concurrency * 2, max_keepalive_connections=self.concurrency)
+            self._ahttp = httpx.AsyncClient(timeout=60.0, limits=limits)
+        return self._ahttp
+
+    async def aclose(self) -> None:
+        if self._ahttp is not None:
+            await self._ahttp.aclose()
+            self._ahttp = None
+
+    def _batches(self, texts: List[str]) -> List[List[str]]:
+        n = self.batch_size
+        return [texts[i:i + n] for i in range(0, len(texts), n)]
+
+    # ----- sync -----
+    def _embed_legacy(self, text: str) -> List[float]:
+        r = self.http.post(f"{self.base_url}/api/embeddings",
+                           json={"model": self.model, "prompt": text})
         r.raise_for_status()
-        data = r.json()
-        if "embeddings" in data:
-            return data["embeddings"][0]
-        return data["embedding"]
+        return r.json()["embedding"]
+
+    def _embed_batch(self, texts: List[str], priority: str | None = None) -> List[List[float]]:
+        with scheduler.slot(self.model, priority):
+            return self._embed_batch_http(texts)
+
+    def _embed_batch_http(self, texts: List[str]) -> List[List[float]]:
+        if self.endpoint != "embeddings":
+            r = self.http.post(f"{self.base_url}/api/embed",
+                               json={"model": self.model, "input": texts})
+            if r.status_code < 400:
+                self.endpoint = "embed"
+                return r.json()["embeddings"]
+            if self.endpoint == "embed":
+                r.raise_for_status()
+        # fallback legacy: từng văn bản một
+        out = [self._embed_legacy(t) for t in texts]
+        self.endpoint = "embeddings"
+        return out
+
+    def _embed_one(self, text: str) -> List[float]:
+        return self.flight.do((self.model, text), lambda: self._embed_batch([text])[0])
 
     def embed_documents(self, input=None, documents=None, **_):
         texts = list(documents if documents is not None else (input or []))
         if not texts:
             return []
-        return [self._embed_one(t) for t in texts]
+        batches = self._batches(texts)
+        # index lại catalog: lớp 'batch' → nhường slot Ollama cho lượt chat đang chờ
+        if len(batches) == 1 or self.concurrency == 1:
+            return [v for b in batches for v in self._embed_batch(b, "batch")]
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(batches))) as ex:
+            return [v for vecs in ex.map(lambda b: self._embed_batch(b, "batch"), batches) for v in vecs]
 
     def embed_query(self, input=None, query=None, **_):
         text = input if input is not None else query
@@ -83,12 +130,170 @@ class OllamaEmbeddingFn(EmbeddingFunction):
             return []
         return [self._embed_one(text)]
 
+    # ----- async -----
+    async def _aembed_legacy(self, text: str) -> List[float]:
+        r = await self.ahttp.post(f"{self.base_url}/api/embeddings",
+                                  json={"model": self.model, "prompt": text})
+        r.raise_for_status()
+        return r.json()["embedding"]
+
+    async def _aembed_batch(self, texts: List[str], priority: str | None = None) -> List[List[float]]:
+        async with scheduler.aslot(self.model, priority):
+            return await self._aembed_batch_http(texts)
+
+    async def _aembed_batch_http(self, texts: List[str]) -> List[List[float]]:
+        if self.endpoint != "embeddings":
+            r = await self.ahttp.post(f"{self.base_url}/api/embed",
+                                      json={"model": self.model, "input": texts})
+            if r.status_code < 400:
+                self.endpoint = "embed"
+                return r.json()["embeddings"]
+            if self.endpoint == "embed":
+                r.raise_for_status()
+        out = [await self._aembed_legacy(t) for t in texts]
+        self.endpoint = "embeddings"
+        return out
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def _run(batch: List[str]) -> List[List[float]]:
+            async with sem:
+                return await self._aembed_batch(batch, "batch")
+
+        parts = await asyncio.gather(*[_run(b) for b in self._batches(list(texts))])
+        return [v for vecs in parts for v in vecs]
+
+    async def _aembed_one(self, text: str) -> List[float]:
+        return (await self._aembed_batch([text]))[0]
+
+    async def aembed_query(self, text: str) -> List[List[float]]:
+        return [await self.flight.ado((self.model, text), self._aembed_one, text)]
+
     def __call__(self, input):
         if isinstance(input, str):
             return self.embed_query(input=input)
         return self.embed_documents(input=list(input))
 
 
+# =================== Cache embedding câu truy vấn ===================
+
+def normalize_query(q: str) -> str:
+    """Chuẩn hoá câu truy vấn để làm khoá cache (giữ dấu tiếng Việt: 'sách' ≠ 'sạch')."""
+    q = unicodedata.normalize("NFC", q or "").strip().lower()
+    return re.sub(r"\s+", " ", q)
+
+class QueryEmbeddingCache:
+    """
+    Khoá = (model, câu truy vấn đã chuẩn hoá).
+    Tầng 1: LRU+TTL trong RAM. Tầng 2 (tuỳ chọn): SQLite trên đĩa, vector lưu float32.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, path: str = ""):
+        self.mem = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.ttl = ttl
+        self.disk = SQLiteKV(path, table="query_embeddings") if path else None
+        self.disk_hits = 0
+
+    @staticmethod
+    def key(model: str, query: str) -> str:
+        return f"{model}\x1f{normalize_query(query)}"
+
+    def get_mem(self, key: str) -> Optional[List[float]]:
+        return self.mem.get(key)
+
+    def get_disk(self, key: str) -> Optional[List[float]]:
+        if self.disk is None:
+            return None
+        blob = self.disk.get(key)
+        if blob is None:
+            return None
+        vec = array("f", blob).tolist()
+        self.mem.set(key, vec)   # đưa lên tầng RAM
+        self.disk_hits += 1
+        return vec
+
+    def get(self, key: str) -> Optional[List[float]]:
+        vec = self.mem.get(key)
+        return vec if vec is not None else self.get_disk(key)
+
+    def put(self, key: str, vec: List[float]) -> None:
+        self.mem.set(key, vec)
+        if self.disk is not None:
+            self.disk.set(key, array("f", vec).tobytes(), ttl=self.ttl)
+
+    def stats(self) -> dict:
+        return {**self.mem.stats(), "disk": self.disk is not None, "disk_hits": self.disk_hits}
+
+
+# =================== Cache kết quả search ===================
+
+class SearchResultCache:
+    """
+    Khoá = (câu truy vấn đã chuẩn hoá, limit) → danh sách sách.
+    - Giới hạn số entry (LRU) + TTL.
+    - invalidate_book(id): xoá các entry có chứa sách đó (giá/tồn đổi, sách bị xoá).
+    - bump(): sang "phiên bản catalog" mới → bỏ toàn bộ (sách mới, đổi tên/tác giả/thể loại).
+    Mỗi lần invalidate đều tăng `version`; search chỉ put nếu version không đổi trong lúc nó chạy,
+    nên kết quả tính từ dữ liệu cũ không bao giờ lọt vào cache.
+    Nhiều worker: sửa Books ở worker khác đến qua hub (target 'catalog') hoặc chu kỳ catalog.refresh
+    → Retriever._on_catalog_change gọi invalidate_book/bump ở worker này.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.mem = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.version = 0
+        self._by_book: Dict[int, set] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(query: str, limit: int) -> tuple:
+        return (normalize_query(query), int(limit))
+
+    def get(self, query: str, limit: int) -> Optional[List[Dict]]:
+        hit = self.mem.get(self.key(query, limit))
+        return [dict(r) for r in hit] if hit is not None else None
+
+    def put(self, query: str, limit: int, results: List[Dict], version: int) -> None:
+        key = self.key(query, limit)
+        with self._lock:
+            if version != self.version:
+                return
+            self.mem.set(key, [dict(r) for r in results])
+            for r in results:
+                self._by_book.setdefault(int(r["book_id"]), set()).add(key)
+            if len(self._by_book) > 4 * self.mem.maxsize:
+                self._by_book = {b: ks for b, ks in self._by_book.items()
+                                 if any(k in self.mem for k in ks)}
+
+    def invalidate_book(self, book_id: int) -> None:
+        with self._lock:
+            self.version += 1
+            for key in self._by_book.pop(int(book_id), ()):
+                self.mem.pop(key)
+
+    def bump(self) -> None:
+        with self._lock:
+            self.version += 1
+            self._by_book.clear()
+            self.mem.clear()
+
+    def stats(self) -> dict:
+        return {**self.mem.stats(), "version": self.version}
+
+
+# =================== Document cho vector index ===================
+
+def book_doc(b: Dict) -> str:
+    """Văn bản được embed cho 1 cuốn sách (chỉ phần nội dung, không gồm giá/tồn)."""
+    return f"{b['title']} — {b['author']}. The loai: {b.get('category','')}"
+
+def doc_hash(doc: str) -> str:
+    return hashlib.sha1(doc.encode("utf-8")).hexdigest()
+
+
 # =================== Hybrid Retriever ===================
 
 class HybridRetriever:
@@ -105,87 +310,194 @@ class HybridRetriever:
         else:
             self.client = chromadb.Client(Settings(allow_reset=False))
 
+        self.embed_fn = OllamaEmbeddingFn(model=emb_model, base_url=base_url)
+        self.query_cache = QueryEmbeddingCache(
+            maxsize=settings.query_embed_cache_size,
+            ttl=settings.query_embed_cache_ttl,
+            path=settings.query_embed_cache_path,
+        )
+        self.result_cache = SearchResultCache(
+            maxsize=settings.search_cache_size, ttl=settings.search_cache_ttl,
+        )
+        # thay đổi Books do worker khác ghi: catalog.refresh thấy → bỏ cache tương ứng
+        catalog.subscribe(self._on_catalog_change)
+        self.leg_stats: Dict[str, Dict] = {}
+        # hợp nhất điểm: lexical (title/author/category) + vector, chấm cả lô 1 lần
+        self.reranker = reranker_from_settings()
         self.collection = self.client.get_or_create_collection(
             name=collection_name,
-            embedding_function=OllamaEmbeddingFn(model=emb_model, base_url=base_url),
+            embedding_function=self.embed_fn,
         )
 
-    # hợp nhất điểm: lexical (title/author/category) + vector
-    def _score(self, q: str, rec: Dict, vec_score: Optional[float]) -> float:
-        text = f"{rec['title']} {rec['author']} {rec.get('category','')}"
-        s_ratio = (fuzz.token_set_ratio(q, text) or 0.0) / 100.0  # 0..1
-        title_boost = 0.20 if any(w.lower() in rec['title'].lower() for w in q.split()) else 0.0
-        cat_boost = 0.15 if rec.get('category') and any(w.lower() in rec['category'].lower() for w in q.split()) else 0.0
-        v = float(vec_score or 0.0)
-        return 0.55 * s_ratio + 0.35 * v + title_boost + cat_boost
-
     def upsert_book(self, b: Dict):
-        doc = f"{b['title']} — {b['author']}. The loai: {b.get('category','')}"
+        self.upsert_books([b])
+
+    def upsert_books(self, books: List[Dict], embeddings: Optional[List[List[float]]] = None):
+        """Upsert 1 lô sách trong 1 lần gọi Chroma (embeddings tính sẵn thì truyền vào)."""
+        if not books:
+            return
+        for b in books:
+            self.result_cache.invalidate_book(b["book_id"])
+        docs = [book_doc(b) for b in books]
         self.collection.upsert(
-            ids=[str(b["book_id"])],
-            documents=[doc],
-            metadatas=[{"book_id": b["book_id"]}],
+            ids=[str(b["book_id"]) for b in books],
+            documents=docs,
+            metadatas=[{"book_id": b["book_id"], "hash": doc_hash(d)} for b, d in zip(books, docs)],
+            embeddings=embeddings if embeddings is not None else self.embed_fn.embed_documents(docs),
         )
 
     def delete_book(self, book_id: int):
+        self.result_cache.invalidate_book(book_id)
         self.collection.delete(ids=[str(book_id)])
 
-    def search(self, user_query: str, limit: int = 5) -> list[Dict]:
-        pq = parse_catalog_query(user_query)
-        q = (pq["query"] or user_query).strip()
-        cat = pq["category"]
+    def invalidate_book(self, book_id: int, content_changed: bool = False):
+        """Gọi sau khi ghi Books: content_changed=True (thêm sách/đổi tên...) thì bỏ toàn bộ cache."""
+        if content_changed:
+            self.result_cache.bump()
+        else:
+            self.result_cache.invalidate_book(book_id)
+
+    def _on_catalog_change(self, book_ids: Optional[List[int]], content_changed: bool) -> None:
+        if book_ids is None or content_changed:
+            self.result_cache.bump()
+        else:
+            for bid in book_ids:
+                self.result_cache.invalidate_book(bid)
+
+    async def aclose(self) -> None:
+        await self.embed_fn.aclose()
+
+    async def embed_query_cached(self, user_query: str) -> List[List[float]]:
+        """Embedding câu truy vấn, ưu tiên lấy từ cache (RAM → đĩa) trước khi gọi Ollama."""
+        key = self.query_cache.key(self.embed_fn.model, user_query)
+        vec = self.query_cache.get_mem(key)
+        if vec is None and self.query_cache.disk is not None:
+            vec = await anyio.to_thread.run_sync(self.query_cache.get_disk, key)
+        if vec is None:
+            vec = (await self.embed_fn.aembed_query(normalize_query(user_query)))[0]
+            if self.query_cache.disk is not None:
+                await anyio.to_thread.run_sync(self.query_cache.put, key, vec)
+            else:
+                self.query_cache.put(key, vec)
+        return [vec]
+
+    async def search(self, user_query: str, limit: int = 5) -> list[Dict]:
+        cached = self.result_cache.get(user_query, limit)
+        if cached is not None:
+            return cached
+        version = self.result_cache.version
+        results, degraded = await self._search(user_query, limit)
+        # kết quả thiếu nhánh (timeout/lỗi) không cache, lần sau thử lại đủ
+        if not degraded:
+            self.result_cache.put(user_query, limit, results, version)
+        return results
+
+    async def _timed(self, leg: str, coro, timeout: float, default):
+        """Chạy 1 nhánh với deadline riêng; quá hạn/lỗi → trả default (search vẫn có kết quả)."""
+        st = self.leg_stats.setdefault(leg, {"calls": 0, "timeouts": 0, "errors": 0, "total_ms": 0.0, "last_ms": 0.0})
+        t0 = time.perf_counter()
+        try:
+            return await asyncio.wait_for(coro, timeout=timeout), True
+        except asyncio.TimeoutError:
+            st["timeouts"] += 1
+            return default, False
+        except Exception:
+            st["errors"] += 1
+            return default, False
+        finally:
+            ms = (time.perf_counter() - t0) * 1000.0
+            st["calls"] += 1
+            st["total_ms"] += ms
+            st["last_ms"] = ms
+
+    def search_stats(self) -> dict:
+        """Latency từng nhánh ứng viên (lexical / vector)."""
+        out = {}
+        for leg, st in self.leg_stats.items():
+            avg = st["total_ms"] / st["calls"] if st["calls"] else 0.0
+            out[leg] = {**st, "total_ms": round(st["total_ms"], 1), "last_ms": round(st["last_ms"], 1),
+                        "avg_ms": round(avg, 1)}
+        return out
+
+    @staticmethod
+    def _pool(limit: int) -> int:
+        """Số ứng viên mỗi nhánh: rerank theo lô nên lấy rộng (SEARCH_CANDIDATES) cũng rẻ."""
+        return max(limit * 2, settings.search_candidates)
+
+    async def _lexical_leg(self, q: str, cat: Optional[str], limit: int) -> list[Dict]:
+        pool = self._pool(limit)
+        # snapshot trong RAM nếu đã nạp, không thì hỏi DB
+        if catalog.ready:
+            cands = []
+            if cat:
+                cands += catalog.by_category(cat, limit=pool)
+            if q and len(q) >= 2:
+                cands += catalog.keyword_search(q, limit=pool)
+            return cands
 
-        # 1) Ứng viên từ DB
-        with db_conn() as conn:
+        def _db_cands(conn) -> list[Dict]:
             db_cands = []
             if cat:
-                db_cands += fetch_books_by_category(conn, cat, limit=limit * 2)
+                db_cands += fetch_books_by_category(conn, cat, limit=pool)
             if q and len(q) >= 2:
                 try:
-                    db_cands += fetch_books_fulltext(conn, q, limit=limit * 2)
+                    db_cands += fetch_books_fulltext(conn, q, limit=pool)
                 except Exception:
-                    db_cands += fetch_books_keywords(conn, q, limit=limit * 2)
+                    db_cands += fetch_books_keywords(conn, q, limit=pool)
+            return db_cands
+
+        return await arun(_db_cands)
+
+    async def _vector_leg(self, user_query: str, limit: int) -> Dict[int, float]:
+        # embed qua httpx async (có cache); Chroma (local, sync) chạy trong thread
+        q_emb = await self.embed_query_cached(user_query)
+
+        def _query():
+            # Chroma tự kẹp n_results theo số phần tử → không cần count() (thêm 1 round-trip mỗi truy vấn)
+            return self.collection.query(query_embeddings=q_emb, n_results=self._pool(limit))
 
-        # 2) Ứng viên vector từ Chroma (có thể rỗng nếu chưa index)
+        res = await anyio.to_thread.run_sync(_query)
         vec_scores: Dict[int, float] = {}
-        try:
-            res = self.collection.query(query_texts=[user_query], n_results=min(limit * 2, 10))
-            ids = (res or {}).get("ids", [[]])[0] or []
-            dists = (res or {}).get("distances", [[]])[0] or []
-            for _id, dist in zip(ids, dists):
-                try:
-                    bid = int(_id)
-                    dist = float(dist)
-                except Exception:
-                    continue
-                # chuyển khoảng cách -> điểm
-                vec_scores[bid] = 1.0 / (1.0 + dist)
-        except Exception:
-            pass
+        ids = (res or {}).get("ids", [[]])[0] or []
+        dists = (res or {}).get("distances", [[]])[0] or []
+        for _id, dist in zip(ids, dists):
+            try:
+                bid = int(_id)
+                dist = float(dist)
+            except Exception:
+                continue
+            # chuyển khoảng cách -> điểm
+            vec_scores[bid] = 1.0 / (1.0 + dist)
+        return vec_scores
+
+    async def _search(self, user_query: str, limit: int) -> tuple[list[Dict], bool]:
+        pq = parse_catalog_query(user_query)
+        q = (pq["query"] or user_query).strip()
+        cat = pq["category"]
+
+        # 1) + 2) Ứng viên lexical & vector chạy song song, mỗi nhánh 1 deadline:
+        #    Chroma/Ollama chậm thì chỉ còn kết quả lexical chứ không cộng dồn latency.
+        (db_cands, lex_ok), (vec_scores, vec_ok) = await asyncio.gather(
+            self._timed("lexical", self._lexical_leg(q, cat, limit), settings.search_lexical_timeout, []),
+            self._timed("vector", self._vector_leg(user_query, limit), settings.search_vector_timeout, {}),
+        )
+        degraded = not (lex_ok and vec_ok)
 
         # 3) Hợp nhất theo book_id
         by_id: Dict[int, Dict] = {r["book_id"]: r for r in db_cands}
         missing = [bid for bid in vec_scores.keys() if bid not in by_id]
-        if missing:
-            with db_conn() as conn:
-                stmt = text("""
-                    SELECT book_id, title, author, price, stock, category
-                    FROM Books
-                    WHERE book_id IN :ids
-                """).bindparams(bindparam("ids", expanding=True))
-                rows = conn.execute(stmt, {"ids": missing}).mappings().all()
+        if missing and catalog.ready:
+            for row in catalog.get_many(missing):
+                by_id[row["book_id"]] = row
+        elif missing:
+            async with adb_conn() as conn:
+                rows = (await conn.execute(Q.BOOKS_BY_IDS.clause, {"ids": missing})).mappings().all()
                 for row in rows:
                     by_id[row["book_id"]] = dict(row)
 
         # 4) Rerank
-        scored = []
-        base_q = q or user_query
-        for bid, rec in by_id.items():
-            score = self._score(base_q, rec, vec_scores.get(bid))
-            scored.append((score, rec))
-        scored.sort(key=lambda x: x[0], reverse=True)
-
-        return [rec for _, rec in scored[:limit]]
+        ranked = self.reranker.rank(q or user_query, list(by_id.values()), vec_scores, limit=limit)
+        return ranked, degraded
 
 
 # singleton
@@ -0,0 +1,108 @@
+# app/services/rerank.py
+from __future__ import annotations
+
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from ..config import settings
+
+# rapidfuzz để chấm điểm từ khóa; nếu chưa cài vẫn chạy được (điểm fuzzy = 0)
+try:
+    from rapidfuzz import fuzz, process
+except Exception:  # fallback mềm
+    fuzz = process = None
+
+
+# ========= Fusion: gộp các cột điểm thành 1 điểm cuối =========
+# fn(features, reranker) -> np.ndarray điểm (càng cao càng tốt)
+FusionFn = Callable[[Dict[str, np.ndarray], "Reranker"], np.ndarray]
+FUSIONS: Dict[str, FusionFn] = {}
+
+def register_fusion(name: str, fn: FusionFn) -> None:
+    FUSIONS[name] = fn
+
+def _fuse_linear(f: Dict[str, np.ndarray], rr: "Reranker") -> np.ndarray:
+    # công thức cũ của HybridRetriever._score
+    return (rr.w_fuzzy * f["fuzzy"] + rr.w_vector * f["vector"]
+            + rr.title_boost * f["title_hit"] + rr.cat_boost * f["cat_hit"])
+
+def _ranks(x: np.ndarray) -> np.ndarray:
+    """Hạng 1..n theo điểm giảm dần."""
+    order = np.argsort(-x, kind="stable")
+    r = np.empty(len(x), dtype=np.float64)
+    r[order] = np.arange(1, len(x) + 1)
+    return r
+
+def _fuse_rrf(f: Dict[str, np.ndarray], rr: "Reranker") -> np.ndarray:
+    # Reciprocal Rank Fusion: lexical (fuzzy + boost) và vector xếp hạng riêng rồi cộng 1/(k+rank)
+    lexical = f["fuzzy"] + rr.title_boost * f["title_hit"] + rr.cat_boost * f["cat_hit"]
+    score = 1.0 / (rr.rrf_k + _ranks(lexical))
+    has_vec = f["vector"] > 0
+    if has_vec.any():
+        score = score + np.where(has_vec, 1.0 / (rr.rrf_k + _ranks(f["vector"])), 0.0)
+    return score
+
+register_fusion("linear", _fuse_linear)
+register_fusion("rrf", _fuse_rrf)
+
+
+class Reranker:
+    """
+    Rerank cả lô ứng viên 1 lần:
+    - query tách từ / lower đúng 1 lần
+    - fuzzy token_set_ratio cho mọi ứng viên bằng rapidfuzz.process.cdist (đa luồng)
+    - boost title/category bằng np.char.find trên mảng chuỗi
+    - gộp điểm qua fusion cắm được ('linear' | 'rrf' | tự register_fusion)
+    """
+
+    def __init__(self, w_fuzzy: float = 0.55, w_vector: float = 0.35, title_boost: float = 0.20,
+                 cat_boost: float = 0.15, fusion: str = "linear", rrf_k: float = 60.0, workers: int = -1):
+        self.w_fuzzy = w_fuzzy
+        self.w_vector = w_vector
+        self.title_boost = title_boost
+        self.cat_boost = cat_boost
+        self.fusion = fusion if fusion in FUSIONS else "linear"
+        self.rrf_k = rrf_k
+        self.workers = workers
+
+    def features(self, q: str, recs: List[Dict], vec_scores: Dict[int, float]) -> Dict[str, np.ndarray]:
+        words = [w.lower() for w in q.split()]
+        texts = [f"{r['title']} {r['author']} {r.get('category','')}" for r in recs]
+        titles = np.array([r["title"].lower() for r in recs], dtype=str)
+        cats = np.array([(r.get("category") or "").lower() for r in recs], dtype=str)
+
+        if process is not None:
+            fuzzy = process.cdist([q], texts, scorer=fuzz.token_set_ratio, workers=self.workers,
+                                  dtype=np.float32)[0] / 100.0
+        else:
+            fuzzy = np.zeros(len(recs), dtype=np.float32)
+
+        title_hit = np.zeros(len(recs), dtype=bool)
+        cat_hit = np.zeros(len(recs), dtype=bool)
+        for w in words:
+            title_hit |= np.char.find(titles, w) >= 0
+            cat_hit |= np.char.find(cats, w) >= 0
+        cat_hit &= np.char.str_len(cats) > 0
+
+        vector = np.array([float(vec_scores.get(r["book_id"]) or 0.0) for r in recs], dtype=np.float64)
+        return {"fuzzy": fuzzy.astype(np.float64), "vector": vector,
+                "title_hit": title_hit.astype(np.float64), "cat_hit": cat_hit.astype(np.float64)}
+
+    def rank(self, q: str, recs: List[Dict], vec_scores: Dict[int, float],
+             limit: Optional[int] = None, fusion: Optional[str] = None) -> List[Dict]:
+        if not recs:
+            return []
+        scores = FUSIONS[fusion or self.fusion](self.features(q, recs, vec_scores), self)
+        order = np.argsort(-scores, kind="stable")
+        if limit is not None:
+            order = order[:limit]
+        return [recs[i] for i in order]
+
+
+def reranker_from_settings() -> Reranker:
+    return Reranker(
+        w_fuzzy=settings.rerank_w_fuzzy, w_vector=settings.rerank_w_vector,
+        title_boost=settings.rerank_title_boost, cat_boost=settings.rerank_cat_boost,
+        fusion=settings.rerank_fusion, rrf_k=settings.rerank_rrf_k,
+    )
@@ -1,22 +1,291 @@
 from __future__ import annotations
-from typing import Dict, Any
-
-# In-memory state store per session (you can replace with DB if needed)
-SESSIONS: dict[str, dict[str, Any]] = {}
-
-def get_session(session_id: str) -> dict[str, Any]:
-    st = SESSIONS.get(session_id)
-    if not st:
-        st = {
-            'state': 'catalog',
-            'slots': {
-                'book_id': None, 'quantity': None,
-                'customer_name': None, 'phone': None, 'address': None
-            },
-            'last_prompt': None
+
+import json
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Optional
+
+import anyio
+
+from .. import sql as Q
+from ..config import settings
+from .cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+# ================= Session object =================
+
+class Session:
+    """
+    Trạng thái hội thoại của 1 session. Dùng __slots__ cho gọn RAM;
+    vẫn truy cập kiểu dict (st["state"], st["slots"][k], st.get("cache")) như code cũ.
+    """
+    __slots__ = ("state", "slots", "last_prompt", "cache")
+
+    def __init__(self, state: str = "catalog", slots: Optional[dict] = None,
+                 last_prompt: Optional[str] = None, cache: Optional[dict] = None):
+        self.state = state
+        self.slots = slots or {
+            'book_id': None, 'quantity': None,
+            'customer_name': None, 'phone': None, 'address': None
         }
-        SESSIONS[session_id] = st
-    return st
+        self.last_prompt = last_prompt
+        self.cache = cache
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key) from None
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        try:
+            setattr(self, key, value)
+        except (AttributeError, TypeError):
+            raise KeyError(key) from None
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key, default) if key in self.__slots__ else default
+
+    def to_dict(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "Session":
+        return cls(**{k: d.get(k) for k in cls.__slots__ if k in d})
+
+
+# ================= Stores =================
+
+class SessionStore(ABC):
+    """Interface backend lưu session. `shared=False` nghĩa là object sống trong RAM, sửa tại chỗ là đủ."""
+    shared = True
+
+    @abstractmethod
+    def load(self, session_id: str) -> Optional[Session]:
+        ...
+
+    @abstractmethod
+    def save_many(self, items: Dict[str, Session]) -> None:
+        ...
+
+    @abstractmethod
+    def delete(self, session_id: str) -> None:
+        ...
+
+    def stats(self) -> dict:
+        return {}
+
+
+class MemorySessionStore(SessionStore):
+    """LRU + TTL (trượt theo lần truy cập) trong process; chỉ hợp với 1 worker."""
+    shared = False
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def load(self, session_id: str) -> Optional[Session]:
+        st = self.cache.get(session_id)
+        if st is not None:
+            self.cache.set(session_id, st)   # gia hạn TTL
+        return st
+
+    def save_many(self, items: Dict[str, Session]) -> None:
+        for sid, st in items.items():
+            self.cache.set(sid, st)
+
+    def delete(self, session_id: str) -> None:
+        self.cache.pop(session_id)
+
+    def stats(self) -> dict:
+        return self.cache.stats()
+
+
+class MySQLSessionStore(SessionStore):
+    """Bảng ChatState(session_id, data JSON, updated_at); dùng chung được giữa nhiều worker."""
+
+    def __init__(self, ttl: float):
+        from ..db import db_conn
+        self._db_conn = db_conn
+        self.ttl = ttl
+        self._last_purge = 0.0
+
+    def load(self, session_id: str) -> Optional[Session]:
+        with self._db_conn() as conn:
+            data = Q.CHAT_STATE_LOAD.scalar(conn, {"sid": session_id, "ttl": int(self.ttl)})
+        return Session.from_dict(json.loads(data)) if data is not None else None
+
+    def save_many(self, items: Dict[str, Session]) -> None:
+        if not items:
+            return
+        rows = [{"sid": sid, "data": json.dumps(st.to_dict(), ensure_ascii=False)} for sid, st in items.items()]
+        with self._db_conn() as conn:
+            # executemany → PyMySQL gộp thành 1 INSERT nhiều dòng
+            Q.CHAT_STATE_UPSERT.run(conn, rows)
+            if self.ttl > 0 and time.monotonic() - self._last_purge > 600:
+                Q.CHAT_STATE_PURGE.run(conn, {"ttl": int(self.ttl)})
+                self._last_purge = time.monotonic()
+            conn.commit()
+
+    def delete(self, session_id: str) -> None:
+        with self._db_conn() as conn:
+            Q.CHAT_STATE_DELETE.run(conn, {"sid": session_id})
+            conn.commit()
+
+
+class RedisSessionStore(SessionStore):
+    """Redis (hoặc server tương thích giao thức Redis chạy local); TTL do Redis tự xoá."""
+
+    def __init__(self, url: str, ttl: float):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("SESSION_STORE=redis cần cài gói `redis` (pip install redis)") from e
+        self.r = redis.Redis.from_url(url)
+        self.ttl = int(ttl)
+
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return f"chatstate:{session_id}"
+
+    def load(self, session_id: str) -> Optional[Session]:
+        raw = self.r.get(self._key(session_id))
+        if raw is None:
+            return None
+        if self.ttl > 0:
+            self.r.expire(self._key(session_id), self.ttl)
+        return Session.from_dict(json.loads(raw))
+
+    def save_many(self, items: Dict[str, Session]) -> None:
+        pipe = self.r.pipeline(transaction=False)
+        for sid, st in items.items():
+            data = json.dumps(st.to_dict(), ensure_ascii=False)
+            if self.ttl > 0:
+                pipe.setex(self._key(sid), self.ttl, data)
+            else:
+                pipe.set(self._key(sid), data)
+        pipe.execute()
+
+    def delete(self, session_id: str) -> None:
+        self.r.delete(self._key(session_id))
+
+
+# ================= Write-back buffer =================
+
+class SessionManager:
+    """
+    Lớp trên SessionStore:
+    - get: ưu tiên bản đang chờ ghi (dirty) → store → tạo mới
+    - save: chỉ đánh dấu dirty; thread nền gom và ghi theo lô mỗi `flush_interval` giây
+    Với MemorySessionStore thì save không cần làm gì (object sửa tại chỗ).
+    """
+
+    def __init__(self, store: SessionStore, flush_interval: float = 0.2):
+        self.store = store
+        self.flush_interval = flush_interval
+        self._dirty: Dict[str, Session] = {}
+        self._lock = threading.Lock()
+        self._flusher: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self.flushes = 0
+        self.flushed = 0
+
+    def get(self, session_id: str) -> Session:
+        with self._lock:
+            st = self._dirty.get(session_id)
+        if st is None:
+            st = self.store.load(session_id)
+        if st is None:
+            st = Session()
+            if not self.store.shared:
+                self.store.save_many({session_id: st})
+        return st
+
+    def save(self, session_id: str, st: Session) -> None:
+        if not self.store.shared:
+            return
+        with self._lock:
+            self._dirty[session_id] = st
+        self._ensure_flusher()
+
+    def reset(self, session_id: Optional[str]) -> None:
+        if not session_id:
+            return
+        with self._lock:
+            self._dirty.pop(session_id, None)
+        self.store.delete(session_id)
+
+    def flush(self) -> int:
+        with self._lock:
+            batch, self._dirty = self._dirty, {}
+        if not batch:
+            return 0
+        try:
+            self.store.save_many(batch)
+        except Exception:
+            # ghi lỗi → trả lại buffer (bản mới hơn, nếu có, được giữ)
+            with self._lock:
+                for sid, st in batch.items():
+                    self._dirty.setdefault(sid, st)
+            raise
+        self.flushes += 1
+        self.flushed += len(batch)
+        return len(batch)
+
+    def _ensure_flusher(self) -> None:
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self._run, name="session-flusher", daemon=True)
+            self._flusher.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("session flush failed")
+
+    def close(self) -> None:
+        self._stop.set()
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("session flush on shutdown failed")
+
+    def stats(self) -> dict:
+        return {"backend": type(self.store).__name__, "pending": len(self._dirty),
+                "flushes": self.flushes, "flushed": self.flushed, **self.store.stats()}
+
+
+def _make_store() -> SessionStore:
+    kind = (settings.session_store or "memory").lower()
+    if kind == "mysql":
+        return MySQLSessionStore(ttl=settings.session_ttl)
+    if kind == "redis":
+        return RedisSessionStore(settings.redis_url, ttl=settings.session_ttl)
+    return MemorySessionStore(maxsize=settings.session_max, ttl=settings.session_ttl)
+
+sessions = SessionManager(_make_store(), flush_interval=settings.session_flush_ms / 1000.0)
+
+
+# ================= API dùng trong app =================
+
+def get_session(session_id: str) -> Session:
+    return sessions.get(session_id)
+
+async def aget_session(session_id: str) -> Session:
+    """Bản async: store dùng chung (MySQL/Redis) được đọc trong thread, không chặn event loop."""
+    if not sessions.store.shared:
+        return sessions.get(session_id)
+    return await anyio.to_thread.run_sync(sessions.get, session_id)
+
+def save_session(session_id: str, st: Session) -> None:
+    sessions.save(session_id, st)
+
 def reset_session(session_id: str):
-    if session_id in SESSIONS:
-        del SESSIONS[session_id]
\ No newline at end of file
+    sessions.reset(session_id)
+
+def session_stats() -> dict:
+    return sessions.stats()
@@ -0,0 +1,289 @@
+# app/sql.py
+"""
+Câu SQL khai báo sẵn, dựng 1 lần lúc import.
+Helper trong db.py / agent*.py chỉ việc execute: không tạo lại text() và parse lại tên bind mỗi lần gọi.
+SQLAlchemy cache bản compile theo cache key của TextClause. Câu dựng động (sort/filter) thì
+qua variant(): mỗi chuỗi SQL khác nhau chỉ dựng 1 lần.
+
+Tuỳ chọn DB_SERVER_PREPARE=1 (cần DB_DRIVER=mysqlconnector): các Stmt có prepare=True chạy bằng
+server-side prepared statement của driver. MySQL chỉ parse 1 lần mỗi kết nối, tham số gửi dạng binary.
+PyMySQL / aiomysql không hỗ trợ prepare phía server, nên luôn chạy như text() bình thường.
+"""
+from __future__ import annotations
+
+import re
+import time
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy import bindparam, text
+
+from .config import settings
+
+# ":name" nhưng không phải "::" hay chuỗi giờ kiểu 12:30
+_BIND_RE = re.compile(r"(?<![:\w\\]):(\w+)(?!:)")
+
+
+class _Result:
+    """Kết quả tối thiểu của nhánh prepared (rowcount/lastrowid cho câu ghi)."""
+    __slots__ = ("rowcount", "lastrowid")
+
+    def __init__(self, rowcount: int, lastrowid: Optional[int]):
+        self.rowcount = rowcount
+        self.lastrowid = lastrowid
+
+
+class Stmt:
+    """
+    1 câu SQL dùng lại: TextClause dựng sẵn + dạng %s theo vị trí (cho prepared cursor).
+    rows()/one()/scalar()/run() chạy qua SQLAlchemy, hoặc qua prepared cursor nếu bật.
+    expanding: tên bind nhận list (`IN :ids`). Số placeholder đổi theo từng lần gọi nên không prepare phía server.
+    """
+    __slots__ = ("name", "sql", "clause", "prepare", "_positional", "_order")
+
+    def __init__(self, name: str, sql: str, prepare: bool = False, expanding: tuple[str, ...] = ()):
+        self.name = name
+        self.sql = " ".join(sql.split())
+        self.clause = text(self.sql)
+        if expanding:
+            self.clause = self.clause.bindparams(*(bindparam(n, expanding=True) for n in expanding))
+        self.prepare = prepare and not expanding
+        self._order = _BIND_RE.findall(self.sql)
+        self._positional = _BIND_RE.sub("%s", self.sql)
+
+    def __repr__(self) -> str:
+        return f"Stmt({self.name!r})"
+
+    # ----- SQLAlchemy -----
+    def execute(self, conn, params: Any = None):
+        return conn.execute(self.clause, params if params is not None else {})
+
+    def rows(self, conn, params: Optional[dict] = None) -> List[Dict[str, Any]]:
+        cur = self._prepared(conn, params)
+        if cur is not None:
+            cols = [d[0] for d in cur.description]
+            return [dict(zip(cols, r)) for r in cur.fetchall()]
+        return [dict(r) for r in self.execute(conn, params).mappings().all()]
+
+    def one(self, conn, params: Optional[dict] = None) -> Optional[Dict[str, Any]]:
+        cur = self._prepared(conn, params)
+        if cur is not None:
+            r = cur.fetchone()
+            cur.fetchall()   # đọc hết để cursor dùng lại được
+            return dict(zip([d[0] for d in cur.description], r)) if r else None
+        r = self.execute(conn, params).mappings().first()
+        return dict(r) if r else None
+
+    def scalar(self, conn, params: Optional[dict] = None):
+        cur = self._prepared(conn, params)
+        if cur is not None:
+            r = cur.fetchone()
+            cur.fetchall()
+            return r[0] if r else None
+        return self.execute(conn, params).scalar()
+
+    def run(self, conn, params: Any = None):
+        """Câu ghi: trả object có rowcount / lastrowid. params là list → executemany (luôn qua SQLAlchemy)."""
+        if not isinstance(params, list):
+            cur = self._prepared(conn, params)
+            if cur is not None:
+                return _Result(cur.rowcount, cur.lastrowid)
+        return self.execute(conn, params)
+
+    # ----- server-side prepare -----
+    def _prepared(self, conn, params: Optional[dict]):
+        if not (self.prepare and _SERVER_PREPARE and conn.dialect.driver == "mysqlconnector"):
+            return None
+        # giữ đúng ngữ nghĩa transaction như conn.execute (autobegin) để conn.commit() vẫn commit
+        if not conn.in_transaction():
+            conn.begin()
+        fairy = conn.connection
+        cache = fairy.info.setdefault("prepared", {})   # sống theo kết nối vật lý (statement server-side)
+        cur = cache.get(self.name)
+        if cur is None:
+            cur = cache[self.name] = fairy.dbapi_connection.cursor(prepared=True)
+        params = params or {}
+        t0 = time.perf_counter()
+        cur.execute(self._positional, tuple(params[k] for k in self._order))
+        if on_prepared_query is not None:
+            on_prepared_query(conn, self.sql, time.perf_counter() - t0)
+        return cur
+
+
+_SERVER_PREPARE = settings.db_server_prepare and settings.db_driver == "mysqlconnector"
+# db.py gắn vào: đếm queries/slow_queries + slow log cho nhánh prepared (không đi qua event cursor của engine)
+on_prepared_query: Optional[Callable[[Any, str, float], None]] = None
+
+
+@lru_cache(maxsize=256)
+def variant(sql: str) -> Stmt:
+    """Câu dựng động theo vài tham số (sort/chiều/filter): mỗi biến thể dựng 1 lần."""
+    return Stmt("variant", sql)
+
+
+# ---------- Books ----------
+BOOKS_ALL = Stmt("books_all", """
+  SELECT book_id, title, author, price, stock, category
+  FROM Books ORDER BY book_id DESC
+""")
+BOOK_BY_ID = Stmt("book_by_id", """
+  SELECT book_id, title, author, price, stock, category
+  FROM Books WHERE book_id=:id
+""", prepare=True)
+BOOKS_BY_IDS = Stmt("books_by_ids", """
+  SELECT book_id, title, author, price, stock, category
+  FROM Books WHERE book_id IN :ids
+""", expanding=("ids",))
+BOOK_INSERT = Stmt("book_insert", """
+  INSERT INTO Books(title,author,price,stock,category)
+  VALUES (:title,:author,:price,:stock,:category)
+""")
+BOOK_UPDATE = Stmt("book_update", """
+  UPDATE Books SET title=:title,author=:author,price=:price,stock=:stock,category=:category
+  WHERE book_id=:id
+""")
+BOOK_DELETE = Stmt("book_delete", "DELETE FROM Books WHERE book_id=:id")
+BOOK_TAKE_STOCK = Stmt("book_take_stock", """
+  UPDATE Books SET stock = stock - :qty
+  WHERE book_id=:bid AND stock >= :qty
+""")
+BOOKS_FULLTEXT = Stmt("books_fulltext", """
+  SELECT book_id, title, author, price, stock, category,
+         MATCH(title, author) AGAINST (:q IN NATURAL LANGUAGE MODE) AS score
+  FROM Books
+  WHERE MATCH(title, author) AGAINST (:q IN NATURAL LANGUAGE MODE)
+  ORDER BY score DESC
+  LIMIT :lim
+""")
+BOOKS_LIKE_TITLE_AUTHOR = Stmt("books_like_title_author", """
+  SELECT book_id, title, author, price, stock, category, 0.0 AS score
+  FROM Books
+  WHERE title LIKE :like OR author LIKE :like
+  LIMIT :lim
+""")
+BOOKS_BY_CATEGORY = Stmt("books_by_category", """
+  SELECT book_id, title, author, price, stock, category
+  FROM Books
+  WHERE category LIKE :pat
+  ORDER BY stock DESC, book_id DESC
+  LIMIT :lim
+""")
+BOOKS_KEYWORDS = Stmt("books_keywords", """
+  SELECT book_id, title, author, price, stock, category, 0.0 AS score
+  FROM Books
+  WHERE title LIKE :like OR author LIKE :like OR category LIKE :like
+  ORDER BY book_id DESC
+  LIMIT :lim
+""")
+
+# ---------- Orders ----------
+ORDER_COLS = """
+  o.order_id, o.customer_name, o.phone, o.address,
+  o.book_id, b.title, b.author, o.quantity, o.status, o.created_at,
+  b.price, (b.price * o.quantity) AS total, o.session_id
+"""
+ORDER_INSERT = Stmt("order_insert", """
+  INSERT INTO Orders (customer_name, phone, address, book_id, quantity, status, session_id)
+  VALUES (:customer_name, :phone, :address, :book_id, :quantity, 'pending', :session_id)
+""")
+ORDERS_BY_STATUS = Stmt("orders_by_status", f"""
+  SELECT {ORDER_COLS}
+  FROM Orders o
+  JOIN Books b ON b.book_id=o.book_id
+  WHERE o.status=:status
+  ORDER BY o.created_at DESC
+  LIMIT :lim
+""")
+ORDER_DETAIL = Stmt("order_detail", f"""
+  SELECT {ORDER_COLS}, b.stock
+  FROM Orders o
+  JOIN Books b ON b.book_id=o.book_id
+  WHERE o.order_id=:id
+""", prepare=True)
+ORDER_COUNTS = Stmt("order_counts", "SELECT status, COUNT(*) FROM Orders GROUP BY status")
+ORDER_LOCK = Stmt("order_lock", "SELECT book_id, quantity FROM Orders WHERE order_id=:id FOR UPDATE")
+ORDER_APPROVE = Stmt("order_approve", "UPDATE Orders SET status='approved' WHERE order_id=:id")
+ORDER_CANCEL = Stmt("order_cancel", "UPDATE Orders SET status='cancelled' WHERE order_id=:id")
+ORDER_BY_ID = Stmt("order_by_id", """
+  SELECT order_id, book_id, quantity, status, session_id
+  FROM Orders WHERE order_id=:id
+""", prepare=True)
+ORDER_SESSION = Stmt("order_session", "SELECT session_id FROM Orders WHERE order_id=:id", prepare=True)
+LAST_ORDER_OF_SESSION = Stmt("last_order_of_session", """
+  SELECT order_id, status FROM Orders WHERE session_id=:sid ORDER BY order_id DESC LIMIT 1
+""", prepare=True)
+
+# ---------- Chat ----------
+CHAT_SESSION_ENSURE = Stmt("chat_session_ensure", "INSERT IGNORE INTO ChatSessions(session_id) VALUES (:sid)")
+CHAT_TOUCH_SESSION = Stmt("chat_touch_session", """
+  INSERT INTO ChatSessions(session_id, last_time, msg_count) VALUES (:sid, NOW(), :n)
+  ON DUPLICATE KEY UPDATE last_time = VALUES(last_time), msg_count = msg_count + VALUES(msg_count)
+""", prepare=True)
+CHAT_INSERT = Stmt("chat_insert", """
+  INSERT INTO ChatMessages(session_id, role, content) VALUES (:sid,:role,:content)
+""", prepare=True)
+CHAT_AFTER = Stmt("chat_after", """
+  SELECT id, role, content, created_at
+  FROM ChatMessages
+  WHERE session_id = :sid AND id > :after
+  ORDER BY id ASC
+  LIMIT :lim
+""", prepare=True)
+CHAT_LATEST = Stmt("chat_latest", """
+  SELECT id, role, content, created_at
+  FROM ChatMessages
+  WHERE session_id = :sid
+  ORDER BY id DESC
+  LIMIT :lim
+""", prepare=True)
+CHAT_BEFORE = Stmt("chat_before", """
+  SELECT id, role, content, created_at
+  FROM ChatMessages
+  WHERE session_id = :sid AND id < :before
+  ORDER BY id DESC
+  LIMIT :lim
+""", prepare=True)
+CHAT_RECENT_DIALOG = Stmt("chat_recent_dialog", """
+  SELECT role, content FROM ChatMessages WHERE session_id=:sid ORDER BY id DESC LIMIT :lim
+""")
+CHAT_SESSION_PAGE_IDS = Stmt("chat_session_page_ids", """
+  SELECT session_id FROM ChatSessions WHERE session_id > :after ORDER BY session_id LIMIT :lim
+""")
+CHAT_SESSION_BACKFILL = Stmt("chat_session_backfill", """
+  UPDATE ChatSessions s
+  LEFT JOIN (
+    SELECT session_id, MAX(created_at) AS mt, COUNT(*) AS c
+    FROM ChatMessages
+    WHERE session_id >= :first AND session_id <= :last
+    GROUP BY session_id
+  ) m ON m.session_id = s.session_id
+  SET s.last_time = COALESCE(m.mt, s.created_at), s.msg_count = COALESCE(m.c, 0)
+  WHERE s.session_id >= :first AND s.session_id <= :last
+""")
+
+# ---------- ChatState (SESSION_STORE=mysql) ----------
+CHAT_STATE_LOAD = Stmt("chat_state_load", """
+  SELECT data FROM ChatState WHERE session_id=:sid
+  AND (:ttl <= 0 OR updated_at >= NOW() - INTERVAL :ttl SECOND)
+""", prepare=True)
+CHAT_STATE_UPSERT = Stmt("chat_state_upsert", """
+  INSERT INTO ChatState(session_id, data) VALUES (:sid, :data)
+  ON DUPLICATE KEY UPDATE data=VALUES(data), updated_at=CURRENT_TIMESTAMP
+""")
+CHAT_STATE_PURGE = Stmt("chat_state_purge", "DELETE FROM ChatState WHERE updated_at < NOW() - INTERVAL :ttl SECOND")
+CHAT_STATE_DELETE = Stmt("chat_state_delete", "DELETE FROM ChatState WHERE session_id=:sid")
+
+# ---------- Hub / order events ----------
+HUB_EVENT_INSERT = Stmt("hub_event_insert", "INSERT INTO HubEvents(payload) VALUES (:p)")
+HUB_EVENT_MAX = Stmt("hub_event_max", "SELECT COALESCE(MAX(id), 0) FROM HubEvents")
+HUB_EVENTS_AFTER = Stmt("hub_events_after", """
+  SELECT id, payload FROM HubEvents WHERE id > :after ORDER BY id LIMIT :lim
+""")
+HUB_EVENTS_PURGE = Stmt("hub_events_purge", "DELETE FROM HubEvents WHERE created_at < NOW() - INTERVAL :s SECOND")
+
+ORDER_EVENT_INSERT = Stmt("order_event_insert", "INSERT INTO OrderEvents(payload) VALUES (:p)")
+ORDER_EVENTS_SINCE = Stmt("order_events_since", """
+  SELECT seq, payload FROM OrderEvents WHERE seq > :since ORDER BY seq LIMIT :lim
+""")
+ORDER_EVENTS_BOUNDS = Stmt("order_events_bounds", "SELECT COALESCE(MIN(seq), 0), COALESCE(MAX(seq), 0) FROM OrderEvents")
+ORDER_EVENTS_PURGE = Stmt("order_events_purge", "DELETE FROM OrderEvents WHERE created_at < NOW() - INTERVAL :s SECOND")
@@ -1,40 +1,368 @@
-from typing import Dict, Set
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional
 from starlette.websockets import WebSocket
 
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+# event trên backplane: {"origin", "target": "user"|"admin", "session_id"?, "message"}
+Deliver = Callable[[dict], Awaitable[None]]
+
+
+class Backplane:
+    """Kênh pub/sub giữa các worker. Mặc định (local) = chỉ trong process."""
+
+    async def start(self, deliver: Deliver) -> None:
+        pass
+
+    async def publish(self, event: dict) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+
+class IdCursor:
+    """
+    Con trỏ đọc bảng theo id AUTO_INCREMENT. Id được cấp lúc INSERT chứ không phải lúc commit,
+    nên id nhỏ có thể hiện ra sau id lớn: không nhảy qua lỗ hổng ngay mà chờ tối đa `grace` giây
+    (quá hạn coi như transaction đó đã rollback).
+    - floor: mọi id <= floor đã xử lý (hoặc bỏ qua) → lần đọc sau bắt đầu từ `id > floor`
+    - seen: id > floor đã giao (đọc lại thì bỏ qua)
+    """
+
+    def __init__(self, floor: int, grace: float = 5.0):
+        self.floor = floor
+        self.grace = grace
+        self.seen: set[int] = set()
+        self.gaps: Dict[int, float] = {}   # id còn thiếu → lúc phát hiện
+
+    def accept(self, eid: int) -> bool:
+        if eid <= self.floor or eid in self.seen:
+            return False
+        self.seen.add(eid)
+        return True
+
+    def advance(self, now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        top = max(self.seen, default=self.floor)
+        for eid in range(self.floor + 1, top):
+            if eid not in self.seen:
+                self.gaps.setdefault(eid, now)
+        while self.floor < top:
+            nxt = self.floor + 1
+            if nxt in self.seen:
+                self.seen.discard(nxt)
+                self.gaps.pop(nxt, None)
+            elif now - self.gaps.get(nxt, now) >= self.grace:
+                self.gaps.pop(nxt, None)
+            else:
+                break
+            self.floor = nxt
+
+
+class MySQLBackplane(Backplane):
+    """Ghi event vào bảng HubEvents; mỗi worker poll các id mới (kiểu LISTEN bằng polling)."""
+
+    def __init__(self, poll_sec: float, retention_sec: int = 300, gap_grace_sec: float = 5.0):
+        self.poll_sec = poll_sec
+        self.retention_sec = retention_sec
+        self.gap_grace_sec = gap_grace_sec
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, deliver: Deliver) -> None:
+        from .db import arun, max_hub_event_id
+        last_id = await arun(max_hub_event_id)   # chỉ nhận event phát sau khi worker lên
+        self._task = asyncio.create_task(self._poll(deliver, last_id))
+
+    async def _poll(self, deliver: Deliver, last_id: int) -> None:
+        from .db import arun, fetch_hub_events, purge_hub_events
+        cursor = IdCursor(last_id, self.gap_grace_sec)
+        last_purge = time.monotonic()
+        while True:
+            await asyncio.sleep(self.poll_sec)
+            try:
+                for eid, payload in await arun(fetch_hub_events, cursor.floor):
+                    if cursor.accept(eid):
+                        await deliver(json.loads(payload))
+                cursor.advance()
+                if time.monotonic() - last_purge > self.retention_sec:
+                    await arun(purge_hub_events, self.retention_sec)
+                    last_purge = time.monotonic()
+            except Exception:
+                logger.exception("hub poll failed")
+
+    async def publish(self, event: dict) -> None:
+        from .db import arun, insert_hub_event
+        await arun(insert_hub_event, json.dumps(event, ensure_ascii=False))
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+
+
+class RedisBackplane(Backplane):
+    """PUBLISH/SUBSCRIBE qua Redis (hoặc server tương thích giao thức Redis chạy local)."""
+
+    def __init__(self, url: str, channel: str):
+        try:
+            import redis.asyncio as aioredis
+        except ImportError as e:
+            raise RuntimeError("HUB_BACKPLANE=redis cần cài gói `redis` (pip install redis)") from e
+        self.r = aioredis.Redis.from_url(url)
+        self.channel = channel
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, deliver: Deliver) -> None:
+        pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(self.channel)
+        self._task = asyncio.create_task(self._listen(pubsub, deliver))
+
+    async def _listen(self, pubsub, deliver: Deliver) -> None:
+        try:
+            async for msg in pubsub.listen():
+                try:
+                    await deliver(json.loads(msg["data"]))
+                except Exception:
+                    logger.exception("hub deliver failed")
+        finally:
+            await pubsub.aclose()
+
+    async def publish(self, event: dict) -> None:
+        await self.r.publish(self.channel, json.dumps(event, ensure_ascii=False))
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+        await self.r.aclose()
+
+
+def backplane_from_settings() -> Backplane:
+    kind = (settings.hub_backplane or "local").lower()
+    if kind == "mysql":
+        return MySQLBackplane(poll_sec=settings.hub_poll_ms / 1000.0)
+    if kind == "redis":
+        return RedisBackplane(settings.redis_url, settings.hub_channel)
+    return Backplane()
+
+
+class _Conn:
+    """1 socket: hàng đợi gửi có giới hạn + 1 task writer riêng (socket chậm không chặn ai)."""
+    __slots__ = ("ws", "key", "queue", "wake", "task", "dropped", "paused")
+
+    def __init__(self, ws: WebSocket, key: Optional[str], paused: bool = False):
+        self.ws = ws
+        self.key = key              # session_id; None = admin
+        self.queue: deque = deque() # (enqueued_at, coalesce_key, text)
+        self.wake = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.dropped = 0
+        self.paused = paused        # True: gom event live, chưa gửi (chờ replay xong)
+
+
 class Hub:
-    def __init__(self):
-        self.user_channels: Dict[str, Set[WebSocket]] = {}
-        self.admin_channels: Set[WebSocket] = set()
+    """
+    Fan-out WebSocket:
+    - message được json.dumps 1 lần cho cả broadcast, đẩy vào hàng đợi từng socket (không await mạng)
+    - socket đầy hàng đợi xử lý theo policy: 'drop_oldest' | 'coalesce' (bỏ bản cũ cùng type) | 'disconnect'
+    - writer gửi quá hạn/lỗi → socket bị dọn khỏi kênh và đóng
+    """
+
+    def __init__(self, backplane: Optional[Backplane] = None, queue_size: int = 64,
+                 send_timeout: float = 5.0, slow_policy: str = "drop_oldest"):
+        self.user_channels: Dict[str, Dict[WebSocket, _Conn]] = {}
+        self.admin_channels: Dict[WebSocket, _Conn] = {}
+        self.backplane = backplane or Backplane()
+        self.origin = uuid.uuid4().hex[:12]   # id worker: bỏ qua event của chính mình khi nhận lại
+        # worker khác báo Books vừa đổi → handler (main: catalog.refresh) chạy ở worker này
+        self.on_catalog: Optional[Callable[[dict], Awaitable[None]]] = None
+        self.queue_size = max(1, queue_size)
+        self.send_timeout = send_timeout
+        self.slow_policy = slow_policy
+        self._m = {"fanouts": 0, "enqueued": 0, "sent": 0, "dropped": 0, "reaped": 0,
+                   "fanout_us_total": 0.0, "fanout_us_max": 0.0, "deliver_ms_total": 0.0, "deliver_ms_max": 0.0}
+
+    async def start(self):
+        await self.backplane.start(self._on_event)
+
+    async def stop(self):
+        await self.backplane.stop()
+        for c in [*self.admin_channels.values(), *(c for ch in self.user_channels.values() for c in ch.values())]:
+            if c.task:
+                c.task.cancel()
+
+    # ----- kết nối -----
+    def _open(self, ws: WebSocket, key: Optional[str], paused: bool = False) -> _Conn:
+        c = _Conn(ws, key, paused)
+        c.task = asyncio.create_task(self._writer(c))
+        return c
+
+    def _detach(self, c: _Conn) -> bool:
+        if c.key is None:
+            found = self.admin_channels.pop(c.ws, None) is not None
+        else:
+            ch = self.user_channels.get(c.key) or {}
+            found = ch.pop(c.ws, None) is not None
+            if not ch:
+                self.user_channels.pop(c.key, None)
+        if c.task and c.task is not asyncio.current_task():
+            c.task.cancel()
+        return found
 
     async def connect_user(self, session_id: str, ws: WebSocket):
         await ws.accept()
-        self.user_channels.setdefault(session_id, set()).add(ws)
+        self.user_channels.setdefault(session_id, {})[ws] = self._open(ws, session_id)
 
     async def disconnect_user(self, session_id: str, ws: WebSocket):
-        s = self.user_channels.get(session_id)
-        if s and ws in s:
-            s.remove(ws)
+        c = (self.user_channels.get(session_id) or {}).get(ws)
+        if c:
+            self._detach(c)
 
-    async def connect_admin(self, ws: WebSocket):
+    async def connect_admin(self, ws: WebSocket, paused: bool = False):
+        """paused=True: nhận event live vào hàng đợi nhưng chưa gửi, đến khi resume_admin (replay trước)."""
         await ws.accept()
-        self.admin_channels.add(ws)
+        self.admin_channels[ws] = self._open(ws, None, paused)
+
+    async def resume_admin(self, ws: WebSocket, first: list[dict] | None = None):
+        c = self.admin_channels.get(ws)
+        if not c:
+            return
+        now = time.monotonic()
+        for message in reversed(first or []):
+            c.queue.appendleft((now, None, json.dumps(message, separators=(",", ":"), ensure_ascii=False)))
+        c.paused = False
+        c.wake.set()
 
     async def disconnect_admin(self, ws: WebSocket):
-        if ws in self.admin_channels:
-            self.admin_channels.remove(ws)
+        c = self.admin_channels.get(ws)
+        if c:
+            self._detach(c)
 
-    async def send_to_user(self, session_id: str, message: dict):
-        for ws in list(self.user_channels.get(session_id, [])):
+    # ----- phát cho mọi worker: giao ngay socket local, rồi đẩy lên backplane -----
+    async def publish_user(self, session_id: str, message: dict):
+        await self.send_to_user(session_id, message)
+        await self._publish({"target": "user", "session_id": session_id, "message": message})
+
+    async def publish_admin(self, message: dict):
+        await self.broadcast_admin(message)
+        await self._publish({"target": "admin", "message": message})
+
+    async def publish_catalog(self, message: dict):
+        """Chỉ gửi cho worker khác (worker này đã tự cập nhật snapshot/cache)."""
+        await self._publish({"target": "catalog", "message": message})
+
+    async def _publish(self, event: dict):
+        try:
+            await self.backplane.publish({"origin": self.origin, **event})
+        except Exception:
+            # socket local đã nhận; worker khác lỡ event này (client vẫn thấy qua lịch sử chat)
+            logger.exception("hub publish failed")
+
+    async def _on_event(self, event: dict):
+        if event.get("origin") == self.origin:
+            return
+        if event.get("target") == "user":
+            await self.send_to_user(event.get("session_id") or "", event.get("message") or {})
+        elif event.get("target") == "admin":
+            await self.broadcast_admin(event.get("message") or {})
+        elif event.get("target") == "catalog" and self.on_catalog is not None:
             try:
-                await ws.send_json(message)
-            except:
-                pass
+                await self.on_catalog(event.get("message") or {})
+            except Exception:
+                logger.exception("catalog event handler failed")
+
+    # ----- giao cho socket trong process này -----
+    async def send_to_user(self, session_id: str, message: dict):
+        self._fanout(list((self.user_channels.get(session_id) or {}).values()), message)
 
     async def broadcast_admin(self, message: dict):
-        for ws in list(self.admin_channels):
-            try:
-                await ws.send_json(message)
-            except:
-                pass
+        self._fanout(list(self.admin_channels.values()), message)
+
+    def _fanout(self, conns, message: dict) -> None:
+        if not conns:
+            return
+        t0 = time.perf_counter()
+        # cùng định dạng với WebSocket.send_json, nhưng chỉ serialize 1 lần
+        data = json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+        ckey = message.get("type")
+        now = time.monotonic()
+        for c in conns:
+            self._enqueue(c, (now, ckey, data))
+        us = (time.perf_counter() - t0) * 1e6
+        m = self._m
+        m["fanouts"] += 1
+        m["fanout_us_total"] += us
+        m["fanout_us_max"] = max(m["fanout_us_max"], us)
+
+    def _enqueue(self, c: _Conn, item: tuple) -> None:
+        q = c.queue
+        if len(q) >= self.queue_size:
+            if self.slow_policy == "disconnect":
+                self._reap(c)
+                return
+            victim = 0
+            if self.slow_policy == "coalesce" and item[1] is not None:
+                victim = next((i for i, old in enumerate(q) if old[1] == item[1]), 0)
+            del q[victim]
+            c.dropped += 1
+            self._m["dropped"] += 1
+        q.append(item)
+        self._m["enqueued"] += 1
+        if not c.paused:
+            c.wake.set()
+
+    def _reap(self, c: _Conn) -> None:
+        if self._detach(c):
+            self._m["reaped"] += 1
+            asyncio.create_task(self._close(c.ws))
+
+    @staticmethod
+    async def _close(ws: WebSocket) -> None:
+        try:
+            await ws.close()
+        except Exception:
+            pass
+
+    async def _writer(self, c: _Conn) -> None:
+        m = self._m
+        while True:
+            await c.wake.wait()
+            c.wake.clear()
+            while c.queue:
+                ts, _, data = c.queue.popleft()
+                try:
+                    await asyncio.wait_for(c.ws.send_text(data), self.send_timeout)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    # socket chết hoặc quá chậm → dọn
+                    self._reap(c)
+                    return
+                ms = (time.monotonic() - ts) * 1000
+                m["sent"] += 1
+                m["deliver_ms_total"] += ms
+                m["deliver_ms_max"] = max(m["deliver_ms_max"], ms)
+
+    def stats(self) -> dict:
+        conns = [*self.admin_channels.values(), *(c for ch in self.user_channels.values() for c in ch.values())]
+        m = self._m
+        return {
+            "backplane": type(self.backplane).__name__, "policy": self.slow_policy,
+            "user_sockets": len(conns) - len(self.admin_channels), "admin_sockets": len(self.admin_channels),
+            "queued": sum(len(c.queue) for c in conns), "queue_max": max((len(c.queue) for c in conns), default=0),
+            "fanouts": m["fanouts"], "enqueued": m["enqueued"], "sent": m["sent"],
+            "dropped": m["dropped"], "reaped": m["reaped"],
+            "fanout_us_avg": round(m["fanout_us_total"] / m["fanouts"], 1) if m["fanouts"] else 0.0,
+            "fanout_us_max": round(m["fanout_us_max"], 1),
+            "deliver_ms_avg": round(m["deliver_ms_total"] / m["sent"], 2) if m["sent"] else 0.0,
+            "deliver_ms_max": round(m["deliver_ms_max"], 2),
+        }
 
-hub = Hub()
+hub = Hub(backplane_from_settings(), queue_size=settings.ws_queue_size,
+          send_timeout=settings.ws_send_timeout, slow_policy=settings.ws_slow_policy)
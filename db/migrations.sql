@@ -0,0 +1,41 @@
+-- Nâng cấp DB đã tạo từ schema.sql cũ (chạy 1 lần, theo thứ tự).
+use bookstore;
+
+-- Catalog snapshot: refresh tăng dần theo thời điểm sửa
+ALTER TABLE Books
+  ADD COLUMN updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  ADD KEY idx_books_updated (updated_at);
+
+-- Session store dùng chung giữa các worker (SESSION_STORE=mysql)
+CREATE TABLE IF NOT EXISTS ChatState (
+  session_id VARCHAR(64) PRIMARY KEY,
+  data JSON NOT NULL,
+  updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  KEY idx_chatstate_updated (updated_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Backplane WebSocket giữa các worker (HUB_BACKPLANE=mysql): worker ghi, mọi worker poll theo id
+CREATE TABLE IF NOT EXISTS HubEvents (
+  id BIGINT AUTO_INCREMENT PRIMARY KEY,
+  payload JSON NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  KEY idx_hub_created (created_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Tóm tắt session cho trang admin; chạy xong thì backfill: python -m app.backfill_sessions
+ALTER TABLE ChatSessions
+  ADD COLUMN last_time TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  ADD COLUMN msg_count INT NOT NULL DEFAULT 0,
+  ADD KEY idx_sessions_last (last_time);
+
+-- Trang admin: phân trang keyset theo (status, created_at); index cũ chỉ có status là thừa
+CREATE INDEX idx_orders_status_created ON Orders (status, created_at);
+DROP INDEX idx_orders_status ON Orders;
+
+-- Feed sự kiện đơn hàng cho admin (seq tăng dần → client kết nối lại tiếp tục từ seq cuối)
+CREATE TABLE IF NOT EXISTS OrderEvents (
+  seq BIGINT AUTO_INCREMENT PRIMARY KEY,
+  payload JSON NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  KEY idx_order_events_created (created_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -7,7 +7,9 @@ CREATE TABLE IF NOT EXISTS Books (
   price INT NOT NULL,
   stock INT NOT NULL DEFAULT 0,
   category VARCHAR(100) NOT NULL,
-  FULLTEXT KEY ft_title_author (title, author)
+  updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  FULLTEXT KEY ft_title_author (title, author),
+  KEY idx_books_updated (updated_at)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
 CREATE TABLE IF NOT EXISTS Orders (
@@ -24,13 +26,17 @@ CREATE TABLE IF NOT EXISTS Orders (
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
 CREATE INDEX idx_orders_phone ON Orders (phone);
-CREATE INDEX idx_orders_status ON Orders (status);
+CREATE INDEX idx_orders_status_created ON Orders (status, created_at);
 CREATE INDEX idx_orders_created ON Orders (created_at);
 
 
 CREATE TABLE IF NOT EXISTS ChatSessions (
   session_id VARCHAR(64) PRIMARY KEY,
-  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  -- tóm tắt (cập nhật khi ghi ChatMessages) cho danh sách session ở trang admin
+  last_time TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  msg_count INT NOT NULL DEFAULT 0,
+  KEY idx_sessions_last (last_time)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
 CREATE TABLE IF NOT EXISTS ChatMessages (
@@ -42,3 +48,27 @@ CREATE TABLE IF NOT EXISTS ChatMessages (
   INDEX idx_chat_session (session_id),
   FOREIGN KEY (session_id) REFERENCES ChatSessions(session_id) ON DELETE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Trạng thái hội thoại (slots, state) khi SESSION_STORE=mysql
+CREATE TABLE IF NOT EXISTS ChatState (
+  session_id VARCHAR(64) PRIMARY KEY,
+  data JSON NOT NULL,
+  updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  KEY idx_chatstate_updated (updated_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Backplane WebSocket giữa các worker (HUB_BACKPLANE=mysql): worker ghi, mọi worker poll theo id
+CREATE TABLE IF NOT EXISTS HubEvents (
+  id BIGINT AUTO_INCREMENT PRIMARY KEY,
+  payload JSON NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  KEY idx_hub_created (created_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Feed sự kiện đơn hàng cho admin (seq tăng dần → client kết nối lại tiếp tục từ seq cuối)
+CREATE TABLE IF NOT EXISTS OrderEvents (
+  seq BIGINT AUTO_INCREMENT PRIMARY KEY,
+  payload JSON NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  KEY idx_order_events_created (created_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
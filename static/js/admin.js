@@ -13,6 +13,8 @@
       const key = btn.dataset.tab;
       Object.values(panels).forEach(p=>p && p.classList.remove('active'));
       if (panels[key]) panels[key].classList.add('active');
+      // panel khác (book.js, ...) tự tải dữ liệu lần đầu được mở
+      document.dispatchEvent(new CustomEvent('admin:tab', { detail: key }));
     });
   });
 
@@ -23,6 +25,7 @@
     approved: document.getElementById('sub-approved'),
     cancelled: document.getElementById('sub-cancelled'),
   };
+  let currentStatus = 'pending';
   subtabs.forEach(btn=>{
     btn.addEventListener('click', ()=>{
       subtabs.forEach(b=>b.classList.remove('active'));
@@ -30,36 +33,209 @@
       const key = btn.dataset.subtab;
       Object.values(subpanels).forEach(p=>p && p.classList.remove('active'));
       if (subpanels[key]) subpanels[key].classList.add('active');
+      currentStatus = key;
+      if (!orders[key].loaded) loadOrders(key, true);
     });
   });
 
-  // WS for admin (new orders)
+  // ----- Orders: tải lười từng trang qua /admin/api/orders (ETag → trình duyệt nhận 304 khi không đổi) -----
+  const $search = document.getElementById('orders-search');
+  const orders = {
+    pending:   { cursor: null, loaded: false },
+    approved:  { cursor: null, loaded: false },
+    cancelled: { cursor: null, loaded: false },
+  };
+  const money = v => `${Number(v || 0).toLocaleString('en-US')}đ`;
+
+  function orderRow(o, status){
+    const tr = document.createElement('tr');
+    tr.dataset.id = o.order_id;
+    [o.order_id, o.customer_name, o.phone, o.title, o.quantity, money(o.total), o.created_at].forEach(v=>{
+      const td = document.createElement('td');
+      td.textContent = v ?? '';
+      tr.appendChild(td);
+    });
+    if (status === 'pending'){
+      const td = document.createElement('td');
+      td.className = 'actions';
+      td.innerHTML = `
+        <button class="btn btn-approve" type="button">Duyệt</button>
+        <button class="btn btn-cancel" type="button">Hủy</button>`;
+      td.querySelector('.btn-approve').addEventListener('click', ()=> approve(o.order_id));
+      td.querySelector('.btn-cancel').addEventListener('click', ()=> cancelOrder(o.order_id));
+      tr.appendChild(td);
+    }
+    return tr;
+  }
+
+  async function loadOrders(status, reset){
+    const st = orders[status];
+    const $tbody = document.getElementById(`orders-${status}`);
+    const $more = document.querySelector(`[data-more="${status}"]`);
+    if (!$tbody) return;
+    if (reset){ st.cursor = null; }
+    const qs = new URLSearchParams({ status });
+    const q = $search ? $search.value.trim() : '';
+    if (q) qs.set('q', q);
+    if (st.cursor) qs.set('cursor', st.cursor);
+    try{
+      const res = await fetch(`/admin/api/orders?${qs}`);
+      const data = await res.json();
+      if (reset) $tbody.innerHTML = '';
+      const frag = document.createDocumentFragment();
+      (data.items || []).forEach(o => frag.appendChild(orderRow(o, status)));
+      $tbody.appendChild(frag);
+      st.cursor = data.next_cursor;
+      st.loaded = true;
+      if ($more) $more.hidden = !data.next_cursor;
+    }catch{
+      if (reset) $tbody.innerHTML = '<tr><td colspan="8" class="muted">Không tải được danh sách đơn.</td></tr>';
+    }
+  }
+
+  const counts = { pending: 0, approved: 0, cancelled: 0 };
+  function renderCounts(){
+    Object.entries(counts).forEach(([k, n])=>{
+      const el = document.querySelector(`[data-count="${k}"]`);
+      if (el) el.textContent = n;
+    });
+  }
+
+  async function loadCounts(){
+    try{
+      const res = await fetch('/admin/api/orders/counts');
+      const data = await res.json();
+      Object.assign(counts, data.counts || {});
+      renderCounts();
+      return data.seq;
+    }catch{
+      return null;
+    }
+  }
+
+  document.querySelectorAll('[data-more]').forEach(btn=>
+    btn.addEventListener('click', ()=> loadOrders(btn.dataset.more, false)));
+
+  let searchTimer = null;
+  $search && $search.addEventListener('input', ()=>{
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(()=>{
+      Object.values(orders).forEach(st=> st.loaded = false);
+      loadOrders(currentStatus, true);
+    }, 300);
+  });
+
+  // ----- Feed /ws/admin: áp từng event vào bảng; kết nối lại với ?since=<seq> để nhận bù -----
   const wsState = document.getElementById('wsstate');
+  // baseSeq: seq của ảnh chụp số liệu/bảng đã tải (event <= baseSeq đã nằm trong đó)
+  let lastSeq = null, baseSeq = 0, wsOpen = false;
+  const seen = new Set();
+
+  function upsertOrderRow(o, status){
+    const st = orders[status];
+    const $tbody = document.getElementById(`orders-${status}`);
+    if (!o || !st || !st.loaded || !$tbody) return;
+    if ($search && $search.value.trim()){ st.loaded = false; return; }   // đang lọc: tải lại khi mở
+    if ($tbody.querySelector(`tr[data-id="${o.order_id}"]`)) return;
+    const tr = orderRow(o, status);
+    tr.classList.add('tr-highlight');
+    setTimeout(()=> tr.classList.remove('tr-highlight'), 1000);
+    $tbody.prepend(tr);
+  }
+  function removeOrderRow(orderId, status){
+    const tr = document.querySelector(`#orders-${status} tr[data-id="${orderId}"]`);
+    tr && tr.remove();
+  }
+  function moveCount(from, to){
+    if (from && counts[from] > 0) counts[from]--;
+    if (to) counts[to]++;
+    renderCounts();
+  }
+  function applyStock(bookId, stock){
+    if (bookId == null || stock == null) return;
+    const cell = document.querySelector(`#books-table tr[data-id="${bookId}"] .c-stock`);
+    if (cell) cell.textContent = stock;
+  }
+
+  async function resync(){
+    Object.values(orders).forEach(st=> st.loaded = false);
+    lastSeq = await loadCounts();
+    baseSeq = lastSeq || 0;
+    seen.clear();
+    loadOrders(currentStatus, true);
+  }
+
+  function applyEvent(msg){
+    if (msg.seq != null && msg.type !== 'hello'){
+      // bản trùng giữa replay và live; replay đọc lùi vài seq (seq nhỏ có thể commit muộn)
+      if (seen.has(msg.seq) || msg.seq <= baseSeq) return;
+      seen.add(msg.seq);
+      if (seen.size > 1000) seen.delete(seen.values().next().value);
+      lastSeq = Math.max(lastSeq || 0, msg.seq);
+    }
+    switch (msg.type){
+      case 'hello':
+        if (msg.seq != null) lastSeq = Math.max(lastSeq || 0, msg.seq);
+        break;
+      case 'resync':
+        resync();
+        break;
+      case 'order_created':
+        moveCount(null, 'pending');
+        upsertOrderRow(msg.order, 'pending');
+        break;
+      case 'order_approved':
+      case 'order_cancelled': {
+        const to = msg.type === 'order_approved' ? 'approved' : 'cancelled';
+        if (msg.from_status) removeOrderRow(msg.order_id, msg.from_status);
+        moveCount(msg.from_status, to);
+        upsertOrderRow(msg.order, to);
+        applyStock(msg.book_id, msg.stock);
+        break;
+      }
+    }
+  }
+
   function connectWS(){
-    const ws = new WebSocket(`ws://${location.host}/ws/admin`);
-    ws.onopen = ()=> wsState && (wsState.textContent = 'connected');
-    ws.onclose = ()=> { if (wsState) wsState.textContent = 'disconnected'; setTimeout(connectWS, 1500); };
+    const qs = lastSeq != null ? `?since=${lastSeq}` : '';
+    const ws = new WebSocket(`ws://${location.host}/ws/admin${qs}`);
+    ws.onopen = ()=> { wsOpen = true; wsState && (wsState.textContent = 'connected'); };
+    ws.onclose = ()=> {
+      wsOpen = false;
+      if (wsState) wsState.textContent = 'disconnected';
+      setTimeout(connectWS, 1500);
+    };
     ws.onmessage = (ev)=>{
-      try{
-        const msg = JSON.parse(ev.data);
-        if(msg.type === 'new_order'){
-          alert(`Có đơn mới #${msg.order_id}`);
-          location.reload();
-        }
-      }catch{}
+      try{ applyEvent(JSON.parse(ev.data)); }catch{}
     };
   }
-  if (wsState) connectWS();
 
-  // Order actions
+  // Order actions: bỏ dòng khỏi pending ngay; số liệu/bảng đích cập nhật theo event feed
+  function afterAction(orderId, target){
+    removeOrderRow(orderId, 'pending');
+    if (!wsOpen){
+      orders[target].loaded = false;
+      loadCounts();
+    }
+  }
   window.approve = async function(orderId){
     const r = await fetch(`/admin/orders/${orderId}/approve`, {method:'POST'});
     const d = await r.json();
-    if(d.ok) location.reload(); else alert(d.message || 'Không duyệt được');
+    if(d.ok) afterAction(orderId, 'approved'); else alert(d.message || 'Không duyệt được');
   }
   window.cancelOrder = async function(orderId){
     const r = await fetch(`/admin/orders/${orderId}/cancel`, {method:'POST'});
     const d = await r.json();
-    if(d.ok) location.reload(); else alert(d.message || 'Không hủy được');
+    if(d.ok) afterAction(orderId, 'cancelled'); else alert(d.message || 'Không hủy được');
+  }
+
+  if (panels.orders){
+    loadOrders('pending', true);
+    // seq đọc cùng số liệu → feed bắt đầu đúng từ thời điểm đó
+    loadCounts().then(seq=>{
+      lastSeq = seq;
+      baseSeq = seq || 0;
+      if (wsState) connectWS();
+    });
   }
 })();
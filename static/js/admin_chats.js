@@ -33,11 +33,20 @@
     }
   }
 
+  // phân trang keyset: mở session lấy trang mới nhất, cuộn lên đầu thì tải trang cũ hơn
+  let current = { sid: null, firstId: null, hasMore: false, count: 0, loading: false };
+
+  async function fetchLog(sessionId, beforeId){
+    const qs = beforeId ? `?before_id=${beforeId}` : '';
+    const res = await fetch(`/admin/api/chats/${sessionId}${qs}`);
+    return res.json();
+  }
+
   async function openSession(sessionId){
     try{
-      const res = await fetch(`/admin/api/chats/${sessionId}`);
-      const data = await res.json();
+      const data = await fetchLog(sessionId);
       $sid.textContent = sessionId;
+      current = { sid: sessionId, firstId: data.first_id, hasMore: data.has_more, count: 0, loading: false };
       renderLog(data.messages || []);
     }catch{
       $sid.textContent = '—';
@@ -45,23 +54,53 @@
     }
   }
 
+  function makeBubble(m){
+    const div = document.createElement('div');
+    div.className = `bubble ${m.role === 'user' ? 'user' : 'bot'}`;
+    div.title = m.created_at || '';
+    div.textContent = m.content;
+    return div;
+  }
+
+  function renderMeta(){
+    $meta.textContent = current.count
+      ? `${current.count}${current.hasMore ? '+' : ''} tin nhắn`
+      : 'Không có tin nhắn nào trong session này.';
+  }
+
   function renderLog(messages){
     $log.innerHTML = '';
-    if (!messages.length){
-      $meta.textContent = 'Không có tin nhắn nào trong session này.';
-      return;
-    }
-    $meta.textContent = `${messages.length} tin nhắn`;
-    for (const m of messages){
-      const div = document.createElement('div');
-      div.className = `bubble ${m.role === 'user' ? 'user' : 'bot'}`;
-      div.title = m.created_at || '';
-      div.textContent = m.content;
-      $log.appendChild(div);
-    }
+    current.count = messages.length;
+    renderMeta();
+    const frag = document.createDocumentFragment();
+    for (const m of messages) frag.appendChild(makeBubble(m));
+    $log.appendChild(frag);
     $log.scrollTop = $log.scrollHeight;
   }
 
+  async function loadOlder(){
+    if (!current.hasMore || current.loading) return;
+    current.loading = true;
+    const sid = current.sid;
+    try{
+      const data = await fetchLog(sid, current.firstId);
+      if (sid !== current.sid) return;   // đã chuyển session khác
+      const prevHeight = $log.scrollHeight;
+      const frag = document.createDocumentFragment();
+      for (const m of data.messages || []) frag.appendChild(makeBubble(m));
+      $log.prepend(frag);
+      $log.scrollTop += $log.scrollHeight - prevHeight;
+      current.firstId = data.first_id;
+      current.hasMore = data.has_more;
+      current.count += (data.messages || []).length;
+      renderMeta();
+    }finally{
+      current.loading = false;
+    }
+  }
+
+  $log && $log.addEventListener('scroll', ()=>{ if ($log.scrollTop < 40) loadOlder(); });
+
   async function loadInitial(){
     const items = await fetchSessions();
     renderSessions(items);
@@ -61,20 +61,60 @@
     const tr = document.createElement('tr');
     tr.dataset.id = b.book_id;
     tr.innerHTML = `
-      <td class="c-id">${b.book_id}</td>
-      <td class="c-title">${b.title}</td>
-      <td class="c-author">${b.author}</td>
-      <td class="c-price">${b.price}</td>
-      <td class="c-stock">${b.stock}</td>
-      <td class="c-category">${b.category}</td>
+      <td class="c-id"></td>
+      <td class="c-title"></td>
+      <td class="c-author"></td>
+      <td class="c-price"></td>
+      <td class="c-stock"></td>
+      <td class="c-category"></td>
       <td class="actions">
         <button class="btn btn-sm btn-edit" type="button">Sửa</button>
         <button class="btn btn-sm btn-danger btn-delete" type="button">Xoá</button>
       </td>
     `;
+    ['id','title','author','price','stock','category'].forEach(k=>{
+      tr.querySelector(`.c-${k}`).textContent = k === 'id' ? b.book_id : b[k];
+    });
     return tr;
   }
 
+  // --------- Danh sách: tải lười khi mở tab Books, phân trang keyset qua /admin/api/books ----------
+  const $search = document.getElementById('books-search');
+  const $sort   = document.getElementById('books-sort');
+  const $more   = document.getElementById('books-more');
+  let cursor = null, loaded = false;
+
+  async function loadBooks(reset){
+    if (reset) cursor = null;
+    const [sort, order] = ($sort ? $sort.value : 'id:desc').split(':');
+    const qs = new URLSearchParams({ sort, order });
+    const q = $search ? $search.value.trim() : '';
+    if (q) qs.set('q', q);
+    if (cursor) qs.set('cursor', cursor);
+    try{
+      const res = await fetch(`/admin/api/books?${qs}`);
+      const data = await res.json();
+      if (reset) $tbody.innerHTML = '';
+      const frag = document.createDocumentFragment();
+      (data.items || []).forEach(b => frag.appendChild(renderRow(b)));
+      $tbody.appendChild(frag);
+      cursor = data.next_cursor;
+      loaded = true;
+      if ($more) $more.hidden = !cursor;
+    }catch{
+      toast('Không tải được danh sách sách');
+    }
+  }
+
+  document.addEventListener('admin:tab', e=>{ if (e.detail === 'books' && !loaded) loadBooks(true); });
+  $more && $more.addEventListener('click', ()=> loadBooks(false));
+  $sort && $sort.addEventListener('change', ()=> loadBooks(true));
+  let searchTimer = null;
+  $search && $search.addEventListener('input', ()=>{
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(()=> loadBooks(true), 300);
+  });
+
   // --------- Add ----------
   $btnAdd && $btnAdd.addEventListener('click', ()=>{
     clearForm();
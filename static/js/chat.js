@@ -35,14 +35,138 @@
     div.textContent = text;
     $messages.appendChild(div);
     $messages.scrollTop = $messages.scrollHeight;
+    return div;
+  }
+
+  function setMode(state){
+    const st = state && typeof state === 'object' ? state.state : state;
+    $mode && ($mode.textContent = (st === 'order_collect' || st === 'await_confirm')
+      ? 'Ordering' : 'Catalog');
+  }
+
+  // Gửi qua SSE (/api/chat/stream): hiện từng mẩu câu trả lời ngay khi bot đang viết.
+  async function sendStreaming(text){
+    const res = await fetch('/api/chat/stream', {
+      method: 'POST',
+      headers: {'Content-Type': 'application/json'},
+      body: JSON.stringify({ session_id: sessionId, message: text })
+    });
+    if (!res.ok || !res.body) throw new Error(`HTTP ${res.status}`);
+
+    const bubble = addBubble('…', 'bot');
+    bubble.classList.add('streaming');
+    let partial = '', buf = '', done = false;
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+
+    while (!done){
+      const chunk = await reader.read();
+      if (chunk.done) break;
+      buf += decoder.decode(chunk.value, { stream: true });
+      let idx;
+      while ((idx = buf.indexOf('\n\n')) >= 0){
+        const raw = buf.slice(0, idx); buf = buf.slice(idx + 2);
+        let ev = 'message', data = '';
+        raw.split('\n').forEach(line => {
+          if (line.startsWith('event:')) ev = line.slice(6).trim();
+          else if (line.startsWith('data:')) data += line.slice(5).trim();
+        });
+        let msg = {};
+        try { msg = JSON.parse(data || '{}'); } catch {}
+        if (ev === 'delta'){
+          partial += msg.text || '';
+          bubble.textContent = partial;
+          $messages.scrollTop = $messages.scrollHeight;
+        } else if (ev === 'done'){
+          bubble.textContent = msg.reply || partial || '[no reply]';
+          setMode(msg.state);
+          done = true;
+        } else if (ev === 'error'){
+          bubble.textContent = 'Xin lỗi, có lỗi xảy ra. Thử lại sau nhé.';
+          done = true;
+        }
+      }
+    }
+    bubble.classList.remove('streaming');
+    if (!done && !partial) bubble.textContent = '[no reply]';
+  }
+
+  // ----- Lịch sử: phân trang keyset + cache sessionStorage (reload chỉ tải tin mới) -----
+  const HIST_CACHE_MAX = 200;
+  let older = { firstId: null, hasMore: false };   // con trỏ tải tin cũ hơn
+
+  function readHistCache(id){
+    try{ return JSON.parse(sessionStorage.getItem(`chat_hist_${id}`) || 'null'); }
+    catch{ return null; }
+  }
+  function writeHistCache(id, c){
+    if (c.messages.length > HIST_CACHE_MAX){
+      c.messages = c.messages.slice(-HIST_CACHE_MAX);
+      c.firstId = c.messages[0].id; c.hasMore = true;
+    }
+    try{ sessionStorage.setItem(`chat_hist_${id}`, JSON.stringify(c)); }catch{}
+  }
+
+  function makeBubble(m){
+    const div = document.createElement('div');
+    div.className = `bubble ${m.role === 'user' ? 'user' : 'bot'}`;
+    div.textContent = m.content;
+    return div;
+  }
+
+  function renderOlderButton(){
+    let $btn = document.getElementById('load-older');
+    if (!older.hasMore){ $btn && $btn.remove(); return; }
+    if (!$btn){
+      $btn = document.createElement('button');
+      $btn.id = 'load-older'; $btn.type = 'button'; $btn.className = 'btn';
+      $btn.textContent = 'Tải tin cũ hơn';
+      $btn.addEventListener('click', loadOlder);
+    }
+    $messages.prepend($btn);
+  }
+
+  async function loadOlder(){
+    if (!older.hasMore || !older.firstId) return;
+    const res = await fetch(`/api/chat/history?session_id=${sessionId}&before_id=${older.firstId}`);
+    const data = await res.json();
+    const prevHeight = $messages.scrollHeight;
+    const frag = document.createDocumentFragment();
+    (data.messages || []).forEach(m => frag.appendChild(makeBubble(m)));
+    const $btn = document.getElementById('load-older');
+    $messages.insertBefore(frag, $btn ? $btn.nextSibling : $messages.firstChild);
+    $messages.scrollTop += $messages.scrollHeight - prevHeight;   // giữ nguyên vị trí đang đọc
+    older = { firstId: data.first_id, hasMore: data.has_more };
+    renderOlderButton();
   }
 
   async function loadHistory(id = sessionId){
     try{
-      const res = await fetch(`/api/chat/history?session_id=${id}`);
-      const data = await res.json();
+      let cache = readHistCache(id);
+      let pending = [];   // tin server chưa ghi xong (chưa có id) → chỉ hiển thị, không lưu cache
+      if (cache && cache.lastId){
+        const res = await fetch(`/api/chat/history?session_id=${id}&after_id=${cache.lastId}`);
+        const data = await res.json();
+        cache.messages = cache.messages.concat(data.messages || []);
+        cache.lastId = data.last_id || cache.lastId;
+        pending = data.pending || [];
+        if (data.has_more) cache = null;   // quá nhiều tin mới → lấy lại trang mới nhất
+      }
+      if (!cache || !cache.lastId){
+        const res = await fetch(`/api/chat/history?session_id=${id}`);
+        const data = await res.json();
+        cache = { messages: data.messages || [], firstId: data.first_id, lastId: data.last_id || 0, hasMore: data.has_more };
+        pending = data.pending || [];
+      }
+      writeHistCache(id, cache);
+      older = { firstId: cache.firstId, hasMore: cache.hasMore };
+
+      const frag = document.createDocumentFragment();
+      cache.messages.concat(pending).forEach(m => frag.appendChild(makeBubble(m)));
       $messages.innerHTML = '';
-      (data.messages || []).forEach(m => addBubble(m.content, m.role === 'user' ? 'user' : 'bot'));
+      $messages.appendChild(frag);
+      renderOlderButton();
+      $messages.scrollTop = $messages.scrollHeight;
     }catch{
       addBubble('Không tải được lịch sử chat.', 'bot');
     }
@@ -55,6 +179,10 @@
     addBubble(text, 'user');
     $input.value = '';
     try {
+      if (window.ReadableStream && window.TextDecoder){
+        await sendStreaming(text);
+        return;
+      }
       const res = await fetch('/api/chat', {
         method: 'POST',
         headers: {'Content-Type': 'application/json'},
@@ -62,8 +190,7 @@
       });
       const data = await res.json();
       addBubble(data.reply || '[no reply]', 'bot');
-      $mode && ($mode.textContent = (data.state === 'order_collect' || data.state === 'await_confirm')
-        ? 'Ordering' : 'Catalog');
+      setMode(data.state);
     } catch {
       addBubble('Xin lỗi, có lỗi mạng. Thử lại sau nhé.', 'bot');
     }
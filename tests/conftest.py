@@ -0,0 +1,11 @@
+# tests/conftest.py
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)   # app.main mount static/ và templates/ theo đường dẫn tương đối
+
+# không đụng vào .chroma của repo khi import app.services.rag
+os.environ.setdefault("CHROMA_DIR", tempfile.mkdtemp(prefix="chroma-test-"))
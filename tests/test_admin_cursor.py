@@ -0,0 +1,21 @@
+# tests/test_admin_cursor.py
+import pytest
+
+from app.main import _decode_cursor, _encode_cursor
+
+
+@pytest.mark.parametrize("value, row_id", [
+    ("2026-10-17 08:30:00", 42),
+    (150000, 7),
+    ("Dế Mèn phiêu lưu ký", 1),
+    (None, 3),
+])
+def test_cursor_round_trip(value, row_id):
+    cur = _encode_cursor(value, row_id)
+    assert "=" not in cur and "/" not in cur and "+" not in cur    # an toàn trong query string
+    assert _decode_cursor(cur) == (value, row_id)
+
+
+@pytest.mark.parametrize("bad", ["", None, "not-base64!!", "W10", "eyJhIjoxfQ"])   # "[]", {"a":1}
+def test_bad_cursor_is_ignored(bad):
+    assert _decode_cursor(bad) is None
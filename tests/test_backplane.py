@@ -0,0 +1,81 @@
+# tests/test_backplane.py
+import asyncio
+import json
+
+import app.db
+from app.services import order_feed as feed_mod
+from app.services.order_feed import OrderFeed
+from app.ws import IdCursor, MySQLBackplane
+
+
+def test_cursor_waits_for_late_commit():
+    c = IdCursor(floor=10, grace=5.0)
+    assert c.accept(11) and c.accept(13)
+    c.advance(now=100.0)
+    assert c.floor == 11                      # 12 chưa commit: không nhảy qua
+    assert c.accept(12)                       # 12 commit muộn vẫn được giao
+    assert not c.accept(13)                   # đọc lại 13 → bỏ qua
+    c.advance(now=101.0)
+    assert c.floor == 13 and not c.seen and not c.gaps
+
+
+def test_cursor_skips_rolled_back_id_after_grace():
+    c = IdCursor(floor=0, grace=5.0)
+    c.accept(1), c.accept(3)
+    c.advance(now=0.0)
+    assert c.floor == 1
+    c.advance(now=4.9)
+    assert c.floor == 1
+    c.advance(now=5.0)
+    assert c.floor == 3
+
+
+def test_mysql_backplane_delivers_out_of_order_commits(monkeypatch):
+    table = {}                                 # id → payload đã commit
+
+    async def arun(fn, *args):
+        return fn(None, *args)
+
+    def fetch(conn, after_id, limit=500):
+        return sorted((i, p) for i, p in table.items() if i > after_id)[:limit]
+
+    monkeypatch.setattr(app.db, "arun", arun)
+    monkeypatch.setattr(app.db, "fetch_hub_events", fetch)
+    monkeypatch.setattr(app.db, "purge_hub_events", lambda conn, s: 0)
+    got = []
+
+    async def deliver(ev):
+        got.append(ev["n"])
+
+    async def main():
+        bp = MySQLBackplane(poll_sec=0.01)
+        task = asyncio.create_task(bp._poll(deliver, 0))
+        table[1] = json.dumps({"n": 1})
+        table[3] = json.dumps({"n": 3})       # id 2 cấp trước nhưng commit sau
+        await asyncio.sleep(0.05)
+        table[2] = json.dumps({"n": 2})
+        await asyncio.sleep(0.05)
+        task.cancel()
+
+    asyncio.run(main())
+    assert sorted(got) == [1, 2, 3] and len(got) == 3
+
+
+def test_order_replay_reads_overlap_window(monkeypatch):
+    rows = {s: json.dumps({"type": "order_created", "order_id": s}) for s in range(1, 21)}
+    calls = []
+
+    async def arun(fn, *args):
+        if fn is feed_mod.order_events_bounds:
+            return 1, 20
+        calls.append(args)
+        since, limit = args
+        return [(s, rows[s]) for s in sorted(rows) if s > since][:limit]
+
+    monkeypatch.setattr(feed_mod, "arun", arun)
+    feed = OrderFeed(replay_limit=100, overlap=5)
+    events, latest = asyncio.run(feed.replay(18))
+    assert latest == 20
+    assert [e["seq"] for e in events] == list(range(14, 21))
+    events, latest = asyncio.run(feed.replay(20))   # đã mới nhất: vẫn đọc lại cửa sổ
+    assert [e["seq"] for e in events] == list(range(16, 21))
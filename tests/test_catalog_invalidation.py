@@ -0,0 +1,86 @@
+# tests/test_catalog_invalidation.py
+import asyncio
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import StaticPool
+
+from app.services import catalog as catalog_mod
+from app.services.catalog import CatalogSnapshot
+from app.services.rag import SearchResultCache, retriever
+from app.ws import Hub
+
+
+@pytest.fixture
+def db(monkeypatch):
+    eng = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    with eng.begin() as c:
+        c.execute(text("""CREATE TABLE Books(book_id INTEGER PRIMARY KEY, title TEXT, author TEXT,
+                          price INTEGER, stock INTEGER, category TEXT, updated_at TEXT)"""))
+        c.execute(text("INSERT INTO Books VALUES (1, 'Dế Mèn', 'Tô Hoài', 50000, 5, 'Thiếu nhi', '2026-01-01 00:00:00'),"
+                       " (2, 'Harry Potter', 'J.K. Rowling', 90000, 3, 'Phiêu lưu', '2026-01-01 00:00:00')"))
+
+    @contextmanager
+    def db_conn():
+        with eng.connect() as conn:
+            yield conn
+            conn.commit()
+
+    monkeypatch.setattr(catalog_mod, "db_conn", db_conn)
+    return eng
+
+
+def _other_worker_writes(eng, sql):
+    with eng.begin() as c:
+        c.execute(text(sql))
+
+
+def test_refresh_reports_changes_from_other_workers(db):
+    snap = CatalogSnapshot()
+    events = []
+    snap.subscribe(lambda ids, content: events.append((ids, content)))
+    snap.load()
+    assert events == []
+    snap.refresh()                                    # không đổi gì → không báo
+    assert events == []
+    _other_worker_writes(db, "UPDATE Books SET stock=4, updated_at='2026-01-01 00:00:05' WHERE book_id=1")
+    snap.refresh()
+    assert events == [([1], False)]
+    _other_worker_writes(db, "UPDATE Books SET title='Harry Potter 2', updated_at='2026-01-01 00:00:09' WHERE book_id=2")
+    snap.refresh()
+    assert events[-1] == ([2], True)
+    _other_worker_writes(db, "DELETE FROM Books WHERE book_id=1")
+    snap.refresh()
+    assert events[-1] == (None, True)
+
+
+def test_retriever_drops_cached_results_on_catalog_change():
+    cache = SearchResultCache(maxsize=16, ttl=60)
+    cache.put("dế mèn", 5, [{"book_id": 1}], cache.version)
+    cache.put("harry", 5, [{"book_id": 2}], cache.version)
+    orig, retriever.result_cache = retriever.result_cache, cache
+    try:
+        retriever._on_catalog_change([1], False)
+        assert cache.get("dế mèn", 5) is None and cache.get("harry", 5) is not None
+        retriever._on_catalog_change([2], True)
+        assert cache.get("harry", 5) is None
+    finally:
+        retriever.result_cache = orig
+
+
+def test_hub_dispatches_catalog_events_from_other_workers():
+    hub = Hub()
+    got = []
+
+    async def on_catalog(msg):
+        got.append(msg)
+
+    hub.on_catalog = on_catalog
+
+    async def main():
+        await hub._on_event({"origin": "other", "target": "catalog", "message": {"book_id": 7}})
+        await hub._on_event({"origin": hub.origin, "target": "catalog", "message": {"book_id": 8}})
+
+    asyncio.run(main())
+    assert got == [{"book_id": 7}]
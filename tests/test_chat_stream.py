@@ -0,0 +1,57 @@
+# tests/test_chat_stream.py
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import main
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main.chatlog, "log", lambda *a, **k: None)
+    return TestClient(main.app)
+
+
+def _events(body: str) -> list[str]:
+    return [line[len("event: "):] for line in body.splitlines() if line.startswith("event: ")]
+
+
+@pytest.mark.parametrize("exc", [RuntimeError("boom"), asyncio.CancelledError()])
+def test_stream_always_ends_with_terminal_event(client, monkeypatch, exc):
+    async def run_agent(text, sid, on_delta=None):
+        await on_delta("xin ")
+        raise exc
+
+    monkeypatch.setattr(main, "run_agent", run_agent)
+    r = client.post("/api/chat/stream", json={"session_id": "s1", "message": "hi"})
+    assert _events(r.text) == ["delta", "error"]
+    assert "boom" not in r.text
+
+
+def test_stream_error_hides_exception_text(client, monkeypatch):
+    async def run_agent(text, sid, on_delta=None):
+        raise RuntimeError("(pymysql.err.OperationalError) Can't connect to MySQL server on 'db-internal:3306'")
+
+    monkeypatch.setattr(main, "run_agent", run_agent)
+    r = client.post("/api/chat/stream", json={"session_id": "s1", "message": "hi"})
+    assert _events(r.text) == ["error"]
+    assert "db-internal" not in r.text and "pymysql" not in r.text
+
+
+def test_stream_done(client, monkeypatch):
+    class _St:
+        def to_dict(self):
+            return {"slots": {}}
+
+    async def run_agent(text, sid, on_delta=None):
+        await on_delta("chào")
+        return "chào bạn"
+
+    async def aget_session(sid):
+        return _St()
+
+    monkeypatch.setattr(main, "run_agent", run_agent)
+    monkeypatch.setattr(main, "aget_session", aget_session)
+    r = client.post("/api/chat/stream", json={"session_id": "s1", "message": "hi"})
+    assert _events(r.text) == ["delta", "done"]
@@ -0,0 +1,105 @@
+# tests/test_chatlog.py
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from app.services import chatlog as mod
+from app.services.chatlog import ChatLogWriter
+
+
+class FakeDB:
+    def __init__(self):
+        self.rows = []
+        self.down = False
+        self.calls = 0
+
+    @contextmanager
+    def conn(self):
+        yield self
+
+    def insert(self, conn, rows):
+        self.calls += 1
+        if self.down:
+            raise OperationalError("INSERT", {}, Exception("server has gone away"))
+        if any(r["content"] == "poison" for r in rows):
+            raise IntegrityError("INSERT", {}, Exception("fk"))
+        self.rows.extend(rows)
+        return len(rows)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    d = FakeDB()
+    monkeypatch.setattr(mod, "db_conn", d.conn)
+    monkeypatch.setattr(mod, "insert_chats", d.insert)
+    return d
+
+
+def _writer(**kw):
+    w = ChatLogWriter(batch_size=10, flush_interval=60, **kw)
+    w._ensure_thread = lambda: None      # flush bằng tay trong test
+    return w
+
+
+def test_flush_writes_batch_in_order(db):
+    w = _writer()
+    for i in range(3):
+        w.log("s", "user", f"m{i}")
+    assert w.pending("s") == [{"role": "user", "content": f"m{i}"} for i in range(3)]
+    assert w.flush() == 3
+    assert [r["content"] for r in db.rows] == ["m0", "m1", "m2"]
+    assert w.stats()["commits"] == 1 and w.stats()["buffered"] == 0
+
+
+def test_poison_row_is_dead_lettered_not_retried_forever(db):
+    w = _writer()
+    for c in ("a", "poison", "b"):
+        w.log("s", "user", c)
+    assert w.flush() == 2
+    assert [r["content"] for r in db.rows] == ["a", "b"]
+    st = w.stats()
+    assert st["dead_letter"] == 1 and st["buffered"] == 0
+    w.log("s", "user", "c")
+    assert w.flush() == 1                 # các tin sau không bị chặn
+
+
+def test_db_down_requeues_and_caps_buffer(db):
+    w = _writer(max_buffer=10)
+    db.down = True
+    for i in range(8):
+        w.log("s", "user", f"m{i}")
+    with pytest.raises(OperationalError):
+        w.flush()
+    assert w.stats()["buffered"] == 8
+    for i in range(8, 12):
+        w.log("s", "user", f"m{i}")
+    st = w.stats()
+    assert st["buffered"] == 10 and st["dropped"] == 2
+    db.down = False
+    assert w.flush() == 10
+    assert [r["content"] for r in db.rows] == [f"m{i}" for i in range(2, 12)]
+
+
+def test_history_page_appends_pending_without_flushing(monkeypatch):
+    from app import main
+
+    committed = [{"id": 1, "role": "user", "content": "a", "created_at": None},
+                 {"id": 2, "role": "assistant", "content": "b", "created_at": None}]
+
+    @contextmanager
+    def conn():
+        yield None
+
+    monkeypatch.setattr(main, "db_conn", conn)
+    monkeypatch.setattr(main, "get_chat_history", lambda c, sid, **kw: [dict(r) for r in committed])
+    monkeypatch.setattr(main.chatlog, "flush", lambda: pytest.fail("history read must not flush"))
+    # "b" vừa commit giữa lúc lấy pending và đọc DB → không lặp lại
+    monkeypatch.setattr(main.chatlog, "pending", lambda sid: [{"role": "assistant", "content": "b"},
+                                                              {"role": "user", "content": "c"}])
+
+    page = main._history_page("s", None, None, 20)
+    assert [m["id"] for m in page["messages"]] == [1, 2]
+    assert page["last_id"] == 2
+    assert page["pending"] == [{"role": "user", "content": "c"}]
+    assert main._history_page("s", 5, None, 20)["pending"] == []    # trang cũ hơn: không nối
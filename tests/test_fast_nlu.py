@@ -0,0 +1,74 @@
+# tests/test_fast_nlu.py
+import pytest
+
+from app.config import settings
+from app.services.llm import fast_nlu
+
+COLLECTING_NAME = {"book_id": 3, "quantity": 1}
+HITS = [{"book_id": 11, "title": "Dế Mèn phiêu lưu ký"}, {"book_id": 12, "title": "Harry Potter"}]
+
+
+@pytest.mark.parametrize("text, slots", [
+    ("tên sách là Harry Potter", {}),
+    ("tên sách là Harry Potter", COLLECTING_NAME),
+    ("tên tác giả Nguyễn Nhật Ánh", {}),
+    ("tên tác giả Nguyễn Nhật Ánh", COLLECTING_NAME),
+    ("tên truyện là Dế Mèn", COLLECTING_NAME),
+    ("tenet có không", {}),
+    ("tenet có không", COLLECTING_NAME),
+    ("tên Nguyễn Văn A", {}),                       # chưa tới bước hỏi tên người nhận
+])
+def test_not_a_recipient_name(text, slots):
+    out, _ = fast_nlu(text, [], slots)
+    assert out["customer_name"] is None
+
+
+@pytest.mark.parametrize("text, slots, name", [
+    ("tên Nguyễn Văn A", COLLECTING_NAME, "Nguyễn Văn A"),
+    ("tên là trần thị b", COLLECTING_NAME, "Trần Thị B"),
+    ("tên tôi là Lan", COLLECTING_NAME, "Lan"),
+    ("tên mình là Lan", COLLECTING_NAME, "Lan"),
+    ("tên của em là Nguyễn Lan", COLLECTING_NAME, "Nguyễn Lan"),
+    ("tên Anh Thư", COLLECTING_NAME, "Anh Thư"),
+    ("tên người nhận: Lê Văn C", {}, "Lê Văn C"),
+    ("người nhận là Phạm D", {}, "Phạm D"),
+])
+def test_recipient_name(text, slots, name):
+    out, conf = fast_nlu(text, [], slots)
+    assert out["intent"] == "order"
+    assert out["customer_name"] == name
+    assert conf >= settings.nlu_fast_threshold
+
+
+@pytest.mark.parametrize("text, slots, hits, field, value, intent", [
+    ("0912345678", {"book_id": 1}, [], "phone", "0912345678", "order"),
+    ("2 quyển", {"book_id": 1}, [], "quantity", 2, "order"),
+    ("id 7", {}, [], "book_id", 7, "order"),
+    ("lấy cuốn thứ 2", {}, HITS, "book_id", 12, "order"),
+    ("truyện trinh thám", {}, [], "query", "truyện trinh thám", "search"),
+    ("xin chào", {}, [], "intent", "smalltalk", "smalltalk"),
+])
+def test_fast_path_hits(text, slots, hits, field, value, intent):
+    out, conf = fast_nlu(text, hits, slots)
+    assert out["intent"] == intent
+    assert out[field] == value
+    assert conf >= settings.nlu_fast_threshold
+
+
+@pytest.mark.parametrize("text", [
+    "tên sách là Harry Potter",
+    "mình muốn mua cuốn gì đó hay hay",
+])
+def test_ambiguous_falls_back_to_llm(text):
+    _, conf = fast_nlu(text, [], {})
+    assert conf < settings.nlu_fast_threshold
+
+
+@pytest.mark.parametrize("text", [
+    "tên tôi Lan",
+    "tên mình là Lan nhé",
+    "tên là Lan ạ",
+])
+def test_recipient_name_with_leftovers_falls_back_to_llm(text):
+    _, conf = fast_nlu(text, [], COLLECTING_NAME)
+    assert conf < settings.nlu_fast_threshold
@@ -0,0 +1,43 @@
+# tests/test_json_stream.py
+import json
+
+import pytest
+
+from app.services.llm_json import JsonFieldStreamer
+
+
+def _feed_all(chunks, field="say"):
+    s = JsonFieldStreamer(field)
+    return "".join(s.feed(c) for c in chunks), s
+
+
+def _split_every(text: str, n: int):
+    return [text[i:i + n] for i in range(0, len(text), n)]
+
+
+@pytest.mark.parametrize("value", [
+    "Chào bạn!",
+    'Sách "Dế Mèn"\ngiá 50.000đ\t(còn 3)',
+    "đường dẫn a\\b / c",
+    "emoji 📚 và é",
+])
+@pytest.mark.parametrize("n", [1, 2, 3, 7, 1000])
+def test_streams_field_across_any_chunking(value, n):
+    raw = json.dumps({"intent": "search", "say": value, "items": [1, 2]})   # ensure_ascii → \uXXXX, surrogate
+    out, s = _feed_all(_split_every(raw, n))
+    assert out == value
+    assert s.state == "done"
+
+
+def test_ignores_other_fields_and_missing_field():
+    out, s = _feed_all(['{"ask": "x", "sa', 'y": "ok"}'])
+    assert out == "ok"
+    out, s = _feed_all(['{"ask": "x"}'])
+    assert out == "" and s.state == "seek"
+
+
+def test_stops_after_closing_quote():
+    s = JsonFieldStreamer("say")
+    assert s.feed('{"say": "a') == "a"
+    assert s.feed('b", "say2": "zzz"}') == "b"
+    assert s.feed('"more"') == ""
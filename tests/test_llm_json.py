@@ -0,0 +1,89 @@
+# tests/test_llm_json.py
+import json
+
+import httpx
+import pytest
+from pydantic import BaseModel
+
+from app.services import llm_json as L
+
+
+class Out(BaseModel):
+    say: str
+    n: int = 0
+
+
+@pytest.mark.parametrize("raw, repaired", [
+    ('{"say": "hi", "n": 1}', False),
+    ('```json\n{"say": "hi", "n": 1}\n```', True),
+    ('Đây là JSON:\n{"say": "hi", "n": 1}\nCảm ơn!', True),
+    ('{"say": "hi", "n": 1} {"say": "other"}', True),
+    ('note {not json} then {"say": "hi", "n": 1}', True),
+])
+def test_parse_json_repairs_near_valid_output(raw, repaired):
+    obj, was_repaired = L._parse_json(raw)
+    assert obj == {"say": "hi", "n": 1}
+    assert was_repaired is repaired
+
+
+def test_parse_json_keeps_braces_inside_strings():
+    obj, _ = L._parse_json('ok: {"say": "a } b { c \\" }", "n": 2} trailing')
+    assert obj == {"say": 'a } b { c " }', "n": 2}
+
+
+@pytest.mark.parametrize("raw", ["", "không có json", '{"say": "cut'])
+def test_parse_json_gives_up(raw):
+    with pytest.raises(json.JSONDecodeError):
+        L._parse_json(raw)
+
+
+def test_payloads_carry_json_schema():
+    schema = L._json_schema(Out)
+    assert L._ollama_chat_payload("m", [], schema)["format"] == schema
+    assert L._ollama_generate_payload("m", [], schema)["format"] == schema
+    assert L._ollama_chat_payload("m", [])["format"] == "json"
+    fmt = L._openai_payload("m", [], schema)["response_format"]
+    assert fmt == {"type": "json_schema", "json_schema": {"name": "Out", "schema": schema}}
+    assert L._openai_payload("m", [])["response_format"] == {"type": "json_object"}
+
+
+def _backend(base, handler):
+    be = L.get_backend(base)
+    be.style = "ollama_api"
+    be.http = httpx.Client(transport=httpx.MockTransport(handler))
+    return be
+
+
+def test_complete_json_repairs_without_retry_and_counts_per_site():
+    seen = []
+
+    def handler(req):
+        seen.append(json.loads(req.content))
+        return httpx.Response(200, json={"message": {"content": '```json\n{"say": "hi"}\n```'}})
+
+    _backend("http://t-repair", handler)
+    out = L.complete_json(base_url="http://t-repair", model="m", system="s", user="u", context={},
+                          schema_hint={}, schema_model=Out, cache="t_repair", bypass_cache=True)
+    assert out == {"say": "hi", "n": 0}
+    assert len(seen) == 1 and isinstance(seen[0]["format"], dict)
+    st = L.json_stats()["sites"]["t_repair"]
+    assert st == {"calls": 1, "first_try": 1, "repaired": 1, "retries": 0, "failed": 0}
+
+
+def test_schema_rejection_falls_back_to_plain_json():
+    formats = []
+
+    def handler(req):
+        fmt = json.loads(req.content)["format"]
+        formats.append(fmt)
+        if isinstance(fmt, dict):
+            return httpx.Response(400, json={"error": "invalid format"})
+        return httpx.Response(200, json={"message": {"content": '{"say": "ok"}'}})
+
+    be = _backend("http://t-old", handler)
+    kw = dict(base_url="http://t-old", model="m", system="s", user="u", context={},
+              schema_hint={}, schema_model=Out, cache="t_old", bypass_cache=True)
+    assert L.complete_json(**kw)["say"] == "ok"
+    assert be.structured is False
+    L.complete_json(**{**kw, "user": "u2"})
+    assert [isinstance(f, dict) for f in formats] == [True, False, False]
@@ -0,0 +1,107 @@
+# tests/test_llm_sched.py
+import asyncio
+import threading
+import time
+
+import pytest
+
+from app.services.llm_sched import LLMOverloaded, LLMScheduler, llm_context
+
+
+def _sched(limit=1, deadlines=None):
+    return LLMScheduler(default_limit=limit, limits={}, deadlines=deadlines or {})
+
+
+def test_priority_then_round_robin_across_sessions():
+    sch = _sched(limit=1)
+    order = []
+
+    async def call(name, prio, session):
+        with llm_context(prio, session):
+            async with sch.aslot("m"):
+                order.append(name)
+                await asyncio.sleep(0.01)
+
+    async def main():
+        hold = asyncio.create_task(call("first", "interactive", "x"))
+        await asyncio.sleep(0.001)
+        tasks = []
+        for name, prio, sess in [("b1", "batch", "job"), ("A0", "interactive", "A"), ("A1", "interactive", "A"),
+                                 ("A2", "interactive", "A"), ("B0", "interactive", "B"), ("g1", "background", "g")]:
+            tasks.append(asyncio.create_task(call(name, prio, sess)))
+            await asyncio.sleep(0)
+        await asyncio.gather(hold, *tasks)
+
+    asyncio.run(main())
+    # interactive trước, xoay vòng A/B; rồi background; batch cuối
+    assert order == ["first", "A0", "B0", "A1", "A2", "g1", "b1"]
+
+
+def test_limit_is_respected_across_threads_and_loop():
+    sch = _sched(limit=2)
+    active, peak = 0, 0
+    lock = threading.Lock()
+
+    def work():
+        nonlocal active, peak
+        with sch.slot("m"):
+            with lock:
+                active += 1
+                peak = max(peak, active)
+            time.sleep(0.02)
+            with lock:
+                active -= 1
+
+    async def awork():
+        nonlocal active, peak
+        async with sch.aslot("m"):
+            with lock:
+                active += 1
+                peak = max(peak, active)
+            await asyncio.sleep(0.02)
+            with lock:
+                active -= 1
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(None, work) for _ in range(4)], *[awork() for _ in range(4)])
+
+    asyncio.run(main())
+    assert peak == 2
+    st = sch.stats()["models"]["m"]
+    assert st["in_flight"] == 0 and sum(st["admitted"].values()) == 8
+
+
+def test_deadline_rejects_sync_and_async():
+    sch = _sched(limit=1, deadlines={"interactive": 0.05})
+    sch.acquire("m")                                  # giữ slot duy nhất
+    with pytest.raises(LLMOverloaded):
+        sch.acquire("m", "interactive")
+
+    async def main():
+        with pytest.raises(LLMOverloaded):
+            await sch.aacquire("m", "interactive")
+
+    asyncio.run(main())
+    sch.release("m")
+    st = sch.stats()["models"]["m"]
+    assert st["rejected"]["interactive"] == 2 and st["in_flight"] == 0
+    assert sum(st["queued"].values()) == 0
+
+
+def test_cancelled_waiter_does_not_leak_slot():
+    sch = _sched(limit=1)
+
+    async def main():
+        await sch.aacquire("m")
+        waiter = asyncio.create_task(sch.aacquire("m"))
+        await asyncio.sleep(0.01)
+        sch.release("m")                              # cấp slot cho waiter...
+        waiter.cancel()                               # ...nhưng waiter bị huỷ trước khi chạy tiếp
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        await asyncio.wait_for(sch.aacquire("m"), 1)  # slot đã được trả lại
+        sch.release("m")
+
+    asyncio.run(main())
+    assert sch.stats()["models"]["m"]["in_flight"] == 0
@@ -0,0 +1,101 @@
+# tests/test_singleflight.py
+import asyncio
+import copy
+import threading
+import time
+
+import pytest
+
+from app.services.cache import SingleFlight
+
+
+def test_do_coalesces_concurrent_calls():
+    sf = SingleFlight()
+    calls = []
+    gate = threading.Event()
+
+    def slow(x):
+        calls.append(x)
+        gate.wait(2)
+        return x * 2
+
+    out = []
+    threads = [threading.Thread(target=lambda: out.append(sf.do("k", slow, 21))) for _ in range(4)]
+    for t in threads:
+        t.start()
+    time.sleep(0.1)
+    gate.set()
+    for t in threads:
+        t.join()
+    assert out == [42] * 4
+    assert calls == [21]
+    assert sf.stats()["coalesced"] == 3
+
+
+def test_ado_followers_get_clone_and_errors_are_shared():
+    sf = SingleFlight(clone=copy.deepcopy)
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return {"v": [1]}
+
+    async def boom():
+        await asyncio.sleep(0.05)
+        raise ValueError("x")
+
+    async def main():
+        a, b = await asyncio.gather(sf.ado("k", fetch), sf.ado("k", fetch))
+        assert a == b and a is not b
+        res = await asyncio.gather(sf.ado("e", boom), sf.ado("e", boom), return_exceptions=True)
+        assert all(isinstance(r, ValueError) for r in res)
+
+    asyncio.run(main())
+    assert calls == 1
+    st = sf.stats()
+    assert st["errors"] == 1 and st["in_flight"] == 0
+
+
+def test_ado_leader_cancel_does_not_cancel_followers():
+    sf = SingleFlight()
+    calls = 0
+
+    async def slow():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.3)
+        return "ok"
+
+    async def main():
+        leader = asyncio.ensure_future(asyncio.wait_for(sf.ado("k", slow), 0.1))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(asyncio.wait_for(sf.ado("k", slow), 5))
+        with pytest.raises(asyncio.TimeoutError):
+            await leader
+        assert await follower == "ok"
+
+    asyncio.run(main())
+    assert calls == 1
+
+
+def test_ado_last_waiter_cancel_cancels_upstream():
+    sf = SingleFlight()
+    state = {"cancelled": False}
+
+    async def slow():
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            state["cancelled"] = True
+            raise
+
+    async def main():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(sf.ado("k", slow), 0.05)
+        await asyncio.sleep(0.01)
+        assert sf.stats()["in_flight"] == 0
+
+    asyncio.run(main())
+    assert state["cancelled"]
@@ -0,0 +1,70 @@
+# tests/test_sql.py
+from sqlalchemy import create_engine, text
+
+from app import sql as Q
+from app.sql import Stmt
+
+
+def _conn():
+    eng = create_engine("sqlite://")
+    conn = eng.connect()
+    conn.execute(text("""CREATE TABLE Books(book_id INTEGER PRIMARY KEY, title TEXT, author TEXT,
+                         price INTEGER, stock INTEGER, category TEXT)"""))
+    for i in range(1, 6):
+        conn.execute(text("INSERT INTO Books VALUES (:i, :t, 'x', 1000, 1, 'c')"), {"i": i, "t": f"B{i}"})
+    return conn
+
+
+def test_books_by_ids_expands_list():
+    conn = _conn()
+    rows = Q.BOOKS_BY_IDS.rows(conn, {"ids": [2, 4, 99]})
+    assert sorted(r["book_id"] for r in rows) == [2, 4]
+    assert [r["book_id"] for r in Q.BOOKS_BY_IDS.rows(conn, {"ids": [5]})] == [5]
+
+
+def test_expanding_stmt_is_never_server_prepared():
+    s = Stmt("t", "SELECT 1 FROM Books WHERE book_id IN :ids", prepare=True, expanding=("ids",))
+    assert s.prepare is False
+
+
+def test_positional_form_skips_time_literals():
+    s = Stmt("t", "SELECT * FROM X WHERE a=:a AND t > '12:30' AND b = :b")
+    assert s._order == ["a", "b"]
+    assert s._positional == "SELECT * FROM X WHERE a=%s AND t > '12:30' AND b = %s"
+
+
+class _FakeCursor:
+    description = [("book_id",)]
+    rowcount, lastrowid = 1, None
+
+    def execute(self, sql, params):
+        self.sql, self.params = sql, params
+
+    def fetchall(self):
+        return [(7,)]
+
+
+class _FakeConn:
+    """Connection giả cho nhánh prepared (mysqlconnector) — không cần MySQL."""
+    class dialect:
+        driver = "mysqlconnector"
+
+    def __init__(self, engine):
+        self.engine = engine
+        cur = _FakeCursor()
+        self.connection = type("Fairy", (), {"info": {}, "dbapi_connection": type(
+            "Raw", (), {"cursor": lambda self, prepared: cur})()})()
+
+    def in_transaction(self):
+        return True
+
+
+def test_prepared_path_feeds_query_metrics(monkeypatch):
+    from app import db
+    monkeypatch.setattr(Q, "_SERVER_PREPARE", True)
+    monkeypatch.setattr(db.settings, "db_slow_query_ms", 0.000001)
+    before = db.pool_stats()["sync"]
+    assert Q.BOOK_BY_ID.rows(_FakeConn(db.engine), {"id": 7}) == [{"book_id": 7}]
+    after = db.pool_stats()["sync"]
+    assert after["queries"] == before["queries"] + 1
+    assert after["slow_queries"] == before["slow_queries"] + 1
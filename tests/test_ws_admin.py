@@ -0,0 +1,55 @@
+# tests/test_ws_admin.py
+import pytest
+from fastapi.testclient import TestClient
+
+from app import main
+from app.services.order_feed import order_feed
+
+
+@pytest.fixture
+def admin_client(monkeypatch):
+    async def latest_seq():
+        return 41
+
+    async def replay(since):
+        return [{"type": "order_created", "seq": since + 1}], since + 1
+
+    monkeypatch.setattr(order_feed, "latest_seq", latest_seq)
+    monkeypatch.setattr(order_feed, "replay", replay)
+    client = TestClient(main.app)   # không chạy lifespan (không cần DB)
+    r = client.post("/admin/login", json={"username": main.settings.admin_user,
+                                          "password": main.settings.admin_pass})
+    assert r.status_code == 200
+    return client
+
+
+def test_admin_route_wins_over_session_wildcard():
+    scope = {"type": "websocket", "path": "/ws/admin", "path_params": {}, "root_path": ""}
+    from starlette.routing import Match
+    for route in main.app.routes:
+        match, child = route.matches(scope)
+        if match == Match.FULL:
+            assert route.endpoint is main.ws_admin
+            break
+    else:
+        pytest.fail("no route for /ws/admin")
+
+
+def test_admin_ws_hello(admin_client):
+    with admin_client.websocket_connect("/ws/admin") as ws:
+        assert ws.receive_json() == {"type": "hello", "seq": 41}
+
+
+def test_admin_ws_replay_since(admin_client):
+    with admin_client.websocket_connect("/ws/admin?since=7") as ws:
+        assert ws.receive_json() == {"type": "order_created", "seq": 8}
+        assert ws.receive_json() == {"type": "hello", "seq": 8}
+
+
+def test_admin_ws_requires_login():
+    from starlette.websockets import WebSocketDisconnect
+    client = TestClient(main.app)
+    with pytest.raises(WebSocketDisconnect) as e:
+        with client.websocket_connect("/ws/admin") as ws:
+            ws.receive_json()
+    assert e.value.code == 1008